@@ -19,7 +19,11 @@ setup(
         'requests',
         'prettytable'
     ],
-    packages=find_packages(),
+    extras_require={
+        'async': ['gevent']
+    },
+    packages=find_packages(exclude=['tests']),
+    test_suite='tests',
     entry_points={
         'console_scripts': ['tinify-cli=tinifycli.__init__:main']
     }
@@ -0,0 +1,6 @@
+# coding=utf-8
+
+import logging
+
+# 测试中不输出日志
+logging.getLogger('tinify-cli').addHandler(logging.NullHandler())
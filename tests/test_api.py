@@ -0,0 +1,136 @@
+# coding=utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from tinifycli import api
+from tinifycli.api import TinifyCliClient
+from tinifycli.mock_server import MockTinifyServer
+
+
+class StreamingTest(unittest.TestCase):
+    ''' 上传和下载都分块进行, 不把整张图片读进内存 '''
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        self.server = MockTinifyServer(('127.0.0.1', 0), keys=set(['k1']),
+                                       output_ttl=60)
+        self.endpoint = self.server.start()
+        self.src = os.path.join(self.workdir, 'a.png')
+        with open(self.src, 'wb') as fp:
+            fp.write(os.urandom(100000))
+        self.client = TinifyCliClient('k1', api_endpoint=self.endpoint)
+        self.old_chunk_size = api.CHUNK_SIZE
+        api.CHUNK_SIZE = 4096
+
+    def tearDown(self):
+        api.CHUNK_SIZE = self.old_chunk_size
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir)
+
+    def _record_requests(self):
+        ''' 记下每个请求的 data 参数 '''
+        bodies = []
+        request = self.client.session.request
+
+        def recording_request(method, url, **kwargs):
+            bodies.append(kwargs.get('data'))
+            return request(method, url, **kwargs)
+        self.client.session.request = recording_request
+        return bodies
+
+    def test_upload_sends_file_object(self):
+        bodies = self._record_requests()
+        self.client.shrink(self.src)
+        self.assertEqual(len(bodies), 1)
+        self.assertTrue(hasattr(bodies[0], 'read'))
+        self.assertEqual(self.client.src_size, 100000)
+        self.assertEqual(self.client.bytes_up, 100000)
+
+    def test_download_is_written_in_chunks(self):
+        chunks = []
+        iter_chunks = self.client._iter_chunks
+
+        def recording_iter(response, waits=None):
+            for chunk in iter_chunks(response, waits):
+                chunks.append(len(chunk))
+                yield chunk
+        self.client._iter_chunks = recording_iter
+        dest = os.path.join(self.workdir, 'b.png')
+        self.client.compress(self.src, dest)
+        self.assertEqual(os.path.getsize(dest), 50000)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(max(chunks) <= api.CHUNK_SIZE)
+        self.assertEqual(sum(chunks), self.client.bytes_down)
+        with open(self.src, 'rb') as src_fp, open(dest, 'rb') as dest_fp:
+            self.assertEqual(dest_fp.read(), src_fp.read(50000))
+        # 写完后改名为 dest , 不留下临时文件
+        self.assertEqual(sorted(os.listdir(self.workdir)),
+                         ['a.png', 'b.png'])
+
+    def test_failed_download_keeps_old_dest(self):
+        dest = os.path.join(self.workdir, 'b.png')
+        with open(dest, 'wb') as fp:
+            fp.write('old')
+        download_url, _ = self.client.shrink(self.src)
+        response = self.client.open_output(download_url)
+        chunks = list(response.iter_content(api.CHUNK_SIZE))
+
+        def broken_chunks(chunk_size):
+            yield chunks[0]  # 写入一部分之后连接断开
+            raise IOError('connection reset')
+        response.iter_content = broken_chunks
+        self.client.open_output = lambda *args: response
+        self.assertRaises(IOError, self.client.fetch, download_url, dest)
+        with open(dest, 'rb') as fp:
+            self.assertEqual(fp.read(), 'old')
+        self.assertEqual(sorted(os.listdir(self.workdir)),
+                         ['a.png', 'b.png'])
+
+
+class VariantsTest(unittest.TestCase):
+    ''' 上传一次, 同时下载多个尺寸 '''
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        self.server = MockTinifyServer(('127.0.0.1', 0), keys=set(['k1']))
+        self.endpoint = self.server.start()
+        self.src = os.path.join(self.workdir, 'a.png')
+        with open(self.src, 'wb') as fp:
+            fp.write('x' * 1000)
+        self.client = TinifyCliClient('k1', api_endpoint=self.endpoint)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir)
+
+    def test_one_upload_for_all_variants(self):
+        outputs = [(os.path.join(self.workdir, name), resize)
+                   for name, resize in (('s.png', ('scale', 320, None)),
+                                        ('f.png', ('fit', 120, 80)),
+                                        ('c.png', ('cover', 20, 20)))]
+        self.client.compress_variants(self.src, outputs)
+        self.assertEqual(self.client.bytes_up, 1000)
+        for dest, _ in outputs:
+            self.assertEqual(os.path.getsize(dest), 500)
+        self.assertEqual(self.client.dest_size, 1500)
+        # 一次上传, 每个尺寸一次调整
+        self.assertEqual(self.server.compression_count('k1'), 4)
+
+    def test_failed_variant_raises(self):
+        download_url, info = self.client.shrink(self.src)
+        outputs = [(os.path.join(self.workdir, 's.png'),
+                    ('scale', 320, None)),
+                   (os.path.join(self.workdir, 'f.png'), ('fit', 120, 80))]
+        self.assertRaises(api.ClientError, self.client.compress_variants,
+                          self.src, outputs,
+                          (download_url + '-expired', info))
+        self.assertEqual(sorted(os.listdir(self.workdir)), ['a.png'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# coding=utf-8
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from tinifycli import cache
+from tinifycli.cache import TinifyCliResultCache
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        self.cache_dir = os.path.join(self.workdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _cache(self, max_size=1000):
+        return TinifyCliResultCache(self.cache_dir, max_size)
+
+    def _output(self, name, size=100):
+        path = os.path.join(self.workdir, name)
+        with open(path, 'wb') as fp:
+            fp.write(name[0] * size)
+        return path
+
+    def _store(self, result_cache, name, size=100):
+        result_cache.store(name + '0' * 38, self._output(name, size))
+
+    def _lookup(self, result_cache, name):
+        return result_cache.lookup(name + '0' * 38,
+                                   os.path.join(self.workdir, 'dest'))
+
+    def test_hit_and_miss(self):
+        result_cache = self._cache()
+        self._store(result_cache, 'a')
+        self.assertTrue(self._lookup(result_cache, 'a'))
+        with open(os.path.join(self.workdir, 'dest'), 'rb') as fp:
+            self.assertEqual(fp.read(), 'a' * 100)
+        self.assertFalse(self._lookup(result_cache, 'b'))
+        self.assertEqual((result_cache.hits, result_cache.misses), (1, 1))
+
+    def test_evicts_least_recently_used_to_low_water(self):
+        result_cache = self._cache(max_size=1000)
+        for name in 'abcdefghij':
+            self._store(result_cache, name)
+        self.assertEqual(result_cache.total_size, 1000)
+        self.assertTrue(self._lookup(result_cache, 'a'))  # a 变成最近使用的
+        self._store(result_cache, 'k')
+        # 淘汰到 900 字节: b 和 c 是最久未使用的
+        self.assertEqual(result_cache.total_size, 900)
+        self.assertFalse(self._lookup(result_cache, 'b'))
+        self.assertFalse(self._lookup(result_cache, 'c'))
+        self.assertTrue(self._lookup(result_cache, 'a'))
+        self.assertTrue(self._lookup(result_cache, 'k'))
+
+    def test_eviction_does_not_walk_the_cache(self):
+        result_cache = self._cache(max_size=1000)
+        for name in 'abcdefghij':
+            self._store(result_cache, name)
+
+        def no_walk():
+            raise AssertionError('淘汰时不应遍历缓存目录')
+        result_cache._entries = no_walk
+        for name in 'klmnopqrst':
+            self._store(result_cache, name)
+        self.assertTrue(result_cache.total_size <= 1000)
+
+    def test_lookup_keeps_output_mtime(self):
+        result_cache = self._cache()
+        output = self._output('a')
+        old_time = time.time() - 3600
+        os.utime(output, (old_time, old_time))
+        result_cache.store('a' * 40, output)  # 可能与 output 是硬链接
+        self.assertTrue(result_cache.lookup(
+            'a' * 40, os.path.join(self.workdir, 'dest')))
+        self.assertAlmostEqual(os.path.getmtime(output), old_time, places=3)
+
+    def test_recency_persists(self):
+        result_cache = self._cache(max_size=1000)
+        for name in 'abcdefghij':
+            self._store(result_cache, name)
+        self.assertTrue(self._lookup(result_cache, 'a'))
+        result_cache.flush()
+
+        result_cache = self._cache(max_size=1000)
+        self.assertEqual(result_cache.total_size, 1000)
+        self.assertEqual(result_cache.entries.keys()[-1], 'a' + '0' * 38)
+        self._store(result_cache, 'k')
+        self.assertTrue(self._lookup(result_cache, 'a'))
+        self.assertFalse(self._lookup(result_cache, 'b'))
+
+    def test_missing_file_is_forgotten(self):
+        result_cache = self._cache()
+        self._store(result_cache, 'a')
+        os.remove(result_cache._path('a' + '0' * 38))
+        self.assertFalse(self._lookup(result_cache, 'a'))
+        self.assertEqual(result_cache.total_size, 0)
+
+    def test_file_digest_reuses_memo(self):
+        path = self._output('a')
+        digest = cache.file_digest(path)
+        self.assertEqual(digest, cache.hash_file(path))
+        with open(path, 'rb') as fp:
+            self.assertEqual(cache.file_digest(path, fp.read()), digest)
+
+    def test_miss_does_not_touch_dest(self):
+        result_cache = self._cache()
+        calls = []
+        original = cache.place_file
+        cache.place_file = lambda *args: calls.append(args)
+        try:
+            self.assertFalse(self._lookup(result_cache, 'b'))
+        finally:
+            cache.place_file = original
+        self.assertEqual(calls, [])
+
+    def test_make_key_matches_make_keys(self):
+        path = self._output('a')
+        resize = ('scale', 100, None)
+        self.assertEqual(TinifyCliResultCache.make_key(path, resize),
+                         TinifyCliResultCache.make_keys(path, [resize])[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
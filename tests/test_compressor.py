@@ -0,0 +1,71 @@
+# coding=utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from tinifycli import api
+from tinifycli.compressor import TinifyCliCompressor
+from tinifycli.mock_server import MockTinifyServer
+
+
+class CompressorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        self.server = MockTinifyServer(('127.0.0.1', 0), keys=set(['k1']))
+        self.endpoint = self.server.start()
+        self.tasks = []
+        for name in ('a.png', 'b.png', 'c.png'):
+            src = os.path.join(self.workdir, name)
+            with open(src, 'wb') as fp:
+                fp.write('x' * 1000)
+            self.tasks.append((src, src + '.out'))
+        self.original_compress = api.TinifyCliClient.compress
+
+    def tearDown(self):
+        api.TinifyCliClient.compress = self.original_compress
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir)
+
+    def _compress(self, tasks, concurrency=1):
+        with TinifyCliCompressor(['k1'], concurrency=concurrency,
+                                 api_endpoint=self.endpoint) as compressor:
+            return sorted(compressor.compress(tasks),
+                          key=lambda result: repr(result.src))
+
+    def test_compress(self):
+        results = self._compress(self.tasks, concurrency=2)
+        self.assertEqual([result.src for result in results],
+                         [src for src, _ in self.tasks])
+        for result in results:
+            self.assertTrue(result.ok)
+            self.assertEqual(result.ratio, 0.5)
+
+    def test_unexpected_error_is_a_failure(self):
+        original_compress = self.original_compress
+
+        def compress(client, src, dest, resize=None, shrunk=None):
+            if src.endswith('b.png'):
+                raise KeyError('output')  # 响应缺少字段
+            return original_compress(client, src, dest, resize, shrunk)
+        api.TinifyCliClient.compress = compress
+        # 只有一个工作线程, 它出错之后还要继续处理后面的任务
+        results = self._compress(self.tasks)
+        self.assertEqual([result.ok for result in results],
+                         [True, False, True])
+        self.assertIsInstance(results[1].error, KeyError)
+        self.assertEqual(results[1].attempts, 1)
+
+    def test_malformed_task_is_a_failure(self):
+        results = self._compress([5] + self.tasks[:1])
+        self.assertEqual(len(results), 2)
+        failed = [result for result in results if not result.ok]
+        self.assertEqual(len(failed), 1)
+        self.assertIsInstance(failed[0].error, TypeError)
+
+
+if __name__ == '__main__':
+    unittest.main()
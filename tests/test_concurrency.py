@@ -0,0 +1,184 @@
+# coding=utf-8
+
+import random
+import threading
+import time
+import unittest
+
+from tinifycli.concurrency import TinifyCliConcurrencyController
+from tinifycli.dispatcher import TinifyCliDispatcher
+
+
+class ConcurrencyControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(1)
+
+    def _controller(self, max_limit=64, initial_limit=4):
+        controller = TinifyCliConcurrencyController(max_limit, initial_limit)
+        controller.WINDOW = 0  # 每凑够 MIN_SAMPLES 个任务就调整一次
+        return controller
+
+    def _window(self, controller, latency, reason='success'):
+        ''' 完成一个窗口的任务 '''
+        for _ in range(controller.MIN_SAMPLES):
+            controller.active += 1
+            controller.release(latency, reason)
+
+    def test_acquire_respects_limit(self):
+        controller = self._controller(initial_limit=2)
+        self.assertTrue(controller.acquire())
+        self.assertTrue(controller.acquire())
+        start_time = time.time()
+        self.assertFalse(controller.acquire(timeout=0.1))
+        self.assertGreaterEqual(time.time() - start_time, 0.09)
+
+    def test_release_wakes_waiter(self):
+        controller = self._controller(initial_limit=1)
+        controller.WINDOW = 60
+        controller.acquire()
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(controller.acquire(timeout=2)))
+        thread.start()
+        time.sleep(0.05)
+        controller.release(0.1, 'success')
+        thread.join()
+        self.assertEqual(acquired, [True])
+
+    def test_slow_start_doubles(self):
+        controller = self._controller()
+        self._window(controller, 1.0)
+        self._window(controller, 1.0)
+        self.assertEqual(controller.limit, 16)
+        self.assertTrue(controller.slow_start)
+
+    def test_throttling_decreases(self):
+        controller = self._controller(initial_limit=16)
+        controller.active += 1
+        controller.release(0, 'rateLimited')
+        self.assertEqual(controller.limit, 12)
+        self.assertFalse(controller.slow_start)
+        controller.active += 1
+        controller.release(0, 'localError')  # 与服务器无关的失败
+        self.assertEqual(controller.limit, 12)
+
+    def test_latency_rise_decreases(self):
+        controller = self._controller(initial_limit=32)
+        self._window(controller, 1.0)
+        self._window(controller, 1.0)
+        limit = controller.limit
+        self._window(controller, 10.0)
+        self.assertFalse(controller.slow_start)
+        self.assertLess(controller.limit, limit)
+
+    def test_stays_within_bounds(self):
+        controller = self._controller(max_limit=10)
+        for _ in range(10):
+            self._window(controller, 1.0)
+        self.assertEqual(controller.limit, 10)
+        for _ in range(50):
+            controller.active += 1
+            controller.release(0, 'serverError')
+        self.assertEqual(controller.limit, controller.min_limit)
+
+    def _simulate(self, controller, windows, capacity, base_latency=1.0,
+                  noise=0.3):
+        ''' 带宽只够同时传输 capacity 张图片, 超出的任务排队, 延迟随并发数
+        线性增加 '''
+        limits = []
+        for _ in range(windows):
+            latency = base_latency * max(1.0, controller.limit / capacity)
+            self._window(controller,
+                         latency * (1 + self.random.uniform(-noise, noise)))
+            limits.append(controller.limit)
+        return limits
+
+    def test_converges_to_capacity(self):
+        controller = self._controller(max_limit=200)
+        limits = self._simulate(controller, 200, 20.0)
+        # 延迟平稳上升时并发数也不会一直增加到上限
+        self.assertLess(max(limits[100:]), 60)
+        self.assertGreaterEqual(min(limits[100:]), 10)
+        self.assertTrue(15 <= controller.settled_limit <= 45,
+                        controller.settled_limit)
+
+    def test_follows_capacity_drop(self):
+        controller = self._controller(max_limit=200)
+        self._simulate(controller, 150, 20.0)
+        limits = self._simulate(controller, 150, 8.0)
+        self.assertLess(sum(limits[-50:]) / 50, 25)
+
+    def test_probe_remeasures_base_latency(self):
+        controller = self._controller(max_limit=200)
+        self._simulate(controller, 100, 20.0)
+        # 图片变大, 没有排队时的延迟也变为 3 倍, 并发数不应降到底
+        limits = self._simulate(controller, 100, 20.0, base_latency=3.0)
+        self.assertGreater(sum(limits[-50:]) / 50, 15)
+        self.assertGreater(controller.base_latency, 2.0)
+
+    def test_probe_halves_limit_for_one_window(self):
+        controller = self._controller(initial_limit=32)
+        controller.slow_start = False
+        controller.base_latency = 1.0
+        controller.probe_countdown = 1
+        self._window(controller, 1.0)
+        limit = controller.probe_saved_limit
+        self.assertEqual(controller.limit, limit * controller.PROBE_FACTOR)
+        self._window(controller, 0.8)
+        self.assertEqual(controller.limit, limit)
+        self.assertEqual(controller.base_latency, 0.8)
+        self.assertIsNone(controller.probe_saved_limit)
+
+    def test_missing_latency_is_ignored(self):
+        controller = self._controller()
+        self._window(controller, 1.0)
+        self._window(controller, None)  # 命中缓存的任务
+        self.assertEqual(controller.base_latency, 1.0)
+        self.assertEqual(controller.limit, 8)
+        self.assertEqual(controller.window_latencies, [])
+
+
+class DispatcherControllerTest(unittest.TestCase):
+
+    class RecordingController(TinifyCliConcurrencyController):
+
+        def __init__(self, max_limit):
+            TinifyCliConcurrencyController.__init__(self, max_limit)
+            self.latencies = []
+
+        def release(self, latency, reason):
+            self.latencies.append(latency)
+            TinifyCliConcurrencyController.release(self, latency, reason)
+
+    def test_cached_and_resumed_results_have_no_latency(self):
+        controller = self.RecordingController(4)
+        infos = {'a': {'cached': True}, 'b': {'resumed': 'journal'},
+                 'c': {'resumed': None}}
+
+        def func(task):
+            time.sleep(0.01)
+            return ('success', infos[task[0]])
+        dispatcher = TinifyCliDispatcher(2, 8, controller)
+        tasks = [(name, name + '.out', None) for name in 'abc']
+        self.assertEqual(dispatcher.run(tasks, func), 3)
+        self.assertEqual(controller.latencies.count(None), 2)
+        self.assertEqual(len(controller.latencies), 3)
+
+    def test_idle_workers_hold_no_slot(self):
+        controller = self.RecordingController(4)
+        active = []
+
+        def func(task):
+            time.sleep(0.1)  # 其余的工作线程都已经在等待任务
+            active.append(controller.active)
+            return ('success', )
+        dispatcher = TinifyCliDispatcher(4, 8, controller)
+        self.assertEqual(dispatcher.run([('a', 'a.out', None)], func), 1)
+        # 等待任务的工作线程没有占用名额
+        self.assertEqual(active, [1])
+        self.assertEqual(len(controller.latencies), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+# coding=utf-8
+
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+import tinifycli
+from tinifycli import shared_var
+
+
+class DiscoveryTest(unittest.TestCase):
+    ''' 边遍历源目录边产生任务 '''
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        self.old_vars = (shared_var.src_dir, shared_var.dest_dir,
+                         shared_var.filename_pattern,
+                         shared_var.is_recursive)
+        shared_var.src_dir = os.path.join(self.workdir, 'src')
+        # 输出目录在源目录里面
+        shared_var.dest_dir = os.path.join(shared_var.src_dir, 'out')
+        shared_var.filename_pattern = r'^(.*\.png)$'
+        shared_var.is_recursive = False
+        for path in ('a.png', 'notes.txt', os.path.join('sub', 'b.png'),
+                     os.path.join('sub', 'deeper', 'c.png'),
+                     os.path.join('out', 'tinify-a.png')):
+            path = os.path.join(shared_var.src_dir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as fp:
+                fp.write('image')
+
+    def tearDown(self):
+        (shared_var.src_dir, shared_var.dest_dir, shared_var.filename_pattern,
+         shared_var.is_recursive) = self.old_vars
+        shutil.rmtree(self.workdir)
+
+    def test_top_level_only(self):
+        self.assertEqual(list(tinifycli.discover_file()), ['a.png'])
+
+    def test_recursive_skips_dest_dir(self):
+        shared_var.is_recursive = True
+        self.assertEqual(sorted(tinifycli.discover_file()),
+                         ['a.png', os.path.join('sub', 'b.png'),
+                          os.path.join('sub', 'deeper', 'c.png')])
+
+    def test_is_lazy(self):
+        shared_var.is_recursive = True
+        files = tinifycli.discover_file()
+        self.assertIsInstance(files, types.GeneratorType)
+        next(files)
+        # 已经开始产生任务之后新建的子目录也会被遍历到
+        path = os.path.join(shared_var.src_dir, 'sub', 'new', 'd.png')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fp:
+            fp.write('image')
+        self.assertIn(os.path.join('sub', 'new', 'd.png'), list(files))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# coding=utf-8
+
+import threading
+import time
+import unittest
+
+from tinifycli.dispatcher import TinifyCliDispatcher
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def _start(self, target):
+        thread = threading.Thread(target=target)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def _tasks(self, num, produced=None):
+        ''' 逐个产生任务, 把已经产生的个数记在 produced[0] '''
+        for i in range(num):
+            if produced is not None:
+                produced[0] += 1
+            yield ('img%d.png' % i, 'out%d.png' % i, None)
+
+    def test_runs_all_tasks(self):
+        finished = []
+        lock = threading.Lock()
+
+        def func(task):
+            with lock:
+                finished.append(task[0])
+            return ('success', )
+        dispatcher = TinifyCliDispatcher(4, 8)
+        self.assertEqual(dispatcher.run(self._tasks(50), func), 50)
+        self.assertEqual(sorted(finished),
+                         sorted('img%d.png' % i for i in range(50)))
+        self.assertEqual(dispatcher.pending, 0)
+
+    def test_queue_is_bounded(self):
+        produced = [0]
+        ahead = []
+        release = threading.Event()
+
+        def func(task):
+            release.wait(5)
+            # 产生了的任务减去做完的任务, 不超过 queue_size
+            ahead.append(produced[0] - dispatcher.finished)
+            return ('success', )
+        dispatcher = TinifyCliDispatcher(2, 6)
+        thread = self._start(
+            lambda: dispatcher.run(self._tasks(100, produced), func))
+        try:
+            time.sleep(0.2)
+            # 工作线程都还没有做完任务时, 任务的产生者取出第 7 个任务后等待
+            self.assertEqual(produced[0], 7)
+            self.assertEqual(dispatcher.pending, 6)
+        finally:
+            release.set()
+        thread.join(10)
+        self.assertEqual(dispatcher.finished, 100)
+        self.assertTrue(max(ahead) <= 6 + 1, max(ahead))
+
+    def test_drain_finishes_started_tasks(self):
+        started = threading.Event()
+        release = threading.Event()
+        produced = [0]
+
+        def func(task):
+            started.set()
+            release.wait(5)
+            return ('success', )
+        dispatcher = TinifyCliDispatcher(1, 4)
+        result = []
+        thread = self._start(lambda: result.append(
+            dispatcher.run(self._tasks(100, produced), func)))
+        started.wait(5)
+        time.sleep(0.1)  # 队列已满
+        dispatcher.drain(5)
+        release.set()
+        thread.join(10)
+        # 已经开始的任务做完, 排队中的被放弃, 之后的任务不再产生
+        self.assertEqual(result, [1])
+        self.assertEqual(dispatcher.dropped, 3)
+        self.assertEqual(dispatcher.pending, 0)
+        self.assertEqual(produced[0], 5)
+
+    def test_drain_timeout(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def func(task):
+            started.set()
+            release.wait(5)
+            return ('success', )
+        dispatcher = TinifyCliDispatcher(1, 4)
+        result = []
+        thread = self._start(lambda: result.append(
+            dispatcher.run(self._tasks(10), func)))
+        try:
+            started.wait(5)
+            time.sleep(0.1)
+            start_time = time.time()
+            dispatcher.drain(0.3)
+            thread.join(10)
+            self.assertLess(time.time() - start_time, 3)
+        finally:
+            release.set()
+        self.assertEqual(result, [0])
+        # 执行中的任务和唯一的工作线程来不及取出的任务都算作没有完成
+        self.assertEqual(dispatcher.pending, 4)
+        self.assertEqual(dispatcher.dropped, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# coding=utf-8
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from tinifycli.journal import TinifyCliResumeJournal
+
+
+class ResumeJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        self.path = os.path.join(self.workdir, 'resume.json')
+        self.src = os.path.join(self.workdir, 'a.png')
+        with open(self.src, 'wb') as fp:
+            fp.write('image')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _journal(self, max_age=TinifyCliResumeJournal.MAX_AGE):
+        journal = TinifyCliResumeJournal(self.path, max_age)
+        journal.SAVE_INTERVAL = 3600  # 除非测试需要, 不自动写入
+        return journal
+
+    def test_resume_after_save(self):
+        journal = self._journal()
+        journal.record(self.src, 'http://x/output/1', {'key_id': 'abc'})
+        journal.save()
+        url, info = self._journal().lookup(self.src)
+        self.assertEqual(url, 'http://x/output/1')
+        self.assertEqual(info['key_id'], 'abc')
+
+    def test_changed_source_is_not_resumed(self):
+        journal = self._journal()
+        journal.record(self.src, 'http://x/output/1', {})
+        with open(self.src, 'wb') as fp:
+            fp.write('another image')
+        self.assertIsNone(journal.lookup(self.src))
+
+    def test_max_age(self):
+        journal = self._journal()
+        journal.record(self.src, 'http://x/output/1', {})
+        journal.entries[self.src]['time'] = time.time() - 120
+        journal.save()
+        self.assertIsNotNone(self._journal(max_age=300).lookup(self.src))
+        self.assertIsNone(self._journal(max_age=60).lookup(self.src))
+
+    def test_flushes_periodically(self):
+        journal = self._journal()
+        journal.SAVE_INTERVAL = 0
+        journal.record(self.src, 'http://x/output/1', {})
+        self.assertTrue(os.path.exists(self.path))  # 没有调用 save
+        journal.discard(self.src)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_plaintext_key_is_dropped(self):
+        st = os.stat(self.src)
+        with open(self.path, 'w') as fp:
+            json.dump({self.src: {
+                'url': 'http://x/output/1', 'info': {'key': 'secret'},
+                'size': st.st_size, 'mtime': st.st_mtime,
+                'time': time.time()}}, fp)
+        journal = self._journal()
+        journal.save()
+        with open(self.path) as fp:
+            self.assertNotIn('secret', fp.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
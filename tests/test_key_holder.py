@@ -0,0 +1,204 @@
+# coding=utf-8
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from tinifycli import api
+from tinifycli import shared_var
+from tinifycli.key_holder import TinifyCliKeyHolder, EmptyKeyHolderException
+
+
+class KeyStatusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        self.old_path = TinifyCliKeyHolder.KEY_HOLDER_PATH
+        TinifyCliKeyHolder.set_key_holder_path(
+            os.path.join(self.workdir, 'keys'))
+        with open(TinifyCliKeyHolder.KEY_HOLDER_PATH, 'w') as fp:
+            fp.write('k1\nk2\n')
+        shared_var.is_no_validate = False
+
+    def tearDown(self):
+        TinifyCliKeyHolder.KEY_HOLDER_PATH = self.old_path
+        shutil.rmtree(self.workdir)
+
+    def _write_status(self, checked_at, name=TinifyCliKeyHolder.fingerprint):
+        status = dict((name(key), {'status': 'valid', 'compression_count': 1,
+                                   'checked_at': checked_at})
+                      for key in ('k1', 'k2'))
+        with open(TinifyCliKeyHolder.status_path(), 'w') as fp:
+            json.dump(status, fp)
+
+    def _read_status(self):
+        ''' 以 Key 本身为键返回状态文件的内容 '''
+        with open(TinifyCliKeyHolder.status_path()) as fp:
+            saved = json.load(fp)
+        self.assertFalse(set(saved) & set(['k1', 'k2']))  # 不保存 Key 本身
+        return dict((key, saved[TinifyCliKeyHolder.fingerprint(key)])
+                    for key in ('k1', 'k2')
+                    if TinifyCliKeyHolder.fingerprint(key) in saved)
+
+    def _load(self):
+        key_holder = TinifyCliKeyHolder()
+        key_holder.load_keys_from_file()
+        return key_holder
+
+    def test_status_file_is_private(self):
+        self._write_status(time.time())
+        os.chmod(TinifyCliKeyHolder.status_path(), 0644)
+        self._load().save_status()
+        mode = os.stat(TinifyCliKeyHolder.status_path()).st_mode & 0777
+        self.assertEqual(mode, 0600)
+
+    def test_migrates_plaintext_keys(self):
+        checked_at = time.time() - 60
+        self._write_status(checked_at, name=lambda key: key)
+        key_holder = self._load()
+        self.assertEqual(key_holder.compression_counts, {'k1': 1, 'k2': 1})
+        key_holder.save_status()
+        self.assertAlmostEqual(self._read_status()['k1']['checked_at'],
+                               checked_at)
+
+    def test_no_status_file_without_ttl(self):
+        old_ttl = TinifyCliKeyHolder.STATUS_TTL
+        TinifyCliKeyHolder.STATUS_TTL = 0
+        try:
+            key_holder = TinifyCliKeyHolder()
+            key_holder.add_keys(['k1'])
+            key_holder.save_status()
+        finally:
+            TinifyCliKeyHolder.STATUS_TTL = old_ttl
+        self.assertFalse(os.path.exists(TinifyCliKeyHolder.status_path()))
+
+    def test_account_status(self):
+        exceeded = api.AccountError('Your monthly limit has been exceeded')
+        invalid = api.AccountError('Credentials are invalid')
+        self.assertEqual(TinifyCliKeyHolder.account_status(exceeded),
+                         'exhausted')
+        self.assertEqual(TinifyCliKeyHolder.account_status(invalid),
+                         'invalid')
+
+    def test_save_does_not_refresh_unconfirmed_keys(self):
+        checked_at = time.time() - 60
+        self._write_status(checked_at)
+        key_holder = self._load()
+        key_holder.save_status()
+        status = self._read_status()
+        self.assertAlmostEqual(status['k1']['checked_at'], checked_at)
+
+    def test_successful_response_refreshes_check_time(self):
+        checked_at = time.time() - 60
+        self._write_status(checked_at)
+        key_holder = self._load()
+        key = key_holder.acquire_key('k1')
+        key_holder.release_key(key, 7)
+        key_holder.save_status()
+        status = self._read_status()
+        self.assertEqual(status['k1']['compression_count'], 7)
+        self.assertGreater(status['k1']['checked_at'], checked_at)
+        self.assertAlmostEqual(status['k2']['checked_at'], checked_at)
+
+    def test_account_error_is_persisted(self):
+        self._write_status(time.time())
+        key_holder = self._load()
+        key = key_holder.acquire_key('k1')
+        key_holder.remove_key(
+            key, api.AccountError('Your monthly limit has been exceeded'))
+        key_holder.release_key(key, 500)
+        key_holder.save_status()
+        self.assertEqual(self._read_status()['k1']['status'], 'exhausted')
+        self.assertIn('k1', key_holder.exhausted_keys)
+
+        # 下次运行不再使用 k1
+        self.assertEqual(self._load().keys, ['k2'])
+
+    def test_invalid_key_is_persisted(self):
+        self._write_status(time.time())
+        key_holder = self._load()
+        key_holder.remove_key('k2', api.AccountError('Credentials are invalid'))
+        key_holder.save_status()
+        self.assertEqual(self._read_status()['k2']['status'], 'invalid')
+        self.assertEqual(self._load().keys, ['k1'])
+
+
+class KeyQuotaTest(unittest.TestCase):
+
+    def _key_holder(self, quota, counts):
+        key_holder = TinifyCliKeyHolder()
+        key_holder.MONTHLY_QUOTA = quota
+        key_holder.add_keys(sorted(counts))
+        key_holder.compression_counts.update(counts)
+        return key_holder
+
+    def _acquire_in_thread(self, key_holder):
+        result = {}
+
+        def acquire():
+            try:
+                result['key'] = key_holder.acquire_key()
+            except EmptyKeyHolderException as err:
+                result['error'] = err
+
+        thread = threading.Thread(target=acquire)
+        thread.setDaemon(True)
+        thread.start()
+        return thread, result
+
+    def test_unlimited_by_default(self):
+        key_holder = TinifyCliKeyHolder()
+        self.assertEqual(key_holder.MONTHLY_QUOTA, 0)
+        key_holder.add_keys(['k1'])
+        key = key_holder.acquire_key()
+        key_holder.release_key(key, 100000)
+        self.assertEqual(key_holder.keys, ['k1'])
+
+    def test_picks_key_with_most_remaining(self):
+        key_holder = self._key_holder(10, {'k1': 8, 'k2': 3})
+        self.assertEqual(key_holder.acquire_key(), 'k2')
+        self.assertEqual(key_holder.acquire_key('k1'), 'k1')
+
+    def test_retires_key_at_quota(self):
+        key_holder = self._key_holder(10, {'k1': 9, 'k2': 0})
+        key_holder.release_key(key_holder.acquire_key('k1'), 10)
+        self.assertEqual(key_holder.keys, ['k2'])
+        self.assertIn('k1', key_holder.exhausted_keys)
+
+    def test_waits_instead_of_overshooting(self):
+        key_holder = self._key_holder(2, {'k1': 1})
+        key = key_holder.acquire_key()
+        thread, result = self._acquire_in_thread(key_holder)
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())  # 唯一的剩余次数正被占用
+
+        # 请求失败, 没有消耗次数, 等待的一方拿到 Key
+        key_holder.release_key(key, None)
+        thread.join(2)
+        self.assertEqual(result.get('key'), 'k1')
+
+    def test_find_key_by_fingerprint(self):
+        key_holder = self._key_holder(0, {'k1': 0, 'k2': 0})
+        fingerprint = TinifyCliKeyHolder.fingerprint('k2')
+        self.assertNotIn('k2', fingerprint)
+        self.assertEqual(key_holder.find_key(fingerprint), 'k2')
+        key_holder.remove_key('k2')
+        self.assertIsNone(key_holder.find_key(fingerprint))
+        self.assertIsNone(key_holder.find_key(None))
+
+    def test_raises_when_inflight_requests_use_up_quota(self):
+        key_holder = self._key_holder(2, {'k1': 1})
+        key = key_holder.acquire_key()
+        thread, result = self._acquire_in_thread(key_holder)
+        thread.join(0.2)
+        key_holder.release_key(key, 2)
+        thread.join(2)
+        self.assertIsInstance(result.get('error'), EmptyKeyHolderException)
+
+
+if __name__ == '__main__':
+    unittest.main()
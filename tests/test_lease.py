@@ -0,0 +1,110 @@
+# coding=utf-8
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from tinifycli.lease import TinifyCliLeaseStore
+
+
+class LeaseStoreTest(unittest.TestCase):
+
+    LEASE_SECONDS = 0.6
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        self.path = os.path.join(self.workdir, 'leases.db')
+        self.stores = []
+        self.tasks = [(os.path.join(self.workdir, name), name + '.out', None)
+                      for name in ('a.png', 'b.png')]
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.workdir)
+
+    def _store(self, lease_seconds=LEASE_SECONDS):
+        store = TinifyCliLeaseStore(self.path, self.workdir,
+                                    lease_seconds, batch_size=16)
+        store.RECHECK_INTERVAL = 0.1
+        store.RETRY_MARGIN = 0.05
+        store.MAX_WAIT = 0.05
+        self.stores.append(store)
+        return store
+
+    def _srcs(self, tasks):
+        return [task[0] for task in tasks]
+
+    def test_claims_free_tasks(self):
+        first, second = self._store(), self._store()
+        self.assertEqual(list(first.filter_tasks(self.tasks)), self.tasks)
+        self.assertEqual(first.claimed, 2)
+        self.assertEqual(second.claim_batch(['a.png', 'c.png']), ['c.png'])
+
+    def test_completed_tasks_are_skipped(self):
+        first, second = self._store(), self._store()
+        list(first.filter_tasks(self.tasks))
+        first.complete(self.tasks[0][0], self.tasks[0][1])
+        first.close()
+        start_time = time.time()
+        self.assertEqual(self._srcs(second.filter_tasks(self.tasks)),
+                         [self.tasks[1][0]])
+        self.assertLess(time.time() - start_time, 0.3)  # 不必等待
+
+    def test_expired_lease_is_claimed_after_ttl(self):
+        first, second = self._store(), self._store()
+        list(first.filter_tasks(self.tasks))
+        first.heartbeat_stopped.set()  # 模拟进程崩溃, 租约不再续期
+        start_time = time.time()
+        self.assertEqual(list(second.filter_tasks(self.tasks)), self.tasks)
+        self.assertGreaterEqual(time.time() - start_time,
+                                self.LEASE_SECONDS * 0.5)
+
+    def test_task_completed_while_waiting(self):
+        # 租约很长, 其他进程处理完之后也不必等到租约到期
+        first, second = self._store(60), self._store(60)
+        list(first.filter_tasks(self.tasks))
+        start_time = time.time()
+
+        def finish():
+            time.sleep(self.LEASE_SECONDS / 2)
+            for src, dest, _ in self.tasks:
+                first.complete(src, dest)
+        thread = threading.Thread(target=finish)
+        thread.start()
+        self.assertEqual(list(second.filter_tasks(self.tasks)), [])
+        self.assertLess(time.time() - start_time, 2)
+        thread.join()
+
+    def test_gives_up_when_lease_is_still_held(self):
+        first, second = self._store(), self._store()
+        list(first.filter_tasks(self.tasks))  # 心跳一直在续期
+        start_time = time.time()
+        self.assertEqual(list(second.filter_tasks(self.tasks)), [])
+        elapsed = time.time() - start_time
+        self.assertGreaterEqual(elapsed, self.LEASE_SECONDS * 0.5)
+        self.assertLess(elapsed, self.LEASE_SECONDS * 3)
+
+    def test_close_releases_leases(self):
+        first, second = self._store(), self._store()
+        list(first.filter_tasks(self.tasks))
+        first.close()
+        self.assertEqual(second.claim_batch(['a.png', 'b.png']),
+                         ['a.png', 'b.png'])
+
+    def test_close_stops_heartbeat(self):
+        first = self._store()
+        list(first.filter_tasks(self.tasks))
+        first.close()
+        self.assertFalse(first.heartbeat_thread.is_alive())
+        first.close()
+        # 异常退出后还在运行的工作线程
+        first.complete(self.tasks[0][0], self.tasks[0][1])
+        self.assertEqual(first.completed, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# coding=utf-8
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from tinifycli.key_holder import TinifyCliKeyHolder
+from tinifycli.locations import TinifyCliLocationStore
+
+
+class LocationStoreTest(unittest.TestCase):
+
+    INFO = {'output': {'size': 500, 'width': 10, 'height': 10}}
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        self.path = os.path.join(self.workdir, 'store', 'locations.db')
+        self.src = self._write('a.png', 'image')
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.workdir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.workdir, name)
+        with open(path, 'wb') as fp:
+            fp.write(content)
+        return path
+
+    def _store(self, ttl=3600):
+        store = TinifyCliLocationStore(self.path, ttl)
+        self.stores.append(store)
+        return store
+
+    def _record(self, store, src=None):
+        info = dict(self.INFO, key_id=TinifyCliKeyHolder.fingerprint('k1'))
+        store.record(src or self.src, 'http://example.com/output/1', info)
+
+    def test_reuse_by_content(self):
+        store = self._store()
+        self.assertIsNone(store.lookup(self.src))
+        self._record(store)
+        url, info = store.lookup(self.src)
+        self.assertEqual(url, 'http://example.com/output/1')
+        self.assertEqual(info['output'], self.INFO['output'])
+        self.assertEqual(info['key_id'], TinifyCliKeyHolder.fingerprint('k1'))
+        # 内容相同的其他文件也能使用同一个输出地址
+        copy = self._write('copy.png', 'image')
+        self.assertEqual(store.lookup(copy)[0], url)
+        with open(self.src, 'rb') as fp:
+            self.assertEqual(store.lookup(self.src, fp.read())[0], url)
+
+    def test_changed_content_misses(self):
+        store = self._store()
+        self._record(store)
+        self._write('a.png', 'another image')
+        self.assertIsNone(store.lookup(self.src))
+        self.assertIsNone(store.lookup(os.path.join(self.workdir, 'gone')))
+
+    def test_persists_across_runs(self):
+        store = self._store()
+        self._record(store)
+        store.close()
+        self.stores.remove(store)
+        self.assertEqual(self._store().lookup(self.src)[0],
+                         'http://example.com/output/1')
+
+    def test_expired_records_are_not_used(self):
+        store = self._store(ttl=0.2)
+        self._record(store)
+        self.assertIsNotNone(store.lookup(self.src))
+        time.sleep(0.3)
+        self.assertIsNone(store.lookup(self.src))
+        store.close()
+        self.stores.remove(store)
+        self._store()  # 打开时删除过期的记录
+        conn = sqlite3.connect(self.path)
+        try:
+            self.assertEqual(
+                conn.execute('SELECT COUNT(*) FROM locations').fetchone(),
+                (0, ))
+        finally:
+            conn.close()
+
+    def test_discard(self):
+        store = self._store()
+        self._record(store)
+        store.discard(self.src)
+        self.assertIsNone(store.lookup(self.src))
+        self.assertEqual(store.stale, 1)
+
+    def test_migrates_plaintext_keys(self):
+        store = self._store()
+        self._record(store)
+        store.close()
+        self.stores.remove(store)
+        # 旧版本在 key 列保存的是 Key 本身
+        conn = sqlite3.connect(self.path)
+        conn.execute("UPDATE locations SET key = 'k1-plaintext-key'")
+        conn.commit()
+        conn.close()
+
+        store = self._store()
+        _, info = store.lookup(self.src)
+        fingerprint = TinifyCliKeyHolder.fingerprint('k1-plaintext-key')
+        self.assertEqual(info['key_id'], fingerprint)
+        conn = sqlite3.connect(self.path)
+        try:
+            self.assertEqual(
+                conn.execute('SELECT key FROM locations').fetchall(),
+                [(fingerprint, )])
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
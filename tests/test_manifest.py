@@ -0,0 +1,89 @@
+# coding=utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from tinifycli.manifest import TinifyCliManifest
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        self.src = self._write('src.png', 'image')
+        self.dest = self._write('dest.png', 'small')
+        self.manifest = self._open()
+        self.manifest.record(self.src, self.dest, None)
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.workdir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.workdir, name)
+        with open(path, 'wb') as fp:
+            fp.write(content)
+        return path
+
+    def _open(self):
+        return TinifyCliManifest(os.path.join(self.workdir, 'manifest.db'))
+
+    def _reopen(self):
+        self.manifest.close()
+        self.manifest = self._open()
+
+    def test_unchanged(self):
+        self.assertTrue(self.manifest.is_unchanged(self.src, self.dest, None))
+        self._reopen()
+        self.assertTrue(self.manifest.is_unchanged(self.src, self.dest, None))
+
+    def test_unknown_source(self):
+        other = self._write('other.png', 'image')
+        self.assertFalse(self.manifest.is_unchanged(other, self.dest, None))
+
+    def test_changed_source(self):
+        self._write('src.png', 'another image')
+        self.assertFalse(self.manifest.is_unchanged(self.src, self.dest, None))
+
+    def test_touched_source_with_same_content(self):
+        stat = os.stat(self.src)
+        os.utime(self.src, (stat.st_atime, stat.st_mtime + 10))
+        self.assertTrue(self.manifest.is_unchanged(self.src, self.dest, None))
+
+    def test_resize_changed(self):
+        resize = {'method': 'scale', 'width': 100}
+        self.assertFalse(self.manifest.is_unchanged(self.src, self.dest,
+                                                    resize))
+
+    def test_deleted_dest(self):
+        os.remove(self.dest)
+        self.assertFalse(self.manifest.is_unchanged(self.src, self.dest, None))
+
+    def test_modified_dest(self):
+        self._write('dest.png', 'edited by hand')
+        self.assertFalse(self.manifest.is_unchanged(self.src, self.dest, None))
+
+    def test_deleted_variant(self):
+        dests = (self.dest, self._write('dest@2x.png', 'small'))
+        resize = ({'method': 'scale', 'width': 100},
+                  {'method': 'scale', 'width': 200})
+        self.manifest.record(self.src, dests, resize)
+        self.assertTrue(self.manifest.is_unchanged(self.src, dests, resize))
+        os.remove(dests[1])
+        self.assertFalse(self.manifest.is_unchanged(self.src, dests, resize))
+
+    def test_close_commits_and_ignores_late_records(self):
+        other = self._write('other.png', 'image')
+        self.manifest.close()
+        self.manifest.close()
+        # 异常退出后还在运行的工作线程
+        self.manifest.record(other, self.dest, None)
+        self.manifest = self._open()
+        self.assertTrue(self.manifest.is_unchanged(self.src, self.dest, None))
+        self.assertFalse(self.manifest.is_unchanged(other, self.dest, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# coding=utf-8
+
+import unittest
+
+from tinifycli.metrics import TinifyCliMetrics
+
+
+class MetricsTest(unittest.TestCase):
+
+    def _success(self, metrics, shrink_time, bytes_up=1000, bytes_down=500):
+        metrics.handle(('start', 'k1'))
+        metrics.handle(('success', 'k1', 1000, 500, shrink_time, 0.01, 7,
+                        bytes_up, bytes_down))
+
+    def test_counts_transferred_bytes(self):
+        metrics = TinifyCliMetrics()
+        self._success(metrics, 0.1)
+        self._success(metrics, 0.1, bytes_up=0)  # 续传, 没有上传
+        self._success(metrics, 0.1, bytes_down=0)  # 直接使用原图
+        self.assertEqual(metrics.bytes_up, 2000)
+        self.assertEqual(metrics.bytes_down, 1000)
+        self.assertEqual(metrics.key_usage, {'k1': 3})
+        self.assertEqual(metrics.key_compression_counts, {'k1': 7})
+
+    def test_inflight(self):
+        metrics = TinifyCliMetrics()
+        metrics.handle(('start', 'k1'))
+        metrics.handle(('start', 'k1'))
+        self.assertEqual(metrics.inflight, 2)
+        metrics.handle(('failure', 'k1', 'internalError'))
+        self.assertEqual(metrics.inflight, 1)
+        self.assertEqual(metrics.failures, {'internalError': 1})
+
+    def test_latency_percentiles(self):
+        metrics = TinifyCliMetrics()
+        for _ in range(90):
+            self._success(metrics, 0.1)
+        for _ in range(10):
+            self._success(metrics, 2.0)
+        latency = metrics.summary()['shrink_latency']
+        # 百分位数是所在桶的上界, 不超过实际值的 2 倍
+        self.assertTrue(0.1 <= latency['p50'] < 0.2)
+        self.assertTrue(2.0 <= latency['p95'] < 4.0)
+        self.assertEqual(latency['p99'], 2.0)  # 不超过最大值
+        self.assertEqual(metrics.shrink_latency.count, 100)
+        self.assertIn('p50/p95/p99 0.1', metrics.format_status())
+
+    def test_no_latencies(self):
+        metrics = TinifyCliMetrics()
+        self.assertIsNone(metrics.summary()['shrink_latency']['p50'])
+        self.assertIn('p50/p95/p99 -', metrics.format_status())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# coding=utf-8
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from tinifycli import api
+from tinifycli.api import TinifyCliClient
+from tinifycli.mock_server import MockTinifyServer
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class MockServerTestCase(unittest.TestCase):
+
+    server_options = {}
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        self.server = MockTinifyServer(('127.0.0.1', 0), keys=set(['k1']),
+                                       **self.server_options)
+        self.endpoint = self.server.start()
+        self.src = self._write('a.png', 'x' * 1000)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.workdir, name)
+        with open(path, 'wb') as fp:
+            fp.write(content)
+        return path
+
+    def _client(self, key='k1'):
+        return TinifyCliClient(key, api_endpoint=self.endpoint)
+
+
+class ClientTest(MockServerTestCase):
+
+    server_options = {'monthly_limit': 3, 'output_ttl': 0.3}
+
+    def test_compress(self):
+        dest = os.path.join(self.workdir, 'b.png')
+        client = self._client()
+        client.compress(self.src, dest)
+        self.assertEqual(os.path.getsize(dest), 500)
+        self.assertEqual(client.compression_count, 1)
+
+    def test_invalid_key(self):
+        self.assertRaises(api.AccountError, self._client('k2').shrink,
+                          self.src)
+
+    def test_monthly_limit(self):
+        client = self._client()
+        for _ in range(3):
+            client.shrink(self.src)
+        try:
+            client.shrink(self.src)
+        except api.AccountError as err:
+            self.assertIn('exceeded', err.message)
+        else:
+            self.fail('AccountError not raised')
+
+    def test_output_expires(self):
+        client = self._client()
+        download_url, _ = client.shrink(self.src)
+        dest = os.path.join(self.workdir, 'b.png')
+        client.fetch(download_url, dest)
+        time.sleep(0.4)
+        self.assertRaises(api.ClientError, client.fetch, download_url, dest)
+
+    def test_keep_alive_requests_are_not_delayed(self):
+        client = self._client()
+        download_url, _ = client.shrink(self.src)
+        client.open_output(download_url).close()
+        start_time = time.time()
+        for _ in range(10):
+            client.open_output(download_url).content
+        # Nagle 算法和延迟确认会使每个请求多等约 40 毫秒
+        self.assertLess(time.time() - start_time, 0.3)
+
+
+class CommandLineTest(MockServerTestCase):
+
+    def _run(self, *args):
+        key_path = self._write('keys', 'k1\n')
+        command = [sys.executable, '-c',
+                   'import tinifycli; tinifycli.main()',
+                   os.path.join(self.workdir, 'src'),
+                   '-o', os.path.join(self.workdir, 'out'),
+                   '-K', key_path, '--api-endpoint', self.endpoint]
+        process = subprocess.Popen(command + list(args), cwd=ROOT_DIR,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output)
+        return output
+
+    def test_compress_directory(self):
+        os.mkdir(os.path.join(self.workdir, 'src'))
+        os.mkdir(os.path.join(self.workdir, 'out'))
+        for i in range(5):
+            self._write(os.path.join('src', 'img%d.png' % i), 'x' * 1000)
+        self._run('-t', '2')
+        out_dir = os.path.join(self.workdir, 'out')
+        self.assertEqual(sorted(os.listdir(out_dir)),
+                         ['tinify-img%d.png' % i for i in range(5)])
+        for name in os.listdir(out_dir):
+            self.assertEqual(os.path.getsize(os.path.join(out_dir, name)),
+                             500)
+        self.assertEqual(self.server.compression_count('k1'), 5)
+
+    def test_async_engine(self):
+        try:
+            import gevent
+        except ImportError:
+            self.skipTest('没有安装 gevent')
+        os.mkdir(os.path.join(self.workdir, 'src'))
+        os.mkdir(os.path.join(self.workdir, 'out'))
+        for i in range(5):
+            self._write(os.path.join('src', 'img%d.png' % i), 'x' * 1000)
+        self._run('--engine', 'async', '--max-inflight', '5', '--pipeline')
+        self.assertEqual(len(os.listdir(os.path.join(self.workdir, 'out'))),
+                         5)
+        self.assertEqual(self.server.compression_count('k1'), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# coding=utf-8
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from tinifycli import output
+
+
+def _mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+class WriteAtomicallyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_writes_all_chunks(self):
+        dest = os.path.join(self.workdir, 'a.png')
+        self.assertEqual(output.write_atomically(['ab', 'cd'], dest), 4)
+        with open(dest, 'rb') as fp:
+            self.assertEqual(fp.read(), 'abcd')
+        self.assertEqual(os.listdir(self.workdir), ['a.png'])
+
+    def test_new_file_gets_umask_mode(self):
+        old_umask = os.umask(027)
+        try:
+            dest = os.path.join(self.workdir, 'a.png')
+            output.write_atomically(['x'], dest)
+            self.assertEqual(_mode(dest), 0640)
+            # 不会为了读取 umask 而修改它
+            self.assertEqual(os.umask(027), 027)
+        finally:
+            os.umask(old_umask)
+
+    def test_explicit_mode(self):
+        dest = os.path.join(self.workdir, 'a.status')
+        with open(dest, 'wb') as fp:
+            fp.write('old')
+        os.chmod(dest, 0644)
+        output.write_atomically(['secret'], dest, mode=0600)
+        self.assertEqual(_mode(dest), 0600)
+        output.write_atomically(['secret'], dest + '.new', mode=0600)
+        self.assertEqual(_mode(dest + '.new'), 0600)
+
+    def test_existing_file_keeps_mode(self):
+        dest = os.path.join(self.workdir, 'a.png')
+        with open(dest, 'wb') as fp:
+            fp.write('old')
+        os.chmod(dest, 0640)
+        output.write_atomically(['new'], dest)
+        self.assertEqual(_mode(dest), 0640)
+
+    def test_error_leaves_dest_untouched(self):
+        dest = os.path.join(self.workdir, 'a.png')
+        with open(dest, 'wb') as fp:
+            fp.write('old')
+
+        def chunks():
+            yield 'new'
+            raise IOError('broken')
+
+        self.assertRaises(IOError, output.write_atomically, chunks(), dest)
+        with open(dest, 'rb') as fp:
+            self.assertEqual(fp.read(), 'old')
+        self.assertEqual(os.listdir(self.workdir), ['a.png'])
+
+    def test_temp_is_hidden_until_committed(self):
+        dest = os.path.join(self.workdir, 'a.png')
+        temp_path, size = output.write_temp(['ab', 'c'], dest)
+        self.assertEqual(size, 3)
+        self.assertFalse(os.path.exists(dest))
+        self.assertEqual(os.path.dirname(temp_path), self.workdir)
+        output.commit_temp(temp_path, dest)
+        with open(dest, 'rb') as fp:
+            self.assertEqual(fp.read(), 'abc')
+        self.assertEqual(os.listdir(self.workdir), ['a.png'])
+
+    def test_discard_temp(self):
+        dest = os.path.join(self.workdir, 'a.png')
+        temp_path, _ = output.write_temp(['x'], dest)
+        output.discard_temp(temp_path)
+        self.assertEqual(os.listdir(self.workdir), [])
+
+
+class PlaceFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        self.src = os.path.join(self.workdir, 'src.png')
+        with open(self.src, 'wb') as fp:
+            fp.write('image')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_places_content(self):
+        dest = os.path.join(self.workdir, 'dest.png')
+        method = output.place_file(self.src, dest)
+        self.assertIn(method, ('reflink', 'link', 'copy'))
+        with open(dest, 'rb') as fp:
+            self.assertEqual(fp.read(), 'image')
+
+    def test_copy_gets_dest_mode(self):
+        dest = os.path.join(self.workdir, 'dest.png')
+        with open(dest, 'wb') as fp:
+            fp.write('old')
+        os.chmod(dest, 0640)
+        os.chmod(self.src, 0600)
+        original_link = getattr(os, 'link', None)
+
+        def no_link(src, dest):
+            raise OSError('EXDEV')
+
+        # 模拟跨文件系统, 不能 reflink 也不能硬链接
+        original_reflink = output._reflink
+        output._reflink = lambda src, fd: False
+        os.link = no_link
+        try:
+            self.assertEqual(output.place_file(self.src, dest), 'copy')
+        finally:
+            output._reflink = original_reflink
+            os.link = original_link
+        self.assertEqual(_mode(dest), 0640)
+
+    def test_same_file(self):
+        self.assertEqual(output.place_file(self.src, self.src), 'same')
+
+
+if __name__ == '__main__':
+    unittest.main()
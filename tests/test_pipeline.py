@@ -0,0 +1,54 @@
+# coding=utf-8
+
+import threading
+import unittest
+
+from tinifycli.pipeline import TinifyCliPipeline
+
+
+class Job(object):
+
+    def __init__(self, task):
+        self.task = task
+        self.dropped = False
+
+    def drop_data(self):
+        self.dropped = True
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_drain_releases_queued_jobs(self):
+        jobs = []
+        uploading = threading.Event()
+        resume = threading.Event()
+
+        def read(task):
+            jobs.append(Job(task))
+            return jobs[-1]
+
+        def upload(job):
+            uploading.set()
+            resume.wait(5)
+            return ('success', )
+        pipeline = TinifyCliPipeline([('read', read, 1),
+                                      ('upload', upload, 1)], 8, 2)
+        tasks = [(name, name + '.out', None) for name in 'abcd']
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(pipeline.run(tasks)))
+        thread.start()
+        uploading.wait(5)
+        pipeline.drain(5)
+        resume.set()
+        thread.join(10)
+        self.assertEqual(result, [1])
+        self.assertEqual(pipeline.dropped, 3)
+        # 在上传队列中被放弃的任务也归还了预读的内存
+        self.assertEqual([job.dropped for job in jobs[1:]],
+                         [True] * (len(jobs) - 1))
+        self.assertFalse(jobs[0].dropped)
+
+
+if __name__ == '__main__':
+    unittest.main()
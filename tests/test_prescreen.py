@@ -0,0 +1,125 @@
+# coding=utf-8
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from tinifycli import prescreen
+from tinifycli.prescreen import TinifyCliPrescreener, screen_image
+
+
+def _png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + \
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+def make_png(width, height, pixel_size, software=None):
+    ''' 真彩色 PNG , 图像数据每像素 pixel_size 字节 '''
+    chunks = [_png_chunk('IHDR', struct.pack('>IIBBBBB', width, height,
+                                             8, 2, 0, 0, 0))]
+    if software is not None:
+        chunks.append(_png_chunk('tEXt', 'Software\0' + software))
+    chunks.append(_png_chunk('IDAT', '\0' * int(width * height * pixel_size)))
+    chunks.append(_png_chunk('IEND', ''))
+    return prescreen.PNG_SIGNATURE + ''.join(chunks)
+
+def make_jpeg(width, height, pixel_size, comment=None):
+    segments = ['\xff\xd8']
+    if comment is not None:
+        segments.append('\xff\xfe' + struct.pack('>H', len(comment) + 2) +
+                        comment)
+    sof = struct.pack('>BHHB', 8, height, width, 1) + '\x01\x11\x00'
+    segments.append('\xff\xc0' + struct.pack('>H', len(sof) + 2) + sof)
+    segments.append('\xff\xda' + '\0' * int(width * height * pixel_size))
+    segments.append('\xff\xd9')
+    return ''.join(segments)
+
+
+class PrescreenTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.workdir, name)
+        with open(path, 'wb') as fp:
+            fp.write(content)
+        return path
+
+
+class ScreenImageTest(PrescreenTestCase):
+
+    def _savings(self, name, content):
+        return screen_image(self._write(name, content))[1]
+
+    def test_png(self):
+        self.assertGreater(self._savings('a.png', make_png(40, 40, 3)), 0.5)
+        self.assertLess(self._savings('b.png', make_png(40, 40, 0.5)), 0.1)
+
+    def test_png_optimizer_marker(self):
+        savings = self._savings('a.png',
+                                make_png(40, 40, 3, software='TinyPNG'))
+        self.assertLess(savings, 0.1)
+
+    def test_jpeg_optimizer_marker(self):
+        self.assertGreater(self._savings('a.jpg', make_jpeg(40, 40, 1)), 0.5)
+        savings = self._savings('b.jpg', make_jpeg(
+            40, 40, 1, comment='Optimized by JPEGmini'))
+        self.assertLess(savings, 0.1)
+
+    def test_unreadable(self):
+        path = os.path.join(self.workdir, 'missing.png')
+        self.assertEqual(screen_image(path), (path, 1.0, None))
+        self.assertEqual(self._savings('a.png', 'not an image'), 1.0)
+
+
+class PrescreenerTest(PrescreenTestCase):
+
+    def _tasks(self, names, log):
+        for name in names:
+            log.append(name)
+            yield os.path.join(self.workdir, name), name + '.out', None
+
+    def _prepare(self):
+        self._write('big.png', make_png(40, 40, 3))
+        self._write('tiny.png', make_png(1, 1, 3))
+        self._write('done.png', make_png(40, 40, 3, software='pngquant'))
+
+    def _check_filter(self, in_process):
+        self._prepare()
+        prescreener = TinifyCliPrescreener(0.1, 512, process_num=2, window=2,
+                                           in_process=in_process)
+        names = ['big.png', 'tiny.png', 'done.png', 'big.png']
+        log = []
+        tasks = prescreener.filter_tasks(self._tasks(names, log))
+        first = next(tasks)
+        self.assertEqual(first[1], 'big.png.out')
+        self.assertLess(len(log), len(names))  # 不需要先读完所有任务
+        self.assertEqual([task[1] for task in tasks], ['big.png.out'])
+        self.assertEqual((prescreener.screened, prescreener.skipped), (4, 2))
+        self.assertIsNone(prescreener.pool)
+
+    def test_resized_tasks_are_not_screened(self):
+        self._prepare()
+        prescreener = TinifyCliPrescreener(0.1, 512, in_process=True)
+        resize = ('scale', 10, None)
+        tasks = [(os.path.join(self.workdir, name), name + '.out', resize)
+                 for name in ('tiny.png', 'done.png')]
+        tasks.append((os.path.join(self.workdir, 'tiny.png'), 'x.out', None))
+        self.assertEqual(list(prescreener.filter_tasks(tasks)), tasks[:2])
+        self.assertEqual((prescreener.screened, prescreener.skipped), (1, 1))
+
+    def test_filter_in_pool(self):
+        self._check_filter(False)
+
+    def test_filter_in_process(self):
+        self._check_filter(True)
+
+
+if __name__ == '__main__':
+    unittest.main()
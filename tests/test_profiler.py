@@ -0,0 +1,117 @@
+# coding=utf-8
+
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from tinifycli.profiler import (TinifyCliHistogram, TinifyCliProfiledLock,
+                                TinifyCliProfiler)
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_bucket_bounds(self):
+        histogram = TinifyCliHistogram()
+        for seconds in (0, 0.000001, 0.000003, 0.000004, 0.000005, 1.0):
+            histogram.add(seconds)
+        self.assertEqual(histogram.buckets, {1: 2, 4: 2, 8: 1, 1 << 20: 1})
+        self.assertEqual(histogram.count, 6)
+        self.assertEqual(histogram.max, 1.0)
+
+    def test_percentiles_within_a_bucket(self):
+        rng = random.Random(1)
+        samples = [rng.expovariate(10) for _ in range(10000)]
+        histogram = TinifyCliHistogram()
+        for seconds in samples:
+            histogram.add(seconds)
+        samples.sort()
+        for ratio in (0.5, 0.95, 0.99):
+            exact = samples[int(ratio * len(samples)) - 1]
+            estimate = histogram.percentile(ratio)
+            # 结果是所在桶的上界: 不低于真实值, 也不超过它的 2 倍
+            self.assertGreaterEqual(estimate, exact)
+            self.assertLess(estimate, exact * 2)
+        self.assertEqual(histogram.percentile(1.0), histogram.max)
+
+    def test_percentile_capped_by_max(self):
+        histogram = TinifyCliHistogram()
+        for _ in range(3):
+            histogram.add(0.3)
+        self.assertEqual(histogram.percentile(0.5), 0.3)
+
+    def test_empty(self):
+        histogram = TinifyCliHistogram()
+        self.assertIsNone(histogram.percentile(0.5))
+        summary = histogram.to_dict()
+        self.assertIsNone(summary['mean'])
+        self.assertEqual(summary['count'], 0)
+
+    def test_to_dict_is_json(self):
+        histogram = TinifyCliHistogram()
+        histogram.add(0.001)
+        histogram.add(0.003)
+        summary = json.loads(json.dumps(histogram.to_dict()))
+        self.assertEqual(summary['buckets_us'], {'1024': 1, '4096': 1})
+        self.assertAlmostEqual(summary['mean'], 0.002)
+        self.assertEqual(summary['p50'], 0.001024)
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        self.profiler = TinifyCliProfiler()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_write_trace(self):
+        now = time.time()
+        self.profiler.record('upload', now, now + 0.5, {'src': 'a.png'})
+        self.profiler.record('server', now + 0.5, now + 0.75)
+        path = os.path.join(self.workdir, 'trace.json')
+        self.profiler.write_trace(path)
+        with open(path) as fp:
+            trace = json.load(fp)
+        events = [event for event in trace['traceEvents']
+                  if event['ph'] == 'X']
+        self.assertEqual([event['name'] for event in events],
+                         ['upload', 'server'])
+        self.assertEqual(events[0]['dur'], 500000)
+        self.assertEqual(events[0]['args'], {'src': 'a.png'})
+        self.assertEqual(trace['otherData']['phases']['upload']['count'], 1)
+
+    def test_events_are_bounded(self):
+        self.profiler.MAX_EVENTS = 10
+        for _ in range(15):
+            self.profiler.record('read', 0, 0.001)
+        self.assertEqual(len(self.profiler.events), 10)
+        self.assertEqual(self.profiler.dropped_events, 5)
+        self.assertEqual(self.profiler.histograms['read'].count, 15)
+
+    def test_profiled_lock_records_contention_only(self):
+        lock = TinifyCliProfiledLock(threading.Lock(), 'keys_lock',
+                                     self.profiler)
+        with lock:
+            pass
+        self.assertNotIn('keys_lock', self.profiler.histograms)
+        lock.acquire()
+        thread = threading.Thread(target=lambda: lock.acquire() and
+                                  lock.release())
+        thread.start()
+        time.sleep(0.1)
+        lock.release()
+        thread.join()
+        self.assertEqual(self.profiler.lock_acquisitions['keys_lock'], 3)
+        histogram = self.profiler.histograms['keys_lock']
+        self.assertEqual(histogram.count, 1)
+        self.assertGreaterEqual(histogram.max, 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# coding=utf-8
+
+import time
+import unittest
+
+from tinifycli.ratelimit import TinifyCliRateLimiter, TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_unlimited(self):
+        bucket = TokenBucket(0)
+        start_time = time.time()
+        for _ in range(1000):
+            bucket.consume(10 ** 6)
+        self.assertLess(time.time() - start_time, 0.5)
+
+    def test_rate(self):
+        bucket = TokenBucket(20, 1)
+        start_time = time.time()
+        for _ in range(11):
+            bucket.consume()
+        # 第一个令牌已经在桶里, 其余 10 个每个等 1/20 秒
+        self.assertAlmostEqual(time.time() - start_time, 0.5, delta=0.15)
+
+    def test_large_amount_is_borrowed(self):
+        bucket = TokenBucket(1000)
+        start_time = time.time()
+        bucket.consume(1300)  # 超过容量也能通过, 欠下的 300 个要等
+        self.assertAlmostEqual(time.time() - start_time, 0.3, delta=0.1)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_per_key_limit(self):
+        limiter = TinifyCliRateLimiter(key_max_rps=10)
+        start_time = time.time()
+        for _ in range(13):  # 可以突发 1 秒的量, 之后每个请求等 0.1 秒
+            limiter.acquire('k1')
+            limiter.acquire('k2')  # 每个 Key 各自计算
+        self.assertAlmostEqual(time.time() - start_time, 0.3, delta=0.1)
+
+    def test_upload_limit(self):
+        limiter = TinifyCliRateLimiter(max_upload=10000)
+        start_time = time.time()
+        limiter.acquire('k1', 10000)
+        limiter.acquire('k1', 3000)
+        self.assertAlmostEqual(time.time() - start_time, 0.3, delta=0.1)
+
+    def test_throttled_halves_rate(self):
+        limiter = TinifyCliRateLimiter(max_rps=8)
+        limiter.request_times.extend([time.time() - 2, time.time()])
+        limiter.on_throttled()
+        self.assertAlmostEqual(limiter.ceiling_rps, 1.0, places=3)
+        self.assertEqual(limiter.adaptive_rps, limiter.MIN_RATE)
+
+        limiter = TinifyCliRateLimiter(max_rps=8)
+        limiter.request_times.extend(time.time() for _ in range(20))
+        limiter.on_throttled()
+        self.assertEqual(limiter.ceiling_rps, 8)  # 不超过 --max-rps
+        self.assertEqual(limiter.adaptive_rps, 4)
+        limiter.on_throttled()  # 同时失败的请求只减半一次
+        self.assertEqual(limiter.adaptive_rps, 4)
+        limiter.last_decrease = 0
+        limiter.on_throttled()
+        self.assertEqual(limiter.adaptive_rps, 2)
+
+    def test_success_recovers_linearly(self):
+        limiter = TinifyCliRateLimiter(max_rps=4)
+        limiter.request_times.extend(time.time() for _ in range(20))
+        limiter.on_throttled()
+        self.assertEqual(limiter.adaptive_rps, 2)
+        self.assertEqual(limiter.adaptive_bucket.rate, 2)
+        steps = int(round(2 / limiter.INCREASE_STEP))
+        for _ in range(steps - 1):
+            limiter.on_success()
+        self.assertIsNotNone(limiter.adaptive_rps)
+        self.assertGreater(limiter.adaptive_bucket.rate, 3.8)
+        limiter.on_success()
+        self.assertIsNone(limiter.adaptive_rps)
+        self.assertEqual(limiter.adaptive_bucket.rate, 0)  # 不再限制
+
+    def test_adaptive_rate_limits_requests(self):
+        limiter = TinifyCliRateLimiter()
+        limiter.request_times.extend(time.time() for _ in range(20))
+        limiter.on_throttled()
+        limiter.adaptive_bucket.set_rate(10)
+        limiter.adaptive_bucket.tokens = 0
+        start_time = time.time()
+        for _ in range(3):
+            limiter.acquire('k1')
+        self.assertAlmostEqual(time.time() - start_time, 0.3, delta=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+# coding=utf-8
+
+import random
+import threading
+import time
+import unittest
+
+from tinifycli.dispatcher import TinifyCliDispatcher
+from tinifycli.retry import TinifyCliCircuitBreaker, TinifyCliRetryPolicy
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = TinifyCliRetryPolicy()
+        random.seed(1)
+
+    def test_retry_limits(self):
+        max_retries = self.policy.LIMITS['netError'][0]
+        self.assertTrue(self.policy.should_retry('netError', max_retries))
+        self.assertFalse(self.policy.should_retry('netError',
+                                                  max_retries + 1))
+        self.assertFalse(self.policy.should_retry('localError', 1))
+
+    def test_backoff_grows_with_jitter(self):
+        base = self.policy.LIMITS['serverError'][1]
+        for attempt in range(1, 6):
+            delays = [self.policy.delay('serverError', attempt)
+                      for _ in range(200)]
+            self.assertTrue(all(0 <= delay < base * 2 ** attempt
+                                for delay in delays))
+            # 抖动: 等待时间分散在整个区间内
+            self.assertLess(min(delays), base * 2 ** attempt * 0.2)
+            self.assertGreater(max(delays), base * 2 ** attempt * 0.8)
+
+    def test_backoff_is_capped(self):
+        delays = [self.policy.delay('serverError', 30) for _ in range(200)]
+        self.assertTrue(all(delay <= self.policy.MAX_DELAY
+                            for delay in delays))
+
+    def test_account_error_retries_immediately(self):
+        self.assertEqual(self.policy.delay('accountError', 5), 0)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = TinifyCliCircuitBreaker()
+        self.breaker.COOLDOWN = 0.2
+        self.breaker.cooldown = 0.2
+
+    def _fail(self, times):
+        for _ in range(times):
+            self.breaker.record_failure()
+
+    def test_opens_after_threshold(self):
+        self._fail(self.breaker.THRESHOLD - 1)
+        self.assertFalse(self.breaker.half_open)
+        self._fail(1)
+        self.assertTrue(self.breaker.half_open)
+        start_time = time.time()
+        self.breaker.wait()
+        self.assertGreaterEqual(time.time() - start_time, 0.15)
+
+    def test_failure_after_cooldown_doubles_it(self):
+        self._fail(self.breaker.THRESHOLD)
+        self._fail(1)  # 暂停前发出的请求, 不计入
+        self.assertEqual(self.breaker.cooldown, 0.2)
+        self.breaker.wait()
+        self._fail(1)
+        self.assertEqual(self.breaker.cooldown, 0.4)
+        self.breaker.wait()
+        self.breaker.record_success()
+        self.assertFalse(self.breaker.half_open)
+        self.assertEqual(self.breaker.cooldown, self.breaker.COOLDOWN)
+
+
+class DispatcherRetryTest(unittest.TestCase):
+    ''' 失败的任务各自退避, 期间其他任务继续执行 '''
+
+    class FastPolicy(TinifyCliRetryPolicy):
+        LIMITS = {'netError': (2, 0.0), 'slowError': (1, 0.5)}
+
+    def _dispatcher(self, worker_num=1):
+        dispatcher = TinifyCliDispatcher(worker_num, 10)
+        dispatcher.retry_policy = self.FastPolicy()
+        return dispatcher
+
+    def test_retries_until_success(self):
+        attempts = {}
+
+        def func(task):
+            attempts[task[0]] = attempts.get(task[0], 0) + 1
+            if task[0] == 'a' and attempts['a'] < 3:
+                return ('netError', task, 'timeout')
+            return ('success', )
+        dispatcher = self._dispatcher()
+        self.assertEqual(dispatcher.run([('a', 'a.out', None),
+                                         ('b', 'b.out', None)], func), 2)
+        self.assertEqual(attempts, {'a': 3, 'b': 1})
+
+    def test_gives_up_after_limit(self):
+        attempts = []
+
+        def func(task):
+            attempts.append(task[0])
+            return ('netError', task, 'timeout')
+        dispatcher = self._dispatcher()
+        self.assertEqual(dispatcher.run([('a', 'a.out', None)], func), 0)
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(dispatcher.failed, 1)
+
+    def test_backoff_does_not_block_other_tasks(self):
+        finished = []
+
+        def func(task):
+            if task[0] == 'a' and 'a-failed' not in finished:
+                finished.append('a-failed')
+                return ('slowError', task, 'busy')
+            finished.append(task[0])
+            return ('success', )
+        random.seed(3)
+        dispatcher = self._dispatcher()
+        tasks = [(name, name + '.out', None) for name in 'abc']
+        self.assertEqual(dispatcher.run(tasks, func), 3)
+        # 唯一的工作线程在 a 退避期间先处理了 b 和 c
+        self.assertEqual(finished, ['a-failed', 'b', 'c', 'a'])
+
+    def test_retry_loop_exits_after_run(self):
+        for _ in range(3):
+            dispatcher = self._dispatcher()
+            dispatcher.run([('a', 'a.out', None)], lambda task: ('success', ))
+            self.assertFalse(dispatcher.retry_worker.is_alive())
+        self.assertEqual([thread for thread in threading.enumerate()
+                          if thread.name == 'retry'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
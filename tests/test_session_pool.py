@@ -0,0 +1,76 @@
+# coding=utf-8
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from tinifycli.compressor import TinifyCliCompressor
+from tinifycli.mock_server import MockTinifyServer
+from tinifycli.session_pool import TinifyCliSessionPool, connections_per_key
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class SessionPoolTest(unittest.TestCase):
+
+    def test_connections_per_key(self):
+        self.assertEqual(connections_per_key(8), 16)
+        self.assertEqual(connections_per_key(8, 0), 16)
+        self.assertEqual(connections_per_key(8, 3), 32)
+        self.assertEqual(connections_per_key(0, 3), 4)
+
+    def test_adapter_size(self):
+        pool = TinifyCliSessionPool(connections_per_key(4, 3))
+        session = pool.get_session('k1')
+        self.assertIs(pool.get_session('k1'), session)
+        self.assertEqual(session.get_adapter('https://api.tinify.com')
+                         ._pool_maxsize, 16)
+        pool.close()
+
+    def test_variants_do_not_overflow_the_pool(self):
+        workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        server = MockTinifyServer(('127.0.0.1', 0), keys=set(['k1']))
+        endpoint = server.start()
+        handler = ListHandler()
+        urllib3_logger = logging.getLogger('urllib3.connectionpool')
+        old_level = urllib3_logger.level
+        urllib3_logger.setLevel(logging.WARNING)
+        urllib3_logger.addHandler(handler)
+        try:
+            resizes = tuple(('scale', width, None) for width in (10, 20, 30))
+            tasks = []
+            for i in range(8):
+                src = os.path.join(workdir, 'img%d.png' % i)
+                with open(src, 'wb') as fp:
+                    fp.write('x' * 1000)
+                tasks.append((src, tuple(src + '.%d' % width
+                                         for _, width, _ in resizes),
+                              resizes))
+            with TinifyCliCompressor(['k1'], concurrency=4,
+                                     api_endpoint=endpoint,
+                                     max_variants=3) as compressor:
+                results = list(compressor.compress(tasks))
+            self.assertTrue(all(result.ok for result in results))
+            self.assertEqual(
+                [message for message in handler.messages
+                 if 'pool is full' in message], [])
+        finally:
+            urllib3_logger.removeHandler(handler)
+            urllib3_logger.setLevel(old_level)
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
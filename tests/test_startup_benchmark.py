@@ -0,0 +1,62 @@
+# coding=utf-8
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from tinifycli import startup_benchmark
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class LazyImportTest(unittest.TestCase):
+    ''' --version 和 -p 不导入 requests 等只有压缩才用到的模块 '''
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        self.old_cwd = os.getcwd()
+        os.chdir(ROOT_DIR)
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.workdir)
+
+    def test_import_does_not_load_heavy_modules(self):
+        script = ('import sys, tinifycli; '
+                  'print(",".join(name for name in sys.argv[1:] '
+                  'if name in sys.modules))')
+        modules = ['requests', 'prettytable', 'multiprocessing.dummy',
+                   'tinifycli.worker', 'tinifycli.dispatcher',
+                   'tinifycli.manifest']
+        output = subprocess.check_output([sys.executable, '-c', script] +
+                                         modules)
+        self.assertEqual(output.strip(), '')
+
+    def test_version(self):
+        status, _, loaded = startup_benchmark.run_once(['--version'])
+        self.assertEqual(status, 0)
+        self.assertEqual(loaded, [])
+
+    def test_preview(self):
+        src_dir = os.path.join(self.workdir, 'src')
+        os.mkdir(src_dir)
+        open(os.path.join(src_dir, 'a.png'), 'wb').close()
+        # 预览不需要 Key
+        status, _, loaded = startup_benchmark.run_once(
+            [src_dir, '-p', '-K', os.path.join(self.workdir, 'no-keys')])
+        self.assertEqual(status, 0)
+        self.assertEqual(loaded, [])
+
+    def test_budget(self):
+        result = startup_benchmark.measure('--version', ['--version'], 1,
+                                           10000)
+        self.assertTrue(result['ok'], result)
+        result = startup_benchmark.measure('--version', ['--version'], 1, 0)
+        self.assertFalse(result['ok'])
+
+
+if __name__ == '__main__':
+    unittest.main()
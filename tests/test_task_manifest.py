@@ -0,0 +1,111 @@
+# coding=utf-8
+
+import json
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import tinifycli
+from tinifycli import shared_var
+from tinifycli.results import TinifyCliResultWriter
+
+
+class TaskManifestTest(unittest.TestCase):
+    ''' --from-manifest 的任务清单 '''
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        self.old_vars = (shared_var.src_dir, shared_var.dest_dir,
+                         shared_var.filename_pattern,
+                         shared_var.filename_replace, shared_var.result_writer)
+        shared_var.src_dir = os.path.join(self.workdir, 'src')
+        shared_var.dest_dir = os.path.join(self.workdir, 'out')
+        shared_var.filename_pattern = r'^(.*\.png)$'
+        shared_var.filename_replace = r'tinify-\1'
+        self.results = StringIO.StringIO()
+        shared_var.result_writer = TinifyCliResultWriter(self.results)
+        os.mkdir(shared_var.src_dir)
+        with open(os.path.join(shared_var.src_dir, 'a.png'), 'wb') as fp:
+            fp.write('image')
+
+    def tearDown(self):
+        (shared_var.src_dir, shared_var.dest_dir, shared_var.filename_pattern,
+         shared_var.filename_replace, shared_var.result_writer) = self.old_vars
+        shutil.rmtree(self.workdir)
+
+    def _read(self, lines, default_resize=None):
+        text = '\n'.join(json.dumps(line) if isinstance(line, dict) else line
+                         for line in lines) + '\n'
+        return list(tinifycli.read_manifest(StringIO.StringIO(text),
+                                            default_resize))
+
+    def _errors(self):
+        return [json.loads(line)
+                for line in self.results.getvalue().splitlines()]
+
+    def test_default_dest_and_resize(self):
+        tasks = self._read([{'src': 'a.png'}], ('scale', 100, None))
+        self.assertEqual(tasks, [(
+            os.path.join(shared_var.src_dir, 'a.png'),
+            os.path.join(shared_var.dest_dir, 'tinify-a.png'),
+            ('scale', 100, None))])
+
+    def test_resize_and_variants(self):
+        tasks = self._read([
+            {'src': 'a.png', 'dest': 'b.png',
+             'resize': {'method': 'fit', 'width': 10, 'height': 20}},
+            {'src': 'a.png', 'dest': ['s.png', 'l.png'],
+             'resize': [{'width': 10}, {'height': 20}]},
+        ])
+        self.assertEqual(tasks[0][2], ('fit', 10, 20))
+        self.assertEqual(tasks[1][1], (
+            os.path.join(shared_var.dest_dir, 's.png'),
+            os.path.join(shared_var.dest_dir, 'l.png')))
+        self.assertEqual(tasks[1][2], (('scale', 10, None),
+                                       ('scale', None, 20)))
+
+    def test_rejects_invalid_sizes(self):
+        sizes = [0, -5, 1.5, '100', True, [100]]
+        tasks = self._read([{'src': 'a.png', 'resize': {'width': size}}
+                            for size in sizes])
+        self.assertEqual(tasks, [])
+        errors = self._errors()
+        self.assertEqual([error['line'] for error in errors],
+                         range(1, len(sizes) + 1))
+        for error in errors:
+            self.assertIn(u'正整数', error['error'])
+
+    def test_rejects_invalid_resize_types(self):
+        values = ['scale', 5, True, 1.5]
+        tasks = self._read([{'src': 'a.png', 'resize': value}
+                            for value in values] +
+                           [{'src': 'a.png', 'resize': None}],
+                           ('scale', 100, None))
+        # 只有 null 是合法的, 表示这个文件不调整尺寸
+        self.assertEqual([task[2] for task in tasks], [None])
+        errors = self._errors()
+        self.assertEqual([error['line'] for error in errors], [1, 2, 3, 4])
+        for error in errors:
+            self.assertIn('resize', error['error'])
+
+    def test_error_records_carry_src(self):
+        tasks = self._read([
+            'not json',
+            {'src': 'missing.png'},
+            {'src': 'a.png', 'resize': {'method': 'zoom', 'width': 10}},
+            {'src': 'a.png'},
+        ])
+        self.assertEqual(len(tasks), 1)
+        errors = self._errors()
+        self.assertEqual([error['line'] for error in errors], [1, 2, 3])
+        self.assertEqual([error['src'] for error in errors], [
+            None,
+            os.path.join(shared_var.src_dir, 'missing.png'),
+            os.path.join(shared_var.src_dir, 'a.png')])
+        self.assertTrue(all(error['status'] == 'failed' for error in errors))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# coding=utf-8
+
+import unittest
+
+import tinifycli
+from tinifycli import shared_var
+
+
+class VariantsTest(unittest.TestCase):
+    ''' --variants 的尺寸描述和输出文件名 '''
+
+    def setUp(self):
+        self.old_vars = (shared_var.filename_pattern,
+                         shared_var.filename_replace)
+        shared_var.filename_pattern = r'^(.*)\.png$'
+        shared_var.filename_replace = r'\1.png'
+
+    def tearDown(self):
+        shared_var.filename_pattern, shared_var.filename_replace = \
+            self.old_vars
+
+    def test_parse(self):
+        self.assertEqual(
+            tinifycli.parse_variants(
+                'scale:320, scale:x240,fit:1200x800,cover:200x200'),
+            [('scale', 320, None), ('scale', None, 240),
+             ('fit', 1200, 800), ('cover', 200, 200)])
+
+    def test_parse_rejects_invalid_specs(self):
+        for text in ('scale', 'scale:abc', 'crop:100x100', 'fit:100',
+                     'scale:100x100', 'scale:320,cover:x200'):
+            self.assertRaises(ValueError, tinifycli.parse_variants, text)
+
+    def test_variant_name(self):
+        self.assertEqual(tinifycli.variant_name(('scale', 320, None)),
+                         'scale-320')
+        self.assertEqual(tinifycli.variant_name(('scale', None, 240)),
+                         'scale-x240')
+        self.assertEqual(tinifycli.variant_name(('fit', 1200, 800)),
+                         'fit-1200x800')
+
+    def test_default_filename(self):
+        self.assertEqual(
+            tinifycli.variant_filename_convert('sub/a.png',
+                                               ('scale', 320, None)),
+            'sub/a-scale-320.png')
+
+    def test_filename_template(self):
+        shared_var.filename_replace = r'\1@{width}w.png'
+        self.assertEqual(
+            tinifycli.variant_filename_convert('a.png', ('scale', 320, None)),
+            'a@320w.png')
+        shared_var.filename_replace = r'{method}-\1-{variant}.png'
+        self.assertEqual(
+            tinifycli.variant_filename_convert('sub/a.png',
+                                               ('fit', 100, 50)),
+            'sub/fit-a-fit-100x50.png')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# coding=utf-8
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from tinifycli.watcher import TinifyCliWatcher
+
+
+class WatcherTestCase(unittest.TestCase):
+    ''' 在后台线程中运行 files() , 记下产生每个文件的时间 '''
+
+    use_inotify = False
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='tinify-cli-test-')
+        self._write('old.png', 'image')
+        self.watcher = TinifyCliWatcher(self.workdir,
+                                        use_inotify=self.use_inotify)
+        self.watcher.SETTLE_TIME = 0.2
+        self.watcher.POLL_INTERVAL = 0.05
+        self.watcher.MAX_POLL_INTERVAL = 0.4
+        self.watcher.poll_interval = 0.05
+        self.watcher.MAX_WAIT = 0.05
+        self.produced = []
+        self.thread = threading.Thread(target=self._consume)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.watcher.stop()
+        self.thread.join(2)
+        self.watcher.close()
+        shutil.rmtree(self.workdir)
+
+    def _consume(self):
+        for rel_path in self.watcher.files():
+            self.produced.append((rel_path, time.time()))
+
+    def _write(self, name, content, mode='wb'):
+        with open(os.path.join(self.workdir, name), mode) as fp:
+            fp.write(content)
+
+    def _wait_for(self, count, timeout=3.0):
+        deadline = time.time() + timeout
+        while len(self.produced) < count and time.time() < deadline:
+            time.sleep(0.02)
+        return [rel_path for rel_path, _ in self.produced]
+
+    def test_existing_files_first(self):
+        self.assertEqual(self._wait_for(1), ['old.png'])
+
+    def test_waits_until_file_settles(self):
+        self._wait_for(1)
+        self._write('new.png', 'a')
+        for _ in range(4):
+            time.sleep(0.1)
+            self._write('new.png', 'a', 'ab')  # 仍在写入
+        last_write = time.time()
+        self.assertEqual(self._wait_for(2), ['old.png', 'new.png'])
+        self.assertGreaterEqual(self.produced[1][1] - last_write,
+                                self.watcher.SETTLE_TIME * 0.9)
+        time.sleep(0.5)
+        self.assertEqual(len(self.produced), 2)  # 只产生一次
+
+    def test_deleted_before_settling(self):
+        self._wait_for(1)
+        self._write('tmp.png', 'a')
+        os.remove(os.path.join(self.workdir, 'tmp.png'))
+        time.sleep(0.6)
+        self.assertEqual(self._wait_for(1), ['old.png'])
+
+
+class PollWatcherTest(WatcherTestCase):
+
+    def test_backend(self):
+        self.assertEqual(self.watcher.backend, 'poll')
+
+    def test_poll_interval_backs_off(self):
+        self._wait_for(1)
+        time.sleep(0.8)
+        self.assertEqual(self.watcher.poll_interval,
+                         self.watcher.MAX_POLL_INTERVAL)
+        self._write('new.png', 'a')
+        self.assertEqual(self._wait_for(2), ['old.png', 'new.png'])
+        self.assertLess(self.watcher.poll_interval,
+                        self.watcher.MAX_POLL_INTERVAL)
+
+
+class InotifyWatcherTest(WatcherTestCase):
+
+    use_inotify = True
+
+    def setUp(self):
+        WatcherTestCase.setUp(self)
+        if self.watcher.backend != 'inotify':
+            self.skipTest('inotify 不可用')
+
+    def test_close_releases_fd(self):
+        fd = self.watcher.inotify_fd
+        self._wait_for(1)
+        self.watcher.stop()
+        self.thread.join(2)
+        self.watcher.close()
+        self.assertIsNone(self.watcher.inotify_fd)
+        self.assertRaises(OSError, os.fstat, fd)
+
+
+if __name__ == '__main__':
+    unittest.main()
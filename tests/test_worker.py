@@ -0,0 +1,22 @@
+# coding=utf-8
+
+import unittest
+
+from tinifycli.worker import TinifyCliByteBudget
+
+
+class ByteBudgetTest(unittest.TestCase):
+
+    def test_limits_total_bytes(self):
+        budget = TinifyCliByteBudget(100)
+        self.assertTrue(budget.try_acquire(60))
+        self.assertTrue(budget.try_acquire(40))
+        self.assertFalse(budget.try_acquire(1))
+        budget.release(60)
+        self.assertTrue(budget.try_acquire(50))
+        self.assertFalse(budget.try_acquire(11))
+        self.assertEqual(budget.used, 90)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,22 +15,33 @@ tinify-cli
 '''
 
 import argparse
-import functools
+import errno
+import json
 import logging
-from multiprocessing.dummy import Pool as ThreadPool
 import os
 import platform
 import re
 import signal
 import sys
 
-from prettytable import PrettyTable
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir  # Python 2 下可以安装 scandir 的 backport
+    except ImportError:
+        scandir = None
 
+# 只导入解析命令行和 --version, -p 用得到的模块, 压缩用的模块在 proc_compress
+# 中才导入; requests 在第一次发出请求时才导入
 from .key_holder import TinifyCliKeyHolder, EmptyKeyHolderException
-from .worker import compress
-from .display import TinifyCliDisplay
-
-from .function_call_trace import tracecall
+from .display import TinifyCliDisplay, report
+from .session_pool import TinifyCliSessionPool, connections_per_key
+from .ratelimit import TinifyCliRateLimiter
+from .api import TinifyCliClient
+from .compressor import TinifyCliCompressor, TinifyCliResult
+from . import engine
+from . import profiler
 
 from . import shared_var
 
@@ -42,8 +53,26 @@ __version__ = '1.1'
 
 LOGGER = logging.getLogger('tinify-cli')
 
+# 排队中和执行中的任务数上限为并发数的这么多倍
+QUEUE_SIZE_FACTOR = 4
+# 流水线中读取和写入阶段的线程数
+PIPELINE_IO_THREADS = 2
+
 def sigint_handler(_, dummy):
-    ''' 处理 SIGINT 信号的函数 '''
+    ''' 处理 SIGINT 信号的函数. 压缩过程中第一次收到时不再开始新的任务,
+    等已经开始的任务做完 (最多 --drain-timeout 秒) 再退出; 第二次收到时
+    立即退出. 两种情况下已经上传但还没有保存的图片都记入续传日志. '''
+    dispatcher = shared_var.worker_thread_pool
+    if dispatcher is not None and not shared_var.is_draining:
+        shared_var.is_draining = True
+        LOGGER.warning(u'不再开始新的任务, 等待进行中的任务完成 (最多 ' +
+                       str(shared_var.drain_timeout) +
+                       u' 秒), 再按一次 Ctrl+C 立即退出')
+        dispatcher.drain(shared_var.drain_timeout)
+        if shared_var.watcher is not None:
+            shared_var.watcher.stop()
+        return
+
     if shared_var.key_loading_thread_pool is not None:
         LOGGER.warning(u'关闭线程池')
         shared_var.key_loading_thread_pool.close()
@@ -54,12 +83,25 @@ def sigint_handler(_, dummy):
         shared_var.worker_thread_pool.close()
         shared_var.worker_thread_pool.terminate()
 
+    if shared_var.output_syncer is not None:
+        shared_var.output_syncer.flush()
+    if shared_var.resume_journal is not None:
+        shared_var.resume_journal.save()
+    if shared_var.location_store is not None:
+        shared_var.location_store.flush()
+    if shared_var.result_cache is not None:
+        shared_var.result_cache.flush()
+    if profiler.PROFILER is not None:
+        profiler.PROFILER.write_trace(shared_var.profile_path)
+
     LOGGER.critical(u'依你的要求退出程序')
     sys.exit(1)
-signal.signal(signal.SIGINT, sigint_handler)
 
 def main():
     ''' 主函数, 命令行 tinify-cli 的入口点 '''
+    # 只有命令行才处理 SIGINT , 作为库被导入时不改变调用者的信号处理
+    signal.signal(signal.SIGINT, sigint_handler)
+
     parser = argparse.ArgumentParser(
         add_help=False,
         description=u'''基于 Tinify 的批量图片压缩工具. 支持多线程,
@@ -132,6 +174,16 @@ def main():
         dest='height',
         help=u'见 --resize-method',
         type=int)
+    group1.add_argument(
+        '--variants',
+        action='store',
+        dest='variants',
+        help=u'''一次上传, 输出多个尺寸. 以逗号分隔的尺寸列表, 例如
+        scale:320,scale:x240,fit:1200x800,cover:200x200 . scale
+        后只写宽度时按宽度缩放, 写作 x高度 时按高度缩放. 每个尺寸的文件名由
+        --filename-replace 决定, 其中可以使用 {variant}, {method}, {width},
+        {height} 占位符; 不使用占位符时, 在扩展名前加上 -{variant} .
+        使用此选项时忽略 --resize ''')
     group1.add_argument(
         '--override',
         action='store_true',
@@ -139,6 +191,193 @@ def main():
         help=u'''默认情况下, 如果一个文件处理之后的文件名,
         在输出目录已经存在同名文件, 那么这个文件不会被处理. 但开启此开关后,
         会变为直接覆盖目标文件.''')
+    group1.add_argument(
+        '--fsync',
+        action='store_true',
+        dest='is_fsync',
+        help=u'''输出文件改名为目标文件之前先 fsync , 所在目录的 fsync
+        攒批进行. 保证掉电后输出文件也是完整的, 但会慢一些''')
+
+    group1.add_argument(
+        '-R', '--recursive',
+        action='store_true',
+        dest='is_recursive',
+        help=u'''递归搜索源目录的子目录, 并在输出目录中保持同样的目录结构.
+        文件一边被发现一边被压缩''')
+    group1.add_argument(
+        '--manifest',
+        action='store_true',
+        dest='is_manifest',
+        help=u'''在输出目录中维护一份清单, 记录处理过的源文件.
+        再次运行时只处理新增或有变化的源文件, 有变化的源文件即使目标文件已存在
+        也会重新处理''')
+
+    group1.add_argument(
+        '--prescreen',
+        action='store_true',
+        dest='is_prescreen',
+        help=u'''上传前在本地用多个进程读取图片的文件头, 估计压缩能节省的比例,
+        跳过预计节省不到 --min-savings 或小于 --min-size 的图片.
+        调整尺寸时 (包括任务清单中给出 resize 的图片) 不进行预筛选''')
+    group1.add_argument(
+        '--min-savings',
+        action='store',
+        dest='min_savings',
+        default=10,
+        help=u'见 --prescreen , 单位为百分比',
+        type=float)
+    group1.add_argument(
+        '--min-size',
+        action='store',
+        dest='min_size',
+        default=512,
+        help=u'见 --prescreen , 单位为字节',
+        type=int)
+
+    group1.add_argument(
+        '--watch',
+        action='store_true',
+        dest='is_watch',
+        help=u'''处理完已有的图片后继续运行, 监视源目录 (-R 时包括子目录),
+        在新图片写完后马上压缩它. Linux 上使用 inotify , 其他系统定期扫描.
+        按 Ctrl+C 退出''')
+    group1.add_argument(
+        '--watch-poll',
+        action='store_true',
+        dest='is_watch_poll',
+        help=u'''--watch 时不使用 inotify , 而是定期扫描源目录 (例如源目录在
+        网络文件系统上时). 每次扫描都要遍历整个目录树并读取每个文件的状态,
+        所以间隔为 1 秒, 没有变化时逐渐拉长到 8 秒''')
+    group1.add_argument(
+        '--from-manifest',
+        action='store',
+        dest='from_manifest',
+        metavar='PATH',
+        help=u'''不搜索源目录, 而是从这个 JSONL 文件 (- 表示标准输入)
+        逐行读取任务, 一边读一边压缩. 每行是一个 JSON 对象, 包括 src (源文件),
+        可选的 dest (目标文件, 多尺寸时为 list) 和 resize ({"method": ...,
+        "width": ..., "height": ...}, 多尺寸时为 list) , 相对路径分别相对于
+        源目录和输出目录. 每个任务的结果 (大小, 压缩比, 延迟, 使用的 Key ,
+        错误) 以 JSONL 格式逐行写到标准输出''')
+
+    group5 = parser.add_argument_group(u'分片')
+    group5.add_argument(
+        '--shard-db',
+        action='store',
+        dest='shard_db',
+        help=u'''共享租约数据库 (SQLite) 的路径. 多个进程或多台机器指向
+        同一个源目录和同一个租约数据库时, 每个文件只会被其中一个处理.
+        数据库应放在各台机器都能访问的共享文件系统上''')
+    group5.add_argument(
+        '--shard-lease',
+        action='store',
+        dest='shard_lease',
+        default=300,
+        help=u'租约的有效秒数, 进程退出后超过这个时间, 它未完成的文件可被其他进程领取',
+        type=int)
+    group5.add_argument(
+        '--shard-batch',
+        action='store',
+        dest='shard_batch',
+        default=16,
+        help=u'每次领取的文件数',
+        type=int)
+
+    group4 = parser.add_argument_group(u'缓存')
+    group4.add_argument(
+        '--cache',
+        action='store_true',
+        dest='is_cache',
+        help=u'''按文件内容缓存压缩结果. 内容相同 (且尺寸调整参数相同)
+        的图片只上传一次, 之后直接从缓存取得结果''')
+    group4.add_argument(
+        '--cache-dir',
+        action='store',
+        dest='cache_dir',
+        default='~/.tinify-cli/cache',
+        help=u'缓存目录')
+    group4.add_argument(
+        '--cache-size',
+        action='store',
+        dest='cache_size',
+        default=1024,
+        help=u'缓存大小上限 (MiB), 超出后淘汰最久未使用的结果',
+        type=int)
+    group4.add_argument(
+        '--reuse-uploads',
+        action='store_true',
+        dest='is_reuse_uploads',
+        help=u'''按文件内容记下服务器上压缩结果的输出地址. 之后的运行中
+        即使 --resize-method, --width, --height 不同, 或者输出文件丢失,
+        内容相同的图片也不再上传, 直接从输出地址取得所需的尺寸''')
+    group4.add_argument(
+        '--location-store',
+        action='store',
+        dest='location_store_path',
+        default='~/.tinify-cli/locations.sqlite',
+        help=u'保存输出地址的数据库文件')
+    group4.add_argument(
+        '--location-ttl',
+        action='store',
+        dest='location_ttl',
+        default=3600,
+        help=u'输出地址的有效秒数, 超过后重新上传',
+        type=int)
+    group4.add_argument(
+        '--resume-max-age',
+        action='store',
+        dest='resume_max_age',
+        default=3600,
+        help=u'''续传日志 (输出目录中的 .tinify-cli-resume.json) 中记录的
+        有效秒数. 上次运行中已经上传的图片, 不超过这个时间的直接下载输出,
+        不再上传''',
+        type=int)
+
+    group6 = parser.add_argument_group(
+        u'限速', u'''0 表示不限. 无论是否设置上限, 收到 429 或 5xx 时都会自动
+        降低请求速率, 之后逐渐恢复''')
+    group6.add_argument(
+        '--max-rps',
+        action='store',
+        dest='max_rps',
+        default=0,
+        help=u'整个运行每秒最多发出的请求数',
+        type=float)
+    group6.add_argument(
+        '--max-upload',
+        action='store',
+        dest='max_upload',
+        default=0,
+        help=u'整个运行的上传速率上限 (KiB/s)',
+        type=int)
+    group6.add_argument(
+        '--max-download',
+        action='store',
+        dest='max_download',
+        default=0,
+        help=u'整个运行的下载速率上限 (KiB/s)',
+        type=int)
+    group6.add_argument(
+        '--key-max-rps',
+        action='store',
+        dest='key_max_rps',
+        default=0,
+        help=u'每个 Key 每秒最多发出的请求数',
+        type=float)
+    group6.add_argument(
+        '--key-max-upload',
+        action='store',
+        dest='key_max_upload',
+        default=0,
+        help=u'每个 Key 的上传速率上限 (KiB/s)',
+        type=int)
+    group6.add_argument(
+        '--key-max-download',
+        action='store',
+        dest='key_max_download',
+        default=0,
+        help=u'每个 Key 的下载速率上限 (KiB/s)',
+        type=int)
 
     group2 = parser.add_argument_group(u'API Key')
     group2.add_argument(
@@ -147,6 +386,29 @@ def main():
         default='~/.tinify-cli/keys',
         dest='key_holder_path',
         help=u'指定存放 API Key 的文件的路径')
+    group2.add_argument(
+        '--key-quota',
+        action='store',
+        dest='key_quota',
+        default=TinifyCliKeyHolder.MONTHLY_QUOTA,
+        help=u'''每个 Key 每月可压缩的次数. 优先使用剩余次数最多的 Key ,
+        用满的 Key 不再使用. 0 表示不限次数''',
+        type=int)
+    group2.add_argument(
+        '--key-status-ttl',
+        action='store',
+        dest='key_status_ttl',
+        default=TinifyCliKeyHolder.STATUS_TTL,
+        help=u'''Key 的验证结果保存在 Key 文件旁的 .status 文件中, 在这么多秒
+        内不再重新验证 (过期后在后台重新验证). 0 表示每次都验证''',
+        type=int)
+    group2.add_argument(
+        '--api-endpoint',
+        action='store',
+        dest='api_endpoint',
+        default=TinifyCliClient.API_ENDPOINT,
+        help=u'''Tinify API 的地址. 可以指向 python -m tinifycli.mock_server
+        启动的本地模拟服务器, 以便在不消耗用量的情况下测试''')
     group2.add_argument(
         '-V', '--only-validate',
         action='store_true',
@@ -168,8 +430,63 @@ def main():
         action='store',
         dest='thread_num',
         default=1,
-        help=u'指定工作线程数',
+        help=u'''指定工作线程数. auto 表示在运行中根据延迟自动调整同时进行的
+        任务数 (thread 引擎最多 ''' + str(engine.AUTO_MAX_THREADS) +
+        u''' 个, async 引擎最多 --max-inflight 个)''',
+        type=thread_num_type)
+    group3.add_argument(
+        '--engine',
+        action='store',
+        choices=engine.ENGINES,
+        dest='engine',
+        default='thread',
+        help=u'''并发引擎. thread 为每个并发请求使用一个线程; async
+        使用 gevent 协程在单个线程内进行全部传输, 适合非常高的并发数,
+        此时并发数由 --max-inflight 决定''')
+    group3.add_argument(
+        '--max-inflight',
+        action='store',
+        dest='max_inflight',
+        default=100,
+        help=u'async 引擎下同时进行中的任务数上限',
+        type=int)
+    group3.add_argument(
+        '--pipeline',
+        action='store_true',
+        dest='is_pipeline',
+        help=u'''把每张图片的处理拆成读取, 上传, 下载, 写入四个阶段, 每个阶段
+        有自己的线程 (上传和下载各 -t 个), 使上传, 下载和磁盘 I/O 同时进行.
+        结束时输出每个阶段的利用率''')
+    group3.add_argument(
+        '--drain-timeout',
+        action='store',
+        dest='drain_timeout',
+        default=30,
+        help=u'''按 Ctrl+C 后最多等待这么多秒, 让已经上传的图片下载完再退出.
+        没有来得及下载的图片的输出地址记在输出目录的续传日志中,
+        下次运行时直接下载, 不再上传''',
+        type=float)
+    group3.add_argument(
+        '--progress-interval',
+        action='store',
+        dest='progress_interval',
+        default=5,
+        help=u'''每隔多少秒输出一次进度, 吞吐量, 延迟和预计剩余时间,
+        0 表示不输出''',
         type=int)
+    group3.add_argument(
+        '--summary-json',
+        action='store',
+        dest='summary_json',
+        help=u'运行结束后把统计结果以 JSON 格式写入此文件')
+    group3.add_argument(
+        '--profile',
+        action='store',
+        dest='profile_path',
+        help=u'''记录读取, 上传, 服务器压缩, 下载, 写入, 等待 Key 等各阶段的
+        用时, 结束时在日志中输出各阶段的用时分布, 并把全部事件以 Chrome
+        trace 格式写入此文件 (可用 chrome://tracing 或 Perfetto 打开).
+        给出 --summary-json 时, 其中也包括各阶段的用时分布''')
     group3.add_argument(
         '--debug',
         action='store_true',
@@ -192,10 +509,38 @@ def main():
     shared_var.is_no_validate = args.is_no_validate
     shared_var.is_only_validate_key = args.is_only_validate_key
     shared_var.is_override = args.is_override
+    shared_var.is_fsync = args.is_fsync
     shared_var.is_preview_filename = args.is_preview_filename
     shared_var.is_resize = args.is_resize
+    shared_var.is_manifest = args.is_manifest
+    shared_var.is_prescreen = args.is_prescreen
+    shared_var.min_savings = args.min_savings / 100.0
+    shared_var.min_size = args.min_size
+    shared_var.shard_db = args.shard_db
+    shared_var.shard_lease = args.shard_lease
+    shared_var.shard_batch = args.shard_batch
+    shared_var.is_recursive = args.is_recursive
+    shared_var.is_watch = args.is_watch
+    shared_var.is_watch_poll = args.is_watch_poll
+    shared_var.from_manifest = args.from_manifest
 
-    shared_var.thread_num = args.thread_num
+    shared_var.is_auto_concurrency = args.thread_num == 'auto'
+    if not shared_var.is_auto_concurrency:
+        shared_var.thread_num = args.thread_num
+    shared_var.is_pipeline = args.is_pipeline
+    shared_var.progress_interval = args.progress_interval
+    shared_var.drain_timeout = args.drain_timeout
+    shared_var.summary_json = args.summary_json
+    shared_var.profile_path = args.profile_path
+    if shared_var.profile_path is not None:
+        profiler.enable()
+    shared_var.max_inflight = args.max_inflight
+    shared_var.max_rps = args.max_rps
+    shared_var.max_upload = args.max_upload * 1024
+    shared_var.max_download = args.max_download * 1024
+    shared_var.key_max_rps = args.key_max_rps
+    shared_var.key_max_upload = args.key_max_upload * 1024
+    shared_var.key_max_download = args.key_max_download * 1024
 
     # 为 '~' 提供支持
     shared_var.src_dir = os.path.abspath(
@@ -207,29 +552,53 @@ def main():
     shared_var.resize_method = args.resize_method
     shared_var.width = args.width
     shared_var.height = args.height
+    shared_var.is_cache = args.is_cache
+    shared_var.cache_dir = args.cache_dir
+    shared_var.cache_size = args.cache_size * 1024 * 1024
+    shared_var.is_reuse_uploads = args.is_reuse_uploads
+    shared_var.location_store_path = os.path.expanduser(
+        args.location_store_path)
+    shared_var.location_ttl = args.location_ttl
+    shared_var.resume_max_age = args.resume_max_age
 
 
 
     TinifyCliKeyHolder.set_key_holder_path(args.key_holder_path)
+    TinifyCliKeyHolder.MONTHLY_QUOTA = args.key_quota
+    TinifyCliKeyHolder.STATUS_TTL = args.key_status_ttl
+    TinifyCliClient.API_ENDPOINT = args.api_endpoint.rstrip('/')
+
+    engine.setup_engine(args.engine)
+
+    # 所有工作线程共享的限速器
+    shared_var.rate_limiter = TinifyCliRateLimiter(
+        shared_var.max_rps, shared_var.max_upload, shared_var.max_download,
+        shared_var.key_max_rps, shared_var.key_max_upload,
+        shared_var.key_max_download)
+
+    if shared_var.is_pipeline and shared_var.is_auto_concurrency:
+        logging.critical('--pipeline 不能与 -t auto 同时使用')
+        sys.exit(1)
+
+    if shared_var.from_manifest is not None and shared_var.is_watch:
+        logging.critical('--from-manifest 不能与 --watch 同时使用')
+        sys.exit(1)
 
     if shared_var.is_resize is True:
-        if shared_var.width is None and shared_var.height is None:
-            logging.critical('尺寸调整要求给定宽度和高度, 详细请查看帮助')
+        error = check_resize_param(
+            shared_var.resize_method, shared_var.width, shared_var.height)
+        if error is not None:
+            logging.critical(error)
             sys.exit(1)
 
-        if shared_var.resize_method == 'scale':
-            if shared_var.width is not None and shared_var.height is not None:
-                logging.critical(
-                    '尺寸调整方式 scale 要求宽度和高度最多只给定一个')
-                sys.exit(1)
-        elif shared_var.resize_method in ['fit', 'cover']:
-            if shared_var.width is None or shared_var.height is None:
-                logging.critical(
-                    '尺寸调整方式 fit 要求宽度和高度都给定')
-                sys.exit(1)
+    if args.variants is not None:
+        try:
+            shared_var.variants = parse_variants(args.variants)
+        except ValueError as err:
+            logging.critical(str(err))
+            sys.exit(1)
 
-    # 暂时我们用不到他, 以后加进度条可以用上
-    TinifyCliDisplay(log_to_stderr=True)
+    shared_var.display = TinifyCliDisplay(log_to_stderr=True)
 
     if not shared_var.is_debug_requests:
         # 屏蔽大部分低级别的 requests 的日志
@@ -237,7 +606,13 @@ def main():
 
     LOGGER.info('在 ' + TinifyCliKeyHolder.KEY_HOLDER_PATH + ' 寻找 Key')
 
-    LOGGER.info('工作线程数为 ' + str(shared_var.thread_num))
+    if shared_var.is_auto_concurrency:
+        LOGGER.info('自动调整并发数, 上限为 ' + str(engine.concurrency()))
+    elif shared_var.engine == 'async':
+        LOGGER.info('使用 async 引擎, 并发数上限为 ' +
+                    str(shared_var.max_inflight))
+    else:
+        LOGGER.info('工作线程数为 ' + str(shared_var.thread_num))
 
     if shared_var.is_only_validate_key:  # 验证 API Key
         proc_validate_key()
@@ -249,6 +624,10 @@ def main():
                 shared_var.filename_pattern)
     LOGGER.info('文件名按这样的规则修改: ' + shared_var.filename_replace)
 
+    if shared_var.is_preview_filename:  # 预览文件名, 不需要 Key
+        proc_preview_filename()
+        sys.exit(0)
+
     if platform.system() == 'Darwin':
         LOGGER.info('按 Control+C 可以退出程序')
     else:
@@ -256,23 +635,253 @@ def main():
 
     proc_compress()
 
+def thread_num_type(text):
+    ''' -t 的参数: 正整数或 auto '''
+    if text == 'auto':
+        return text
+    try:
+        value = int(text)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError(u'应为正整数或 auto')
+    return value
+
+def check_resize_param(method, width, height):
+    ''' 检查尺寸调整参数, 有问题时返回错误信息, 否则返回 None '''
+    if width is None and height is None:
+        return '尺寸调整要求给定宽度和高度, 详细请查看帮助'
+    if method == 'scale':
+        if width is not None and height is not None:
+            return '尺寸调整方式 scale 要求宽度和高度最多只给定一个'
+    elif method in ['fit', 'cover']:
+        if width is None or height is None:
+            return '尺寸调整方式 ' + method + ' 要求宽度和高度都给定'
+    return None
+
+def parse_variants(text):
+    ''' 把 "scale:320,scale:x240,fit:1200x800,cover:200x200" 这样的描述
+    转换为 (method, width, height) 的 list . scale 的尺寸只写宽度时按宽度缩放,
+    写作 "x高度" 时按高度缩放. '''
+    variants = []
+    for spec in text.split(','):
+        method, _, size = spec.strip().partition(':')
+        width, _, height = size.partition('x')
+        try:
+            width = int(width) if width else None
+            height = int(height) if height else None
+        except ValueError:
+            raise ValueError('无法识别的尺寸 ' + spec)
+        if method not in ['scale', 'fit', 'cover']:
+            raise ValueError('无法识别的尺寸调整方式 ' + spec)
+        error = check_resize_param(method, width, height)
+        if error is not None:
+            raise ValueError(spec + ': ' + error)
+        variants.append((method, width, height))
+    return variants
+
+def variant_name(resize):
+    ''' 例如 scale-320, scale-x240, fit-1200x800 '''
+    method, width, height = resize
+    size = '' if width is None else str(width)
+    if height is not None:
+        size += 'x' + str(height)
+    return method + '-' + size
+
+def variant_filename_convert(filename, resize):
+    ''' 多尺寸输出时的目标文件名. --filename-replace 中可以使用 {variant},
+    {method}, {width}, {height} 这几个占位符; 没有使用占位符时,
+    在扩展名之前加上 "-{variant}" . '''
+    method, width, height = resize
+    fields = {
+        '{variant}': variant_name(resize),
+        '{method}': method,
+        '{width}': '' if width is None else str(width),
+        '{height}': '' if height is None else str(height),
+    }
+    converted = filename_convert(filename)
+    if not any(field in shared_var.filename_replace for field in fields):
+        root, ext = os.path.splitext(converted)
+        return root + '-' + fields['{variant}'] + ext
+    dirname, basename = os.path.split(converted)
+    for field, value in fields.items():
+        basename = basename.replace(field, value)
+    return os.path.join(dirname, basename)
+
+def _manifest_str(value):
+    ''' json 给出的是 unicode , 其余代码中的路径都是 utf-8 编码的 str '''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def parse_manifest_resize(value):
+    ''' 把任务清单中的 {"method": ..., "width": ..., "height": ...}
+    转换为 (method, width, height) , 有问题时抛出 ValueError '''
+    if not isinstance(value, dict):
+        raise ValueError('resize 应为 JSON 对象')
+    for name in ('width', 'height'):
+        size = value.get(name)
+        if size is None:
+            continue
+        # bool 也是 int , 需要排除
+        if not isinstance(size, (int, long)) or isinstance(size, bool) or \
+                size <= 0:
+            raise ValueError(name + ' 应为正整数, 而不是 ' +
+                             json.dumps(size))
+    resize = (_manifest_str(value.get('method', 'scale')), value.get('width'),
+              value.get('height'))
+    if resize[0] not in ['scale', 'fit', 'cover']:
+        raise ValueError('无法识别的尺寸调整方式 ' + repr(resize[0]))
+    error = check_resize_param(*resize)
+    if error is not None:
+        raise ValueError(error)
+    return resize
+
+def parse_manifest_line(line, default_resize):
+    ''' 把任务清单中的一行转换为 (源文件, 目标文件, 尺寸参数) ,
+    有问题时抛出 ValueError . 没有给出 dest 时按 --filename-replace
+    生成, 没有给出 resize 时使用命令行给定的尺寸. '''
+    try:
+        record = json.loads(line)
+    except ValueError:
+        raise ValueError('不是合法的 JSON')
+    if not isinstance(record, dict) or not record.get('src'):
+        raise ValueError('缺少 src')
+    src = os.path.join(shared_var.src_dir,
+                       os.path.expanduser(_manifest_str(record['src'])))
+    if not os.path.isfile(src):
+        raise ValueError('源文件 ' + src + ' 不存在')
+    filename = os.path.relpath(src, shared_var.src_dir)
+    if filename.startswith(os.pardir):
+        filename = os.path.basename(src)  # 源文件不在源目录里
+
+    resize = record.get('resize', default_resize)
+    if isinstance(resize, list):
+        resize = tuple(parse_manifest_resize(item) for item in resize)
+        if not resize:
+            raise ValueError('resize 不能为空 list')
+    elif isinstance(resize, dict):
+        resize = parse_manifest_resize(resize)
+    elif 'resize' in record and resize is not None:
+        # 否则要等到上传之后下载时才出错, 白白用掉一次压缩
+        raise ValueError('resize 应为 JSON 对象, list 或 null , 而不是 ' +
+                         json.dumps(resize))
+
+    dest = record.get('dest')
+    if dest is None:
+        if isinstance(resize, tuple) and isinstance(resize[0], tuple):
+            dest = [variant_filename_convert(filename, variant)
+                    for variant in resize]
+        else:
+            dest = filename_convert(filename)
+    if isinstance(dest, list):
+        if not isinstance(resize, tuple) or \
+                not isinstance(resize[0], tuple) or \
+                len(dest) != len(resize):
+            raise ValueError('dest 为 list 时 resize 应为同样长度的 list')
+        dest = tuple(os.path.join(shared_var.dest_dir,
+                                  os.path.expanduser(_manifest_str(path)))
+                     for path in dest)
+    elif isinstance(resize, tuple) and isinstance(resize[0], tuple):
+        raise ValueError('resize 为 list 时 dest 也应为 list')
+    elif not isinstance(dest, basestring):
+        raise ValueError('dest 应为字符串或 list')
+    else:
+        dest = os.path.join(shared_var.dest_dir,
+                            os.path.expanduser(_manifest_str(dest)))
+    return src, dest, resize
+
+def _readlines(fp):
+    ''' 逐行读取 fp , 读取时被 SIGINT 打断 (EINTR) 则继续读, 除非要求中止 '''
+    while True:
+        try:
+            line = fp.readline()
+        except IOError as err:
+            if err.errno == errno.EINTR and not shared_var.is_draining:
+                continue
+            if err.errno == errno.EINTR:
+                return
+            raise
+        if not line or shared_var.is_draining:
+            return
+        yield line
+
+def _manifest_line_src(line):
+    ''' 尽量从有误的一行中取出源文件路径, 用于结果输出, 取不到时返回 None '''
+    try:
+        src = json.loads(line).get('src')
+    except (ValueError, AttributeError):
+        return None
+    if not isinstance(src, basestring) or not src:
+        return None
+    return os.path.join(shared_var.src_dir,
+                        os.path.expanduser(_manifest_str(src)))
+
+def read_manifest(fp, default_resize):
+    ''' 逐行读取任务清单, 产生 (源文件, 目标文件, 尺寸参数) .
+    不使用 for line in fp , 以免 Python 2 的预读使任务要攒够一块才被处理 '''
+    for lineno, line in enumerate(_readlines(fp), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield parse_manifest_line(line, default_resize)
+        except ValueError as err:
+            LOGGER.error('任务清单第 ' + str(lineno) + ' 行有误: ' + str(err))
+            if shared_var.result_writer is not None:
+                shared_var.result_writer.write({
+                    'line': lineno, 'src': _manifest_line_src(line),
+                    'status': 'failed', 'error': str(err).decode('utf-8')})
+
+def iter_dir(path):
+    ''' 逐个产生目录 path 下的 (文件名, 是否为目录) '''
+    if scandir is not None:
+        for entry in scandir(path):
+            yield entry.name, entry.is_dir()
+    else:
+        for name in os.listdir(path):
+            yield name, os.path.isdir(os.path.join(path, name))
+
 def discover_file():
     ''' 根据 shared_var 里面描述的条件, 搜索符合条件的图片,
-    返回一个满是文件名的 list .
+    逐个产生相对于源目录的文件路径. 开启 --recursive 时会遍历子目录.
     '''
     _0 = re.compile(shared_var.filename_pattern)  # 预先编译正则表达式, 提速
-    # t1 = 源目录下符合正则的图片 list
-    _1 = filter(_0.match, os.listdir(shared_var.src_dir))
-    return _1
+    dir_stack = ['']
+    while dir_stack:
+        rel_dir = dir_stack.pop()
+        abs_dir = os.path.join(shared_var.src_dir, rel_dir)
+        for name, is_dir in iter_dir(abs_dir):
+            rel_path = os.path.join(rel_dir, name)
+            if is_dir:
+                # 输出目录在源目录里面时, 不要再去压缩输出的图片
+                if shared_var.is_recursive and \
+                        os.path.join(abs_dir, name) != shared_var.dest_dir:
+                    dir_stack.append(rel_path)
+            elif _0.match(name):
+                yield rel_path
+
+def filename_convert(filename):
+    ''' 将相对于源目录的文件路径转换为相对于输出目录的路径,
+    只对文件名部分按正则替换, 目录结构保持不变 '''
+    dirname, basename = os.path.split(filename)
+    return os.path.join(
+        dirname,
+        re.sub(shared_var.filename_pattern,
+               shared_var.filename_replace,
+               basename))
 
 def filenames_convert(filenames):
     ''' 将给定的源文件名 list 转换为目标文件名的 list , 且一一对应 '''
-    r = re.compile(shared_var.filename_pattern)
-    ret = map(functools.partial(r.sub, shared_var.filename_replace), filenames)
-    return ret
+    if shared_var.variants:
+        return [', '.join(variant_filename_convert(filename, variant)
+                          for variant in shared_var.variants)
+                for filename in filenames]
+    return map(filename_convert, filenames)
 
 def print_filename_change(src_filenames, dest_filenames):
     ''' 用一个漂亮的表格打印出文件名的变化 '''
+    from prettytable import PrettyTable
     table = PrettyTable()
     table.field_names = ['原文件名', '目标文件名']
     [table.add_row(row) for row in zip(src_filenames, dest_filenames)]
@@ -282,96 +891,316 @@ def proc_validate_key():
     ''' 过程: 验证 API Key '''
     LOGGER.info('验证 API Key')
 
+    shared_var.session_pool = TinifyCliSessionPool(
+        engine.concurrency(), TinifyCliClient.USER_AGENT)
     key_holder = TinifyCliKeyHolder()
     shared_var.key_holder = key_holder
-    key_holder.load_keys_from_file()
+    try:
+        # 忽略状态文件, 重新验证全部 Key 并更新状态文件
+        key_holder.load_keys_from_file(refresh=True)
+        key_holder.wait_validation()
+    except EmptyKeyHolderException:
+        LOGGER.critical('没有可用的 Key')
+        sys.exit(1)
+
+def proc_preview_filename():
+    ''' 过程: 预览文件名的变化 '''
+    src_filenames = list(discover_file())
+    dest_filenames = filenames_convert(src_filenames)
+    LOGGER.info('发现了 ' + str(len(src_filenames)) + ' 张图片')
+    print_filename_change(src_filenames, dest_filenames)
 
 def proc_compress():
     ''' 过程: 压缩 '''
+    from .worker import compress, PIPELINE_STAGES, PIPELINE_DRAIN_STAGES
+    from .cache import TinifyCliResultCache
+    from .manifest import TinifyCliManifest, MANIFEST_FILENAME
+    from .dispatcher import TinifyCliDispatcher
+    from .pipeline import TinifyCliPipeline
+    from .concurrency import TinifyCliConcurrencyController
+    from .lease import TinifyCliLeaseStore
+    from .watcher import TinifyCliWatcher
+    from .prescreen import TinifyCliPrescreener
+    from .results import TinifyCliResultWriter, write_result
+    from .output import TinifyCliDirSyncer
+    from .journal import TinifyCliResumeJournal, RESUME_JOURNAL_FILENAME
+    from .locations import TinifyCliLocationStore
+
     LOGGER.info('')
 
+    prescreener = None
+    if shared_var.is_prescreen:
+        if shared_var.is_resize or shared_var.variants:
+            LOGGER.info('调整尺寸时不进行预筛选')
+        else:
+            # 进程池要在验证 Key 等线程启动之前创建.
+            # 监视模式下任务要马上处理, 一次只筛选一个.
+            # gevent 替换了 threading 之后, 进程池不能正常工作.
+            prescreener = TinifyCliPrescreener(
+                shared_var.min_savings, shared_var.min_size,
+                window=1 if shared_var.is_watch else None,
+                in_process=shared_var.engine == 'async')
+
+    # 所有工作线程共享的连接池, 每个 Key 一个 Session
+    shared_var.session_pool = TinifyCliSessionPool(
+        connections_per_key(engine.concurrency(),
+                            len(shared_var.variants or ())),
+        TinifyCliClient.USER_AGENT)
+    if shared_var.is_cache:
+        shared_var.result_cache = TinifyCliResultCache(
+            shared_var.cache_dir, shared_var.cache_size)
+        LOGGER.info('使用缓存 ' + shared_var.result_cache.cache_dir)
+    if shared_var.is_reuse_uploads:
+        shared_var.location_store = TinifyCliLocationStore(
+            shared_var.location_store_path, shared_var.location_ttl)
+        LOGGER.info('输出地址保存在 ' + shared_var.location_store_path)
+    if shared_var.is_fsync:
+        shared_var.output_syncer = TinifyCliDirSyncer()
     key_holder = TinifyCliKeyHolder()
     shared_var.key_holder = key_holder
     if shared_var.is_no_validate:
         LOGGER.info('你要求跳过验证 API Key')
-    key_holder.load_keys_from_file()
+    try:
+        # 需要验证的 Key 在后台验证, 与搜索文件同时进行
+        key_holder.load_keys_from_file()
+    except EmptyKeyHolderException:
+        LOGGER.critical('没有可用的 Key')
+        sys.exit(1)
 
-    src_filenames = discover_file()
-    dest_filenames = filenames_convert(src_filenames)
+    if shared_var.is_resize is True:
+        resize_param = shared_var.resize_method, \
+                shared_var.width, shared_var.height
+    else:
+        resize_param = None
 
-    LOGGER.info('发现了 ' + str(len(src_filenames)) + ' 张图片')
+    if shared_var.from_manifest is not None:
+        # 日志写到标准错误, 标准输出只有结果
+        shared_var.result_writer = TinifyCliResultWriter(sys.stdout)
 
-    if shared_var.is_preview_filename:
-        print_filename_change(src_filenames, dest_filenames)
-        sys.exit(0)
+    # 上次中止时已经上传但还没有保存的图片, 这次直接下载
+    resume_journal = TinifyCliResumeJournal(
+        os.path.join(shared_var.dest_dir, RESUME_JOURNAL_FILENAME),
+        shared_var.resume_max_age)
+    shared_var.resume_journal = resume_journal
+
+    manifest = None
+    if shared_var.is_manifest:
+        manifest = TinifyCliManifest(
+            os.path.join(shared_var.dest_dir, MANIFEST_FILENAME))
+        shared_var.manifest = manifest
 
-    src_file_paths = \
-            [os.path.join(shared_var.src_dir, filename) \
-            for filename in src_filenames]
-    dest_file_paths = \
-            [os.path.join(shared_var.dest_dir, filename) \
-            for filename in dest_filenames]
-
-    file_paths = zip(src_file_paths, dest_file_paths)
-
-    if not shared_var.is_override:  # 如果不要求强行覆盖
-        def filter_fileexists((_, dest_file_path)):
-            ''' 判断路径 dest_file_path 是否已经有一个文件 '''
-            if os.path.isfile(dest_file_path):
-                LOGGER.warn('目标文件 ' + dest_file_path +
-                            ' 已存在, 将跳过此图片')
+    def filter_fileexists(src_file_path, dest_file_path):
+        ''' 判断路径 dest_file_path 是否已经有一个文件 '''
+        if manifest is not None and manifest.is_known(src_file_path):
+            # 清单里有记录的源文件发生了变化, 需要重新处理
+            return True
+        if isinstance(dest_file_path, tuple):
+            # 多尺寸输出时, 所有尺寸都已存在才跳过
+            if all(os.path.isfile(path) for path in dest_file_path):
+                LOGGER.warn('图片 ' + src_file_path +
+                            ' 的所有尺寸都已存在, 将跳过此图片')
                 return False
             return True
-        file_paths = filter(filter_fileexists, file_paths)
+        if os.path.isfile(dest_file_path):
+            LOGGER.warn('目标文件 ' + dest_file_path +
+                        ' 已存在, 将跳过此图片')
+            return False
+        return True
 
-    if shared_var.is_resize is True:
-        resize_param = shared_var.resize_method, \
-                shared_var.width, shared_var.height
-    else:
-        resize_param = None
+    # 输出目录就是源目录时, 监视模式会看到自己写出的输出文件. 记下将要
+    # 产生的输出文件, 不要再去压缩它们; 看到之后就不再需要记着了. (输出
+    # 目录是源目录的子目录时, 它不在监视的范围内.)
+    produced = set() if shared_var.is_watch and \
+            shared_var.dest_dir == shared_var.src_dir else None
 
-    task_list = [(path[0], path[1], resize_param)
-                 for path in file_paths]
+    def derive_tasks(filenames):
+        ''' 由相对于源目录的文件路径得到 (源文件, 目标文件, 尺寸参数) '''
+        for filename in filenames:
+            src_file_path = os.path.join(shared_var.src_dir, filename)
+            if shared_var.variants:
+                yield src_file_path, tuple(
+                    os.path.join(shared_var.dest_dir,
+                                 variant_filename_convert(filename, variant))
+                    for variant in shared_var.variants), \
+                        tuple(shared_var.variants)
+            else:
+                yield src_file_path, os.path.join(
+                    shared_var.dest_dir,
+                    filename_convert(filename)), resize_param
 
-    while True:
-        if shared_var.thread_num == 1:  # 单线程方便调试
-            ret = map(compress, task_list)
+    def iter_tasks(entries):
+        ''' 边搜索边产生任务, 不需要等整个目录树遍历完 '''
+        created_dirs = set()
+        for task in entries:
+            src_file_path, dest_file_path, task_resize_param = task
+            if produced is not None and src_file_path in produced:
+                produced.discard(src_file_path)
+                continue
+            report(('discovered', ))
+            if manifest is not None and not shared_var.is_override and \
+                    manifest.is_unchanged(src_file_path, dest_file_path,
+                                          task_resize_param):
+                report(('skipped', ))  # 跳过自上次处理以来没有变化的源文件
+                write_result(task, 'skipped', error='unchanged')
+                # 输出已经保存, 续传日志中可能还留着没来得及删除的记录
+                resume_journal.discard(src_file_path)
+                continue
+            if not shared_var.is_override and \
+                    not filter_fileexists(src_file_path, dest_file_path):
+                report(('skipped', ))
+                write_result(task, 'skipped', error='exists')
+                # 输出已经保存, 续传日志中可能还留着没来得及删除的记录
+                resume_journal.discard(src_file_path)
+                continue
+            if isinstance(dest_file_path, tuple):
+                dest_file_dir = os.path.dirname(dest_file_path[0])
+            else:
+                dest_file_dir = os.path.dirname(dest_file_path)
+            if dest_file_dir not in created_dirs:
+                # 递归模式下, 在输出目录中重建源目录的结构
+                if not os.path.isdir(dest_file_dir):
+                    os.makedirs(dest_file_dir)
+                created_dirs.add(dest_file_dir)
+            if produced is not None:
+                if isinstance(dest_file_path, tuple):
+                    produced.update(dest_file_path)
+                else:
+                    produced.add(dest_file_path)
+            yield task
+        report(('discovery_done', ))
+
+    watcher = None
+    if shared_var.is_watch:
+        watcher = TinifyCliWatcher(shared_var.src_dir, shared_var.is_recursive,
+                                   shared_var.dest_dir,
+                                   use_inotify=not shared_var.is_watch_poll)
+        shared_var.watcher = watcher  # 按 Ctrl+C 时停止监视
+        pattern = re.compile(shared_var.filename_pattern)
+        tasks = iter_tasks(derive_tasks(
+            filename for filename in watcher.files()
+            if pattern.match(os.path.basename(filename))))
+        LOGGER.info('监视模式, 按 Ctrl+C 退出')
+    elif shared_var.from_manifest is not None:
+        if shared_var.from_manifest == '-':
+            manifest_fp = sys.stdin
+            LOGGER.info('从标准输入读取任务')
         else:
-            # 多线程
-            thread_pool = ThreadPool(shared_var.thread_num)
-            # 全局的线程池引用, 方便程序收到 SIGINT 快速退出
-            shared_var.worker_thread_pool = thread_pool
-            ret = thread_pool.map_async(compress, task_list)
-            while not ret.ready():
-                ret.wait(timeout=2)
-            thread_pool.close()
-            thread_pool.join()
-            ret = ret.get()
-            shared_var.worker_thread_pool = None
-
-        LOGGER.debug('完成了一次 mapping ')
-
-        # 过滤掉执行成功的任务
-        failed_task_list = filter(lambda reason: reason[0] != 'success', ret)
-        if len(failed_task_list) == 0:  # 全部执行完毕?
-            LOGGER.info('任务执行完毕')
-            sys.exit(0)
-
-        new_task_list = []  # 准备一个新的任务列表
-        for failed_task in failed_task_list:  # 处理失败的任务
-            failed_reason = failed_task[0]  # 失败的原因
-            args = failed_task[1]  # 拿到任务的参数
-
-            def just_retry_handler():
-                ''' '''
-                new_task_list.append(args)
-
-            {
-                "accountError": just_retry_handler,
-                "netError": just_retry_handler,
-                "clientError": just_retry_handler,
-                "serverError": just_retry_handler
-            }[failed_reason]()
-
-        task_list = new_task_list
+            manifest_fp = open(os.path.expanduser(shared_var.from_manifest))
+            LOGGER.info('从 ' + shared_var.from_manifest + ' 读取任务')
+        tasks = iter_tasks(read_manifest(manifest_fp, resize_param))
+    else:
+        tasks = iter_tasks(derive_tasks(discover_file()))
+    # 监视模式下任务要马上处理, 不能攒够一批再处理
+    batch_size = 1 if shared_var.is_watch else None
+    if prescreener is not None:
+        tasks = prescreener.filter_tasks(tasks)
+
+    lease_store = None
+    if shared_var.shard_db is not None:
+        lease_store = TinifyCliLeaseStore(
+            os.path.abspath(os.path.expanduser(shared_var.shard_db)),
+            shared_var.src_dir, shared_var.shard_lease,
+            batch_size or shared_var.shard_batch)
+        shared_var.lease_store = lease_store
+        LOGGER.info('从 ' + lease_store.path + ' 领取任务, 本进程为 ' +
+                    lease_store.owner)
+        tasks = lease_store.filter_tasks(tasks)
+
+    concurrency = engine.concurrency()
+    controller = None
+    if shared_var.is_pipeline:
+        stage_sizes = {'upload': concurrency, 'download': concurrency}
+        dispatcher = TinifyCliPipeline(
+            [(name, func, stage_sizes.get(name, PIPELINE_IO_THREADS))
+             for name, func in PIPELINE_STAGES],
+            concurrency * QUEUE_SIZE_FACTOR, PIPELINE_DRAIN_STAGES)
+    else:
+        if shared_var.is_auto_concurrency:
+            controller = TinifyCliConcurrencyController(concurrency)
+        dispatcher = TinifyCliDispatcher(concurrency,
+                                         concurrency * QUEUE_SIZE_FACTOR,
+                                         controller)
+    # 全局的引用, 方便程序收到 SIGINT 快速退出
+    shared_var.worker_thread_pool = dispatcher
+    shared_var.display.start_progress_bar(shared_var.progress_interval)
+    try:
+        finished = dispatcher.run(tasks, compress)
+    except EmptyKeyHolderException:
+        shared_var.display.stop_progress_bar()
+        if shared_var.output_syncer is not None:
+            shared_var.output_syncer.flush()
+        resume_journal.save()
+        if shared_var.location_store is not None:
+            shared_var.location_store.flush()
+        if shared_var.result_cache is not None:
+            shared_var.result_cache.flush()
+        key_holder.save_status()
+        LOGGER.critical('所有的 Key 都已不可用, 退出程序')
+        sys.exit(1)
+    finally:
+        if watcher is not None:
+            watcher.close()  # 关闭 inotify 的文件描述符
+        # 所有的 Key 都不可用或第二次 Ctrl+C 退出时, 也要提交清单中
+        # 还没有提交的记录
+        if manifest is not None:
+            manifest.close()
+        # 同样要放弃本进程的租约, 否则其他主机要等它们过期
+        if lease_store is not None:
+            lease_store.close()
+    shared_var.worker_thread_pool = None
+    metrics = shared_var.display.stop_progress_bar()
+    if shared_var.output_syncer is not None:
+        shared_var.output_syncer.flush()
+        shared_var.output_syncer.log_stats()
 
+    LOGGER.info('任务执行完毕, 共处理了 ' + str(finished) + ' 张图片')
+    # 超过 --drain-timeout 时, pending 中还有没做完的任务
+    unfinished = dispatcher.dropped + dispatcher.pending
+    if unfinished > 0:
+        LOGGER.warning('依你的要求中止, ' + str(unfinished) +
+                       ' 张图片没有处理完, 下次运行时继续')
+    LOGGER.info(metrics.format_status())
+    for key, usage in sorted(metrics.key_usage.items()):
+        LOGGER.info('Key ' + key + ' 压缩了 ' + str(usage) + ' 张图片')
+    if shared_var.is_pipeline:
+        dispatcher.log_stats()
+    if shared_var.summary_json is not None:
+        summary = metrics.summary()
+        if shared_var.is_pipeline:
+            summary['stage_utilization'] = dict(
+                (name, utilization)
+                for name, _, utilization in dispatcher.stage_stats())
+        if profiler.PROFILER is not None:
+            summary['phases'] = profiler.PROFILER.summary()
+        with open(shared_var.summary_json, 'w') as fp:
+            json.dump(summary, fp, indent=2, sort_keys=True)
+    failed = dispatcher.failed
+    if shared_var.result_writer is not None:
+        # 包括任务清单中有误的行
+        failed = shared_var.result_writer.counts.get('failed', 0)
+    if failed > 0:
+        LOGGER.error(str(failed) + ' 个任务处理失败')
+    if controller is not None:
+        controller.log_stats()
+    if manifest is not None:
+        LOGGER.info('清单中没有变化的 ' + str(manifest.skipped) +
+                    ' 张图片被跳过')
+    if prescreener is not None:
+        prescreener.log_stats()
+    if lease_store is not None:
+        LOGGER.info('本进程领取了 ' + str(lease_store.claimed) +
+                    ' 张图片, 完成了 ' + str(lease_store.completed) + ' 张')
+    if profiler.PROFILER is not None:
+        profiler.PROFILER.log_stats()
+        profiler.PROFILER.write_trace(shared_var.profile_path)
+    resume_journal.save()
+    resume_journal.log_stats()
+    if shared_var.location_store is not None:
+        shared_var.location_store.log_stats()
+        shared_var.location_store.close()
+    key_holder.save_status()
+    shared_var.session_pool.log_stats()
+    if shared_var.result_cache is not None:
+        shared_var.result_cache.flush()
+        shared_var.result_cache.log_stats()
+    sys.exit(1 if failed > 0 or unfinished > 0 else 0)
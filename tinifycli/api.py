@@ -5,14 +5,19 @@
 import os
 import platform
 import logging
+import threading
+import time
 import traceback
 
-import requests
-
-from .function_call_trace import tracecall
+from . import profiler
+from .profiler import tracecall
+from .session_pool import CACERT_PATH
+from .output import write_atomically, write_temp, place_file
 
 LOGGER = logging.getLogger('tinify-cli')
 
+CHUNK_SIZE = 64 * 1024  # 下载时每次写入文件的块大小
+
 class TinifyCliClient(object):
     ''' API 客户端 '''
     API_ENDPOINT = 'https://api.tinify.com'
@@ -21,33 +26,65 @@ class TinifyCliClient(object):
                     platform.python_version(),
                     platform.python_implementation())
 
-    def __init__(self, key):
+    def __init__(self, key, session_pool=None, rate_limiter=None,
+                 api_endpoint=None, syncer=None):
         self.key = key
+        self.session_pool = session_pool
+        self.rate_limiter = rate_limiter
+        self.syncer = syncer  # 见 output.TinifyCliDirSyncer
+        if api_endpoint is not None:
+            self.API_ENDPOINT = api_endpoint.rstrip('/')
 
         self.compression_count = None
         self.image_width = None
         self.image_height = None
         self.src_size = None
         self.dest_size = None
+        self.shrink_time = None  # 上传并等待服务器压缩所用的秒数
+        self.download_time = None  # 下载并写入文件所用的秒数
+        # 实际上传和下载的字节数. 使用之前得到的输出地址时没有上传,
+        # 直接使用原图时没有下载
+        self.bytes_up = 0
+        self.bytes_down = 0
+        # 使用了之前得到的输出地址, 没有上传时, 为地址的来源 ('journal'
+        # 续传日志或 'store' 输出地址库)
+        self.resumed = None
 
-        self.session = requests.sessions.Session()
-        self.session.auth = ('api', self.key)
-        self.session.headers = {'user-agent': self.USER_AGENT}
-        self.session.verify = \
-                os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cacert.pem')
+        if session_pool is not None:
+            # 共享同一 Key 的连接池, 避免每张图片都重新握手
+            self.session = session_pool.get_session(self.key)
+        else:
+            import requests
+            self.session = requests.sessions.Session()
+            self.session.auth = ('api', self.key)
+            self.session.headers = {'user-agent': self.USER_AGENT}
+            self.session.verify = CACERT_PATH
 
     @tracecall
-    def request(self, method, url, body=None):
-        url = url if url.lower().startswith('https://') else self.API_ENDPOINT + url
+    def request(self, method, url, body=None, stream=False):
+        if not url.lower().startswith(('https://', 'http://')):
+            url = self.API_ENDPOINT + url
         params = {}
+        upload_size = 0
         if isinstance(body, dict):
             if body:
                 params['json'] = body
         elif body:
+            # body 也可以是文件对象, 此时 requests 会分块读取并上传
             params['data'] = body
+            if hasattr(body, 'fileno'):
+                upload_size = os.fstat(body.fileno()).st_size
+            else:
+                upload_size = len(body)
 
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(self.key, upload_size)
+        if self.session_pool is not None:
+            self.session_pool.count_request()
+        import requests  # 在第一次请求时才导入, 使不发请求的命令启动更快
         try:
-            response = self.session.request(method, url, timeout=120.0, **params)
+            response = self.session.request(method, url, timeout=120.0,
+                                            stream=stream, **params)
         except requests.exceptions.Timeout as err:
             LOGGER.error('连接服务器超时 (' + str(err) + ')')
             raise ConnectionError(str(err))
@@ -69,10 +106,16 @@ class TinifyCliClient(object):
                     'message': 'Error while parsing response: {0}'.format(err),
                     'error': 'ParseError'
                 }
-            raise Error.create(details.get('message'), \
+            err = Error.create(details.get('message'), \
                     details.get('error'), \
                     response.status_code)
+            if isinstance(err, ServerError) and \
+                    self.rate_limiter is not None:
+                self.rate_limiter.on_throttled()
+            raise err
 
+        if self.rate_limiter is not None:
+            self.rate_limiter.on_success()
         return response
 
     def validate(self):
@@ -92,27 +135,86 @@ class TinifyCliClient(object):
                 break
         return '%.1f%s' % (bytes_num, unit)
 
-    @tracecall
-    def compress(self, src, dest, resize=None):
-        filename = os.path.basename(src)
+    def _iter_chunks(self, response, waits=None):
+        ''' 分块读取响应体. 给出 waits 时, 把等待数据的秒数加到 waits[0] '''
+        chunks = response.iter_content(CHUNK_SIZE)
+        if waits is not None:
+            chunks = _timed_iter(chunks, waits)
+        for chunk in chunks:
+            if self.rate_limiter is not None:
+                self.rate_limiter.consume_download(self.key, len(chunk))
+            self.bytes_down += len(chunk)
+            yield chunk
+
+    def _save_response(self, response, dest, waits=None):
+        ''' 把响应体分块写入 dest , 返回写入的字节数.
+        无论图片多大, 内存中只有一个块. '''
+        try:
+            return write_atomically(self._iter_chunks(response, waits), dest,
+                                    self.syncer)
+        finally:
+            response.close()
 
+    def shrink(self, src, data=None):
+        ''' 上传 src , 返回 (输出地址, 服务器返回的 JSON) .
+        给出 data 时上传 data (已经读入内存的 src 的内容). '''
         LOGGER.debug("上传 " + src)
-        # 上传
-        with open(src, 'rb') as fp:
-            image_bin = fp.read()
-        self.src_size = len(image_bin)
-        response = self.request('POST', '/shrink', image_bin)
+        prof = profiler.PROFILER
+        if data is not None:
+            self.src_size = len(data)
+            body = data if prof is None else \
+                    profiler.TinifyCliTimedBody(data, self.src_size)
+            start_time = time.time()
+            response = self.request('POST', '/shrink', body)
+            self.shrink_time = time.time() - start_time
+        else:
+            # 上传, 直接把文件对象交给 requests 分块发送
+            with open(src, 'rb') as fp:
+                self.src_size = os.fstat(fp.fileno()).st_size
+                body = fp if prof is None else \
+                        profiler.TinifyCliTimedBody(fp, self.src_size)
+                start_time = time.time()
+                response = self.request('POST', '/shrink', body)
+                self.shrink_time = time.time() - start_time
+        if prof is not None:
+            # 读完最后一块之后是等待服务器压缩的时间
+            end_time = start_time + self.shrink_time
+            upload_end = body.finished_at or end_time
+            prof.record('upload', start_time, upload_end)
+            prof.record('server', upload_end, end_time)
+        self.bytes_up += self.src_size
 
         download_url = response.headers.get('location')
         r = response.json()
 
         LOGGER.debug('返回的 JSON 为 : ' + str(r))
+        return download_url, r
 
+    def is_not_smaller(self, info, resize=None):
+        ''' 不调整尺寸, 并且据服务器返回的 JSON , 压缩后没有变小. 这时不必
+        下载结果, 直接使用原图即可 (见 place_original). '''
+        if resize is not None or self.src_size is None:
+            return False
+        size = (info or {}).get('output', {}).get('size')
+        return size is not None and size >= self.src_size
+
+    def place_original(self, src, dest):
+        ''' 把原图放到 dest , 返回其大小 '''
+        start_time = time.time()
+        method = place_file(src, dest, self.syncer)
+        if profiler.PROFILER is not None:
+            profiler.PROFILER.record('write', start_time, time.time())
+        LOGGER.info('文件 ' + os.path.basename(src) + ' 压缩后没有变小, ' +
+                    '直接使用原图 (' + method + ')')
+        return self.src_size
+
+    def open_output(self, download_url, resize=None):
+        ''' 请求输出地址上 (按 resize 调整尺寸后的) 图片, 返回尚未读取
+        响应体的响应 '''
         LOGGER.debug('下载 ' + download_url)
         # 处理尺寸问题 & 下载
         if resize is None:  # 压缩但不改变尺寸
-            response = self.request('GET', download_url)
-            image_bin = response.content
+            response = self.request('GET', download_url, stream=True)
         else:  # 压缩且改变尺寸
             method, width, height = resize
             payload = {"resize": {"method": method}}
@@ -120,31 +222,137 @@ class TinifyCliClient(object):
                 payload['resize']['width'] = width
             if height is not None:
                 payload['resize']['height'] = height
-            response = self.request('GET', download_url, body=payload)
-
-            LOGGER.debug('保存到文件 ' + dest)
-            image_bin = response.content
+            response = self.request('GET', download_url, body=payload,
+                                    stream=True)
 
         LOGGER.debug('Response 的 Header : ' + str(response.headers))
+        return response
 
-        self.dest_size = len(image_bin)
-        with open(dest, 'wb') as fp:
-            fp.write(image_bin)
+    def fetch(self, download_url, dest, resize=None):
+        ''' 从输出地址下载 (按 resize 调整尺寸后的) 图片并保存到 dest ,
+        返回 (图片大小, 响应) '''
+        prof = profiler.PROFILER
+        start_time = time.time()
+        response = self.open_output(download_url, resize)
+        LOGGER.debug('保存到文件 ' + dest)
+        if prof is None:
+            return self._save_response(response, dest), response
+        # 边下载边写入, 等待数据的时间计为下载, 其余计为写入
+        waits = [time.time() - start_time]
+        dest_size = self._save_response(response, dest, waits)
+        download_end = start_time + waits[0]
+        prof.record('download', start_time, download_end)
+        prof.record('write', download_end, time.time())
+        return dest_size, response
 
-        LOGGER.info('文件 ' + filename +
-                    ' (' + str(r['output']['width']) + 'x' +
-                    str(r['output']['height']) + ') ' +
+    def fetch_temp(self, download_url, dest, resize=None):
+        ''' 与 fetch 相同, 但只写到 dest 所在目录的临时文件, 返回 (临时文件
+        的路径, 图片大小, 响应) . 由调用者决定何时改名为 dest (见
+        output.commit_temp). '''
+        prof = profiler.PROFILER
+        start_time = time.time()
+        response = self.open_output(download_url, resize)
+        waits = None if prof is None else [time.time() - start_time]
+        try:
+            temp_path, size = write_temp(self._iter_chunks(response, waits),
+                                         dest, self.syncer)
+        finally:
+            response.close()
+        if prof is not None:
+            download_end = start_time + waits[0]
+            prof.record('download', start_time, download_end)
+            prof.record('write', download_end, time.time())
+        return temp_path, size, response
+
+    def _log_result(self, src, width, height, dest_size):
+        LOGGER.info('文件 ' + os.path.basename(src) +
+                    ' (' + str(width) + 'x' + str(height) + ') ' +
                     self._append_unit_suffix(self.src_size) + ' => ' +
-                    self._append_unit_suffix(self.dest_size) + ' ' +
-                    '压缩比: ' + 
-                    '%.1f' % (100.0*self.dest_size/self.src_size) + '%')
+                    self._append_unit_suffix(dest_size) + ' ' +
+                    '压缩比: ' +
+                    '%.1f' % (100.0*dest_size/self.src_size) + '%')
+
+    @tracecall
+    def compress(self, src, dest, resize=None, shrunk=None):
+        ''' 上传 src 并把结果保存到 dest . shrunk 为之前上传得到的
+        (输出地址, 服务器返回的 JSON) 时不再上传. '''
+        download_url, r = shrunk or self.shrink(src)
+
+        start_time = time.time()
+        if self.is_not_smaller(r, resize):
+            self.dest_size = self.place_original(src, dest)
+            headers = {}
+        else:
+            self.dest_size, response = self.fetch(download_url, dest, resize)
+            headers = response.headers
+        self.download_time = time.time() - start_time
+
+        self.image_width = headers.get('image-width', r['output']['width'])
+        self.image_height = headers.get('image-height',
+                                        r['output']['height'])
+        self._log_result(src, self.image_width, self.image_height,
+                         self.dest_size)
+
+    @tracecall
+    def compress_variants(self, src, outputs, shrunk=None):
+        ''' 只上传一次 src , 然后同时下载多个不同尺寸的结果.
+        outputs 是 (dest, resize) 的 list , shrunk 同 compress . '''
+        download_url, r = shrunk or self.shrink(src)
+
+        start_time = time.time()
+        results = [None] * len(outputs)
+
+        def fetch_one(index):
+            dest, resize = outputs[index]
+            try:
+                results[index] = self.fetch(download_url, dest, resize)
+            except Exception as err:
+                results[index] = err
+
+        threads = [threading.Thread(target=fetch_one, args=(index, ),
+                                    name='variant-' + str(index))
+                   for index in range(len(outputs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.download_time = time.time() - start_time
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        self.dest_size = 0
+        for (dest, _), (dest_size, response) in zip(outputs, results):
+            self.dest_size += dest_size
+            self._log_result(dest,
+                             response.headers.get('image-width', '?'),
+                             response.headers.get('image-height', '?'),
+                             dest_size)
+
+def _timed_iter(iterable, waits):
+    ''' 依次产生 iterable 的各项, 把等待每一项的秒数加到 waits[0] '''
+    iterator = iter(iterable)
+    while True:
+        start_time = time.time()
+        try:
+            item = next(iterator)
+        finally:
+            waits[0] += time.time() - start_time
+        yield item
 
 class Error(Exception):
     @staticmethod
     def create(message, kind, status):
         klass = None
-        if status == 401 or status == 429:
+        if status == 401:
             klass = AccountError
+        elif status == 429:
+            # 429 既可能是本月用量耗尽, 也可能只是请求太频繁,
+            # 后者稍后重试即可, 不能因此移除 Key
+            if message and 'exceeded' in message:
+                klass = AccountError
+            else:
+                klass = RateLimitError
         elif status >= 400 and status <= 499:
             klass = ClientError
         elif status >= 400 and status < 599:
@@ -172,5 +380,6 @@ class Error(Exception):
 class AccountError(Error): pass
 class ClientError(Error): pass
 class ServerError(Error): pass
+class RateLimitError(ServerError): pass
 class ConnectionError(Error): pass
 
@@ -0,0 +1,177 @@
+# coding=utf-8
+
+'''
+吞吐量基准测试
+~~~~~~~~~~~~~~
+
+在本地启动 mock_server , 然后以不同的并发数, 引擎和图片大小运行 tinify-cli ,
+测量每秒处理的图片数, 压缩与下载延迟的百分位数, 以及 tinify-cli 进程的峰值
+内存. 每次性能相关的改动都可以用它来对比.
+
+用法::
+
+    $ python -m tinifycli.benchmark --threads 1,4,16 --engines thread,async \\
+          --sizes 100K,2M --images 200 --latency 0.1
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from prettytable import PrettyTable
+
+from .mock_server import MockTinifyServer
+
+CLI_COMMAND = [sys.executable, '-c', 'import tinifycli; tinifycli.main()']
+
+def parse_size(text):
+    ''' 把 "100K" , "2M" 这样的字符串转换为字节数 '''
+    units = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+    text = text.strip().upper().rstrip('B').rstrip('I')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def make_images(directory, count, size):
+    ''' 在 directory 下生成 count 张大小为 size 的 "图片" '''
+    os.makedirs(directory)
+    for i in range(count):
+        with open(os.path.join(directory, 'img%05d.png' % i), 'wb') as fp:
+            fp.write(os.urandom(size))
+
+def run_cli(args, workdir):
+    ''' 运行一次 tinify-cli , 返回 (退出码, 用时, 峰值内存的字节数) '''
+    with open(os.path.join(workdir, 'cli.log'), 'ab') as log:
+        start_time = time.time()
+        process = subprocess.Popen(CLI_COMMAND + args,
+                                   stdout=log, stderr=log)
+        _, status, rusage = os.wait4(process.pid, 0)
+        elapsed = time.time() - start_time
+    process.returncode = status
+    peak_rss = rusage.ru_maxrss
+    if platform.system() != 'Darwin':
+        peak_rss *= 1024  # Linux 上 ru_maxrss 的单位是 KiB
+    return os.WEXITSTATUS(status), elapsed, peak_rss
+
+def run_case(endpoint, workdir, src_dir, engine, concurrency):
+    dest_dir = tempfile.mkdtemp(dir=workdir)
+    summary_path = os.path.join(dest_dir, 'summary.json')
+    key_path = os.path.join(workdir, 'keys')
+    args = [src_dir, '-o', dest_dir, '-K', key_path,
+            '--api-endpoint', endpoint, '--no-validate', '--key-quota', '0',
+            '--progress-interval', '0', '--summary-json', summary_path,
+            '--engine', engine]
+    if engine == 'async':
+        args += ['--max-inflight', str(concurrency)]
+    else:
+        args += ['-t', str(concurrency)]
+    status, elapsed, peak_rss = run_cli(args, workdir)
+    summary = {}
+    if os.path.exists(summary_path):
+        with open(summary_path) as fp:
+            summary = json.load(fp)
+    shutil.rmtree(dest_dir)
+    return {
+        'engine': engine,
+        'concurrency': concurrency,
+        'status': status,
+        'elapsed': elapsed,
+        'peak_rss': peak_rss,
+        'images': summary.get('done', 0),
+        'images_per_second': summary.get('done', 0) / elapsed,
+        'shrink_latency': summary.get('shrink_latency', {}),
+        'download_latency': summary.get('download_latency', {}),
+    }
+
+def _format_latency(latency):
+    values = [latency.get(p) for p in ('p50', 'p95', 'p99')]
+    if None in values:
+        return '-'
+    return '/'.join('%.3f' % value for value in values)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=u'tinify-cli 吞吐量基准测试',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog='python -m tinifycli.benchmark')
+    parser.add_argument('--images', default=100, type=int,
+                        help=u'每种大小的图片数量')
+    parser.add_argument('--sizes', default='100K,1M',
+                        help=u'图片大小, 以逗号分隔')
+    parser.add_argument('--threads', default='1,4,16',
+                        help=u'并发数, 以逗号分隔')
+    parser.add_argument('--engines', default='thread',
+                        help=u'引擎, 以逗号分隔')
+    parser.add_argument('--keys', default=4, type=int,
+                        help=u'使用的 Key 的数量')
+    parser.add_argument('--latency', default=0.1, type=float,
+                        help=u'模拟服务器处理每张图片所用的秒数')
+    parser.add_argument('--bandwidth', default=0, type=int,
+                        help=u'模拟服务器每个连接每秒可传输的字节数')
+    parser.add_argument('--error-rate', default=0.0, type=float,
+                        help=u'模拟服务器返回 503 的概率')
+    parser.add_argument('--output', default=None,
+                        help=u'把结果以 JSON 格式写入此文件')
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    threads = [int(thread) for thread in args.threads.split(',')]
+    engines = args.engines.split(',')
+
+    server = MockTinifyServer(('127.0.0.1', 0), monthly_limit=0,
+                              latency=args.latency,
+                              bandwidth=args.bandwidth,
+                              error_rate=args.error_rate)
+    endpoint = server.start()
+
+    workdir = tempfile.mkdtemp(prefix='tinify-cli-benchmark-')
+    results = []
+    try:
+        with open(os.path.join(workdir, 'keys'), 'w') as fp:
+            for i in range(args.keys):
+                fp.write('benchmark-key-%d\n' % i)
+        for size in sizes:
+            src_dir = os.path.join(workdir, 'src-%d' % size)
+            make_images(src_dir, args.images, size)
+            for engine in engines:
+                for concurrency in threads:
+                    result = run_case(endpoint, workdir, src_dir,
+                                      engine, concurrency)
+                    result['size'] = size
+                    results.append(result)
+                    sys.stderr.write('.')
+        sys.stderr.write('\n')
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+    table = PrettyTable()
+    table.field_names = ['引擎', '并发数', '大小', '张数', '用时 (秒)',
+                         '张/秒', '压缩延迟 p50/p95/p99', '下载延迟 p50/p95/p99',
+                         '峰值内存 (MiB)', '退出码']
+    for result in results:
+        table.add_row([result['engine'], result['concurrency'],
+                       result['size'], result['images'],
+                       '%.2f' % result['elapsed'],
+                       '%.1f' % result['images_per_second'],
+                       _format_latency(result['shrink_latency']),
+                       _format_latency(result['download_latency']),
+                       '%.1f' % (result['peak_rss'] / 1024.0 / 1024.0),
+                       result['status']])
+    sys.stdout.write(table.get_string().encode('utf-8') + '\n')
+
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    if any(result['status'] != 0 for result in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+# coding=utf-8
+
+''' 按内容哈希缓存压缩结果 '''
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from .output import place_file, write_atomically
+
+LOGGER = logging.getLogger('tinify-cli')
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+# file_digest 记住的哈希的条数上限, 超过后清空重来
+MAX_DIGESTS = 65536
+
+_digests = {}  # 路径 => (大小, 修改时间, SHA-1)
+_digests_lock = threading.Lock()
+
+def hash_file(path, extra=None):
+    ''' 计算文件内容 (以及附加参数 extra) 的 SHA-1 '''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        while True:
+            chunk = fp.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    if extra is not None:
+        sha1.update(repr(extra))
+    return sha1.hexdigest()
+
+def file_digest(path, data=None):
+    ''' 文件内容的 SHA-1 . 同一次运行中, 大小和修改时间都没有变化的文件
+    只计算一次, 供缓存, 清单和输出地址库共用. data 为已经读入内存的文件
+    内容, 给出时不再读文件. '''
+    st = os.stat(path)
+    with _digests_lock:
+        cached = _digests.get(path)
+    if cached is not None and cached[:2] == (st.st_size, st.st_mtime):
+        return cached[2]
+    if data is not None:
+        digest = hashlib.sha1(data).hexdigest()
+    else:
+        digest = hash_file(path)
+    with _digests_lock:
+        if len(_digests) >= MAX_DIGESTS:
+            _digests.clear()
+        _digests[path] = (st.st_size, st.st_mtime, digest)
+    return digest
+
+class TinifyCliResultCache(object):
+    ''' 磁盘上的压缩结果缓存.
+
+    以源文件内容和尺寸调整参数的哈希为键, 命中时直接把缓存的结果放到目标
+    位置, 不再请求 API . 缓存总大小超过上限时, 按最近使用时间淘汰到上限的
+    LOW_WATER 倍, 之后的若干次写入都不必再淘汰.
+
+    各条目的大小和最近使用的先后在内存中维护, 淘汰时不必遍历缓存目录.
+    最近使用时间保存在缓存目录的 INDEX_FILENAME 中, 不修改缓存文件本身的
+    修改时间 (条目可能与用户的输出文件是同一个硬链接); 没有记录的条目按
+    写入缓存的时间算.
+    '''
+
+    INDEX_FILENAME = '.index.json'
+    LOW_WATER = 0.9
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_bytes = 0
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        self.index_path = os.path.join(self.cache_dir, self.INDEX_FILENAME)
+        # 缓存键 => 大小, 从最久未使用到最近使用排列
+        self.entries = collections.OrderedDict()
+        self.used_at = {}  # 缓存键 => 最近使用的时间
+        self.total_size = 0
+        self.dirty = False
+        self._load_index()
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.startswith('.'):
+                    yield os.path.join(dirpath, filename)
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as fp:
+                used_at = json.load(fp)
+        except (IOError, ValueError):
+            used_at = {}
+        if not isinstance(used_at, dict):
+            used_at = {}
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            cache_key = os.path.basename(path)
+            entries.append((used_at.get(cache_key, stat.st_mtime), cache_key,
+                            stat.st_size))
+        entries.sort()
+        for used_at, cache_key, size in entries:
+            self.entries[cache_key] = size
+            self.used_at[cache_key] = used_at
+            self.total_size += size
+
+    def _path(self, cache_key):
+        return os.path.join(self.cache_dir, cache_key[:2], cache_key)
+
+    @staticmethod
+    def make_key(src, resize):
+        ''' 与 make_keys 的结果一致, 内容哈希与清单等共用 '''
+        return hashlib.sha1(file_digest(src) + repr(resize)).hexdigest()
+
+    @staticmethod
+    def make_keys(src, resizes):
+        ''' 同一个源文件不同尺寸的键, 源文件只读一次 '''
+        digest = file_digest(src)
+        return [hashlib.sha1(digest + repr(resize)).hexdigest()
+                for resize in resizes]
+
+    def _touch(self, cache_key, size):
+        ''' 把条目移到最近使用的一端, 须持有 self.lock '''
+        self.total_size += size - self.entries.pop(cache_key, 0)
+        self.entries[cache_key] = size
+        self.used_at[cache_key] = time.time()
+        self.dirty = True
+
+    def _forget(self, cache_key):
+        ''' 从索引中删除条目, 须持有 self.lock '''
+        self.total_size -= self.entries.pop(cache_key, 0)
+        self.used_at.pop(cache_key, None)
+        self.dirty = True
+
+    def lookup(self, cache_key, dest, syncer=None):
+        ''' 命中时把结果放到 dest 并返回 True '''
+        path = self._path(cache_key)
+        # 未命中时不必尝试放置文件; 其他进程可能写入了同一个缓存目录,
+        # 所以看文件是否存在而不是看内存中的索引
+        hit = os.path.exists(path)
+        if hit:
+            try:
+                place_file(path, dest, syncer)
+                size = os.path.getsize(dest)
+            except (OSError, IOError):
+                hit = False  # 刚好被其他进程淘汰了
+        if not hit:
+            with self.lock:
+                self.misses += 1
+                if cache_key in self.entries and not os.path.exists(path):
+                    self._forget(cache_key)  # 被其他进程淘汰了
+            return False
+        with self.lock:
+            self.hits += 1
+            self.saved_bytes += size
+            self._touch(cache_key, size)
+        return True
+
+    def store(self, cache_key, output):
+        ''' 把压缩结果 output 存入缓存 '''
+        path = self._path(cache_key)
+        if not os.path.exists(path):
+            entry_dir = os.path.dirname(path)
+            try:
+                if not os.path.isdir(entry_dir):
+                    os.makedirs(entry_dir)
+                place_file(output, path)
+            except (OSError, IOError) as err:
+                LOGGER.warn('无法写入缓存 ' + path + ' (' + str(err) + ')')
+                return
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self.lock:
+            self._touch(cache_key, size)
+            if self.total_size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        ''' 从最久未使用的一端删除, 直到总大小降到上限的 LOW_WATER 倍,
+        须持有 self.lock '''
+        target = self.max_size * self.LOW_WATER
+        while self.entries and self.total_size > target:
+            cache_key, size = self.entries.popitem(last=False)
+            self.used_at.pop(cache_key, None)
+            self.total_size -= size
+            try:
+                os.remove(self._path(cache_key))
+            except OSError:
+                pass  # 已经被其他进程淘汰了
+            LOGGER.debug('从缓存中淘汰 ' + cache_key)
+        self.dirty = True
+
+    def flush(self):
+        ''' 把最近使用时间写入索引文件 '''
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self.used_at)
+            self.dirty = False
+        try:
+            write_atomically([data], self.index_path)
+        except (IOError, OSError) as err:
+            LOGGER.warn('无法写入缓存索引 ' + self.index_path +
+                        ' (' + str(err) + ')')
+
+    def log_stats(self):
+        LOGGER.info('缓存命中 ' + str(self.hits) + ' 次 (共 ' +
+                    str(self.saved_bytes) + ' 字节), 未命中 ' +
+                    str(self.misses) + ' 次')
@@ -0,0 +1,248 @@
+# coding=utf-8
+
+''' 供其他 Python 程序使用的接口
+
+    >>> from tinifycli.compressor import TinifyCliCompressor
+    >>> compressor = TinifyCliCompressor(['API Key'], concurrency=8)
+    >>> for result in compressor.compress([('a.png', 'a-min.png'),
+    ...                                    ('b.jpg', 'b-min.jpg')]):
+    ...     print result.src, result.ok, result.ratio
+    >>> compressor.close()
+
+与命令行不同, 这里不使用 shared_var 中的任何全局状态, 不安装信号处理函数,
+也不会调用 sys.exit . 每个 TinifyCliCompressor 有自己的 Key 箱, 连接池和
+限速器, 可以在多个线程中同时调用它的 compress 和 compress_one .
+'''
+
+import logging
+import Queue
+import threading
+import time
+
+from . import api
+from .key_holder import TinifyCliKeyHolder, EmptyKeyHolderException
+from .ratelimit import TinifyCliRateLimiter
+from .retry import TinifyCliRetryPolicy
+from .session_pool import TinifyCliSessionPool, connections_per_key
+from .output import TinifyCliDirSyncer
+
+LOGGER = logging.getLogger('tinify-cli')
+
+class TinifyCliResult(object):
+    ''' 一张图片的处理结果 '''
+
+    def __init__(self, src, dest, resize):
+        self.src = src
+        self.dest = dest  # 多尺寸输出时为 tuple
+        self.resize = resize
+        self.error = None  # 失败时为最后一次的异常
+        self.attempts = 0  # 一共尝试的次数
+        self.key = None
+        self.src_size = None
+        self.dest_size = None  # 多尺寸输出时为全部输出的大小之和
+        self.width = None  # 多尺寸输出时为 None
+        self.height = None
+        self.shrink_time = None  # 上传并等待服务器压缩所用的秒数
+        self.download_time = None  # 下载并写入文件所用的秒数
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def ratio(self):
+        ''' 压缩后与压缩前的大小之比, 失败时为 None '''
+        if not self.ok or not self.src_size:
+            return None
+        return float(self.dest_size) / self.src_size
+
+    def __repr__(self):
+        if self.ok:
+            return '<TinifyCliResult ' + repr(self.src) + ' ' + \
+                    str(self.src_size) + ' => ' + str(self.dest_size) + '>'
+        return '<TinifyCliResult ' + repr(self.src) + ' failed: ' + \
+                repr(self.error) + '>'
+
+class TinifyCliCompressor(object):
+    ''' 持有 Key 箱, 连接池, 限速器和配置, 压缩一批或一张图片.
+
+    keys 是 API Key 的 list , 不事先验证, 失效的 Key 在第一次请求失败时
+    被移除. 没有可用的 Key 时 compress 和 compress_one 抛出
+    EmptyKeyHolderException . 限速参数的含义与命令行的 --max-rps 等相同,
+    0 表示不限. monthly_quota 与 --key-quota 相同, 默认 0 不限次数.
+    fsync 为 True 时与命令行的 --fsync 相同. max_variants 是一个任务最多
+    输出的尺寸数, 用于确定每个 Key 的连接池大小.
+    '''
+
+    def __init__(self, keys, concurrency=4, api_endpoint=None,
+                 monthly_quota=0,
+                 max_rps=0, max_upload=0, max_download=0,
+                 key_max_rps=0, key_max_upload=0, key_max_download=0,
+                 retry_policy=None, fsync=False, max_variants=1):
+        self.concurrency = max(int(concurrency), 1)
+        self.api_endpoint = api_endpoint
+        self.key_holder = TinifyCliKeyHolder()
+        self.key_holder.MONTHLY_QUOTA = monthly_quota
+        self.key_holder.add_keys(keys)
+        self.session_pool = TinifyCliSessionPool(
+            connections_per_key(self.concurrency, max_variants),
+            api.TinifyCliClient.USER_AGENT)
+        self.rate_limiter = TinifyCliRateLimiter(
+            max_rps, max_upload, max_download,
+            key_max_rps, key_max_upload, key_max_download)
+        self.retry_policy = retry_policy or TinifyCliRetryPolicy()
+        self.syncer = TinifyCliDirSyncer() if fsync else None
+
+    def compress_one(self, src, dest, resize=None):
+        ''' 压缩一张图片, 失败时按重试策略重试, 返回 TinifyCliResult .
+        dest 为 tuple 时一次上传输出多个尺寸, resize 为对应的
+        (method, width, height) 的 tuple . '''
+        result = TinifyCliResult(src, dest, resize)
+        while True:
+            result.attempts += 1
+            reason = self._attempt(result)
+            if reason is None:
+                result.error = None
+                return result
+            if not self.retry_policy.should_retry(reason, result.attempts):
+                return result
+            time.sleep(self.retry_policy.delay(reason, result.attempts))
+
+    def _attempt(self, result):
+        ''' 尝试一次, 成功时返回 None , 否则返回失败原因 '''
+        key = self.key_holder.acquire_key()
+        tinify = api.TinifyCliClient(key, self.session_pool,
+                                     self.rate_limiter, self.api_endpoint,
+                                     self.syncer)
+        try:
+            if isinstance(result.dest, tuple):
+                tinify.compress_variants(result.src,
+                                         zip(result.dest, result.resize))
+            else:
+                tinify.compress(result.src, result.dest, result.resize)
+        except api.Error as err:
+            result.error = err
+            if isinstance(err, api.AccountError):
+                LOGGER.warn('Key ' + key + ' 不正确或用量耗尽, 移除本 Key')
+                self.key_holder.remove_key(key, err)
+                return 'accountError'
+            if isinstance(err, api.ConnectionError):
+                return 'netError'
+            if isinstance(err, api.ClientError):
+                return 'clientError'
+            if isinstance(err, api.RateLimitError):
+                return 'rateLimited'
+            return 'serverError'
+        except (IOError, OSError) as err:
+            result.error = err  # 读写本地文件出错, 不重试
+            return 'localError'
+        except Exception as err:
+            # 例如服务器的响应缺少字段. 不重试
+            LOGGER.exception('压缩 ' + repr(result.src) + ' 时出错')
+            result.error = err
+            return 'internalError'
+        finally:
+            self.key_holder.release_key(key, tinify.compression_count)
+        result.key = key
+        result.src_size = tinify.src_size
+        result.dest_size = tinify.dest_size
+        result.width = tinify.image_width
+        result.height = tinify.image_height
+        result.shrink_time = tinify.shrink_time
+        result.download_time = tinify.download_time
+        return None
+
+    def compress(self, tasks):
+        ''' 用 concurrency 个线程压缩 tasks 中的图片, 按完成的先后产生
+        TinifyCliResult . tasks 的每一项为 (源文件, 目标文件) 或
+        (源文件, 目标文件, 尺寸参数), 一边读取一边处理. 提前停止迭代时,
+        等已经开始的任务做完再返回. '''
+        task_queue = Queue.Queue(self.concurrency * 2)
+        result_queue = Queue.Queue()
+        stopped = threading.Event()
+        state = {'error': None}
+
+        def feed():
+            try:
+                for task in tasks:
+                    while not stopped.is_set():
+                        try:
+                            task_queue.put(task, timeout=1)
+                            break
+                        except Queue.Full:
+                            pass
+                    if stopped.is_set():
+                        break
+            except Exception as err:
+                state['error'] = err  # 读取 tasks 时出错, 交给调用者
+            finally:
+                for _ in range(self.concurrency):
+                    while not stopped.is_set():
+                        try:
+                            task_queue.put(None, timeout=1)
+                            break
+                        except Queue.Full:
+                            pass
+
+        def work():
+            try:
+                while not stopped.is_set():
+                    try:
+                        task = task_queue.get(timeout=1)
+                    except Queue.Empty:
+                        continue
+                    if task is None:
+                        return
+                    src = dest = resize = None
+                    try:
+                        src, dest = task[:2]
+                        resize = task[2] if len(task) > 2 else None
+                        result = self.compress_one(src, dest, resize)
+                    except EmptyKeyHolderException as err:
+                        state['error'] = err
+                        stopped.set()
+                        continue
+                    except Exception as err:
+                        # 一个任务出错时记为失败, 工作线程继续处理后面的任务
+                        LOGGER.exception('处理 ' + repr(task) + ' 时出错')
+                        result = TinifyCliResult(src, dest, resize)
+                        result.error = err
+                    result_queue.put(result)
+            finally:
+                result_queue.put(None)
+
+        feeder = threading.Thread(target=feed, name='compressor-feed')
+        workers = [threading.Thread(target=work, name='compressor-' + str(i))
+                   for i in range(self.concurrency)]
+        for thread in [feeder] + workers:
+            thread.setDaemon(True)
+            thread.start()
+
+        running = self.concurrency
+        try:
+            while running > 0:
+                result = result_queue.get()
+                if result is None:
+                    running -= 1
+                else:
+                    yield result
+        finally:
+            stopped.set()
+            # 不等待 feeder , 它可能正阻塞在调用者的 tasks 上
+            for thread in workers:
+                thread.join()
+            if self.syncer is not None:
+                self.syncer.flush()
+        if state['error'] is not None:
+            raise state['error']
+
+    def close(self):
+        if self.syncer is not None:
+            self.syncer.flush()
+        self.session_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,153 @@
+# coding=utf-8
+
+''' 自适应并发数 (--thread-num auto) '''
+
+import collections
+import logging
+import math
+import threading
+import time
+
+LOGGER = logging.getLogger('tinify-cli')
+
+class TinifyCliConcurrencyController(object):
+    ''' 根据观测到的任务延迟, 在运行中调整同时进行的任务数.
+
+    算法类似于基于延迟梯度的拥塞控制: 分别维护短期 (最近一个窗口) 的任务
+    延迟和基准延迟 (没有排队时的延迟). 短期延迟没有明显高于基准延迟时,
+    说明带宽和服务器还有余量, 并发数按 sqrt(并发数) 增加; 短期延迟升高时
+    并发数按基准延迟 / 短期延迟的比例减小. 服务器返回错误或要求降速时并发数
+    直接乘以 DECREASE_FACTOR . 开始时处于慢启动阶段, 延迟升高或出错之前
+    每个窗口把并发数翻倍.
+
+    基准延迟不能跟着短期延迟上升, 否则带宽饱和后延迟平稳上升时, 并发数会
+    一直增加到上限. 所以它只在短期延迟更低时下降; 每隔 PROBE_INTERVAL 个
+    窗口用一个并发数减半的窗口重新测量 (图片变大等原因也会使基准延迟升高).
+    '''
+
+    WINDOW = 1.0  # 每隔多少秒调整一次
+    MIN_SAMPLES = 4  # 窗口内至少完成这么多任务才调整
+    TOLERANCE = 1.5  # 短期延迟超过长期延迟的这么多倍时才减小并发数
+    PROBE_INTERVAL = 20  # 每隔这么多个窗口重新测量一次基准延迟
+    PROBE_FACTOR = 0.5  # 测量基准延迟时并发数乘以这个比例
+    SMOOTHING = 0.2  # 每次只向新的并发数移动这么多
+    DECREASE_FACTOR = 0.75
+    # 最近这么多个窗口的并发数相差不超过 SETTLE_SPREAD 时认为已经稳定
+    SETTLE_WINDOWS = 8
+    SETTLE_SPREAD = 0.25
+    # 会降低并发数的失败原因
+    THROTTLE_REASONS = ('serverError', 'rateLimited', 'netError')
+
+    def __init__(self, max_limit, initial_limit=4, min_limit=1):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.peak_limit = self.limit
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.active = 0
+        self.slow_start = True
+
+        self.window_start = time.time()
+        self.window_latencies = []
+        self.window_throttled = False
+        self.base_latency = None
+        self.probe_countdown = self.PROBE_INTERVAL
+        self.probe_saved_limit = None  # 测量基准延迟时, 之后要恢复的并发数
+        self.recent_limits = collections.deque(maxlen=self.SETTLE_WINDOWS)
+        self.settled_limit = None
+
+    def acquire(self, timeout=1):
+        ''' 等待一个名额, 超时返回 False '''
+        with self.cond:
+            if self.active >= int(self.limit):
+                self.cond.wait(timeout)
+                if self.active >= int(self.limit):
+                    return False
+            self.active += 1
+            return True
+
+    def release(self, latency, reason):
+        ''' 一个任务结束, reason 为 "success" 或失败原因. 命中缓存等没有
+        真正请求服务器的任务 latency 为 None , 不计入延迟, 否则基准延迟会
+        被拉低到接近 0 '''
+        with self.cond:
+            self.active -= 1
+            if reason == 'success' and latency is not None:
+                self.window_latencies.append(latency)
+            elif reason in self.THROTTLE_REASONS:
+                self.window_throttled = True
+            now = time.time()
+            if now - self.window_start >= self.WINDOW and \
+                    (self.window_throttled or
+                     len(self.window_latencies) >= self.MIN_SAMPLES):
+                self._adjust()
+                self.window_start = now
+                self.window_latencies = []
+                self.window_throttled = False
+            self.cond.notify_all()
+
+    def _adjust(self):
+        old_limit = self.limit
+        is_probe = self.probe_saved_limit is not None
+        if self.window_throttled:
+            self.slow_start = False
+            if is_probe:
+                self.limit = self.probe_saved_limit
+                self.probe_saved_limit = None
+            new_limit = self.limit * self.DECREASE_FACTOR
+        else:
+            latencies = sorted(self.window_latencies)
+            short_latency = latencies[len(latencies) // 2]
+            if is_probe:
+                # 以较低的并发数测得的延迟作为新的基准, 恢复原来的并发数
+                self.base_latency = short_latency
+                new_limit = self.probe_saved_limit
+                self.probe_saved_limit = None
+            else:
+                if self.base_latency is None or \
+                        short_latency < self.base_latency:
+                    self.base_latency = short_latency
+                new_limit = self._next_limit(short_latency)
+        self.limit = max(self.min_limit, min(self.max_limit, new_limit))
+        if not self.slow_start and not is_probe:
+            self.probe_countdown -= 1
+            if self.probe_countdown <= 0:
+                self.probe_countdown = self.PROBE_INTERVAL
+                self.probe_saved_limit = self.limit
+                self.limit = max(self.min_limit,
+                                 self.limit * self.PROBE_FACTOR)
+        if self.probe_saved_limit is None:
+            self.peak_limit = max(self.peak_limit, self.limit)
+            self._check_settled()
+        if int(self.limit) != int(old_limit):
+            LOGGER.debug('并发数调整为 ' + str(int(self.limit)))
+
+    def _next_limit(self, short_latency):
+        gradient = max(0.5, min(1.0, self.TOLERANCE * self.base_latency /
+                                max(short_latency, 1e-6)))
+        if self.slow_start and gradient >= 1.0:
+            return self.limit * 2
+        self.slow_start = False
+        new_limit = self.limit * gradient + math.sqrt(self.limit)
+        return self.limit * (1 - self.SMOOTHING) + \
+                new_limit * self.SMOOTHING
+
+    def _check_settled(self):
+        self.recent_limits.append(self.limit)
+        if len(self.recent_limits) < self.SETTLE_WINDOWS:
+            return
+        average = sum(self.recent_limits) / len(self.recent_limits)
+        spread = max(self.recent_limits) - min(self.recent_limits)
+        if spread > max(2.0, average * self.SETTLE_SPREAD):
+            return
+        limit = int(round(average))
+        if self.settled_limit is None or \
+                abs(limit - self.settled_limit) > \
+                max(2.0, self.settled_limit * self.SETTLE_SPREAD):
+            self.settled_limit = limit
+            LOGGER.info('并发数稳定在 ' + str(limit) + ' 左右')
+
+    def log_stats(self):
+        LOGGER.info('自动调整的并发数最终为 ' + str(int(self.limit)) +
+                    ', 最高为 ' + str(int(self.peak_limit)))
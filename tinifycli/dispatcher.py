@@ -0,0 +1,253 @@
+# coding=utf-8
+
+''' 任务分发 '''
+
+import heapq
+import itertools
+import logging
+import Queue
+import threading
+import time
+
+from . import engine
+from .key_holder import EmptyKeyHolderException
+from .results import write_result
+from .retry import TinifyCliRetryPolicy, TinifyCliCircuitBreaker
+
+LOGGER = logging.getLogger('tinify-cli')
+
+class TinifyCliDispatcher(object):
+    ''' 边产生任务边分发给工作线程.
+
+    未完成的任务 (排队中的, 执行中的和等待重试的) 最多 queue_size 个, 任务的
+    产生者在达到上限时等待, 所以无论有多少个文件, 内存占用都是平稳的.
+    失败的任务各自按重试策略退避一段时间后重新入队, 在此期间工作线程继续处理
+    其他任务.
+
+    工作线程由 engine.spawn 按 --engine 启动, async 引擎下是协程.
+    给出 controller (TinifyCliConcurrencyController) 时, worker_num 是并发数
+    的上限, 同时执行任务的工作线程数由 controller 在运行中调整.
+
+    drain 之后不再开始新的任务 (排队中和等待重试的任务被放弃), 已经开始的
+    任务继续执行, 全部结束或超过期限后 run 返回.
+    '''
+
+    def __init__(self, worker_num, queue_size, controller=None):
+        self.worker_num = worker_num
+        self.controller = controller
+        self.queue_size = max(queue_size, worker_num)
+        self.queue = Queue.Queue()
+        self.cond = threading.Condition()
+        self.pending = 0  # 已放入队列但尚未完成的任务数
+        self.finished = 0
+        self.failed = 0
+        self.dropped = 0  # drain 之后被放弃的任务数
+        self.stopped = False
+        self.draining = False
+        self.drain_deadline = None
+        self.error = None
+        self.workers = []
+
+        self.retry_policy = TinifyCliRetryPolicy()
+        self.circuit_breaker = TinifyCliCircuitBreaker()
+        self.retry_heap = []  # (重新入队的时间, 序号, 任务, 已失败次数)
+        self.retry_cond = threading.Condition()
+        self.retry_seq = itertools.count()
+        self.retry_stopped = False
+        self.retry_worker = None
+
+    def run(self, tasks, func):
+        ''' 用 worker_num 个工作线程对 tasks 中的每个任务执行 func ,
+        func 返回 ("success", [统计信息]) 或 (失败原因, 任务参数, [错误信息]) .
+        '''
+        self._start_workers(func)
+        self.retry_stopped = False
+        self.retry_worker = engine.spawn('retry', self._retry_loop)
+
+        for task in tasks:
+            with self.cond:
+                while self.pending >= self.queue_size and \
+                        not self.stopped and not self.draining:
+                    # 带超时的等待, 使主线程仍能响应 SIGINT
+                    self.cond.wait(1)
+                if self.stopped or self.draining:
+                    break
+                self.pending += 1
+            self.queue.put((task, 0))
+
+        with self.cond:
+            while self.pending > 0 and not self.stopped:
+                if self.draining and time.time() >= self.drain_deadline:
+                    LOGGER.warning('等待超时, 仍有 ' + str(self.pending) +
+                                   ' 个任务没有完成')
+                    self.stopped = True
+                    break
+                self.cond.wait(1)
+
+        self._stop_workers()
+        self._stop_retry_loop()
+        self.retry_worker.join()
+        if self.error is not None:
+            raise self.error
+        return self.finished
+
+    def _start_workers(self, func):
+        for i in range(self.worker_num):
+            self._start_thread('worker-' + str(i), self._worker, func)
+
+    def _start_thread(self, name, target, *args):
+        # async 引擎下每个工作单元是一个协程
+        self.workers.append(engine.spawn(name, target, *args))
+
+    def _stop_workers(self):
+        for _ in self.workers:
+            self.queue.put(None)
+
+    def _task_done(self, is_success):
+        with self.cond:
+            self.pending -= 1
+            if is_success:
+                self.finished += 1
+            else:
+                self.failed += 1
+            self.cond.notify_all()
+
+    def _acquire_slot(self):
+        ''' 等待 controller 的名额, drain 或停止之后返回 False '''
+        while not self.controller.acquire():
+            if self.stopped or self.draining:
+                return False
+        return True
+
+    @staticmethod
+    def _latency(ret, start_time):
+        ''' 交给 controller 的任务延迟. 命中缓存和用之前的输出地址完成的
+        任务没有真正上传, 返回 None '''
+        info = ret[1] if ret[0] == 'success' and len(ret) > 1 else None
+        if info and (info.get('cached') or info.get('resumed')):
+            return None
+        return time.time() - start_time
+
+    def _worker(self, func):
+        while True:
+            # 取到任务之后再占用名额, 队列为空时不占用
+            item = self.queue.get()
+            if item is None:
+                return
+            task, attempt = item
+            if self.draining:
+                self._drop(task)
+                continue
+            if self.controller is not None and not self._acquire_slot():
+                if self.stopped:
+                    return
+                self._drop(task)
+                continue
+            self.circuit_breaker.wait()
+            start_time = time.time()
+            ret = ('exception', )
+            try:
+                ret = func(task)
+            except EmptyKeyHolderException as err:
+                self.error = err
+                self.terminate()
+                return
+            except Exception as err:
+                LOGGER.exception('处理任务 ' + repr(task) + ' 时发生了错误')
+                write_result(task, 'failed', error=repr(err))
+                self._task_done(False)
+                continue
+            finally:
+                if self.controller is not None:
+                    self.controller.release(self._latency(ret, start_time),
+                                            ret[0])
+            self._handle_result(task, attempt, ret)
+
+    def _handle_result(self, task, attempt, ret):
+        ''' 任务结束后计数, 或按重试策略安排重试 '''
+        if ret[0] == 'success':
+            self.circuit_breaker.record_success()
+            info = ret[1] if len(ret) > 1 else None
+            write_result(task, 'cached' if info and info.get('cached')
+                         else 'success', info)
+            self._task_done(True)
+            return
+
+        reason = ret[0]
+        if reason == 'serverError':
+            self.circuit_breaker.record_failure()
+        attempt += 1
+        if self.retry_policy.should_retry(reason, attempt):
+            delay = self.retry_policy.delay(reason, attempt)
+            LOGGER.debug('任务失败 (' + reason + '), ' +
+                         '%.1f' % delay + ' 秒后第 ' + str(attempt) +
+                         ' 次重试')
+            self._schedule_retry(task, attempt, delay)
+        else:
+            LOGGER.error('任务 ' + task[0] + ' 失败 ' + str(attempt) +
+                         ' 次 (' + reason + '), 放弃')
+            write_result(task, 'failed',
+                         error=ret[2] if len(ret) > 2 else reason)
+            self._task_done(False)
+
+    def _drop(self, task):
+        ''' drain 之后放弃一个还没有开始的任务 '''
+        write_result(task, 'skipped', error='interrupted')
+        with self.cond:
+            self.pending -= 1
+            self.dropped += 1
+            self.cond.notify_all()
+
+    def _schedule_retry(self, task, attempt, delay):
+        if self.draining:
+            self._drop(task)
+            return
+        if delay <= 0:
+            self.queue.put((task, attempt))
+            return
+        with self.retry_cond:
+            heapq.heappush(self.retry_heap, (time.time() + delay,
+                                             next(self.retry_seq),
+                                             task, attempt))
+            self.retry_cond.notify()
+
+    def _retry_loop(self):
+        ''' 把退避时间已到的任务放回队列 '''
+        while True:
+            with self.retry_cond:
+                while not self.retry_heap and not self.retry_stopped:
+                    self.retry_cond.wait()
+                if self.retry_stopped:
+                    return
+                due = self.retry_heap[0][0] - time.time()
+                if due > 0:
+                    self.retry_cond.wait(due)
+                    continue
+                _, _, task, attempt = heapq.heappop(self.retry_heap)
+            self.queue.put((task, attempt))
+
+    def _stop_retry_loop(self):
+        with self.retry_cond:
+            self.retry_stopped = True
+            self.retry_cond.notify()
+
+    def drain(self, timeout):
+        ''' 不再开始新的任务, 最多再等 timeout 秒让已经开始的任务结束 '''
+        with self.cond:
+            self.draining = True
+            self.drain_deadline = time.time() + timeout
+            self.cond.notify_all()
+        with self.retry_cond:
+            retry_heap = self.retry_heap
+            self.retry_heap = []
+        for _, _, task, _ in retry_heap:
+            self._drop(task)
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self._stop_retry_loop()
@@ -8,6 +8,7 @@ import time
 import threading
 
 from . import shared_var
+from .metrics import TinifyCliMetrics
 
 class TinifyCliDisplay(object):
     def __init__(self, log_to_stderr=False, log_to_file=False):
@@ -40,6 +41,8 @@ class TinifyCliDisplay(object):
                     encoding='utf-8'))
 
         self.mailbox = Queue.Queue()  # for progress_bar_view
+        self.metrics = None
+        self.progress_bar_thread = None
 
     def set_logging_level(self, level):
         '''
@@ -48,12 +51,43 @@ class TinifyCliDisplay(object):
         '''
         self.logger.setLevel(level=eval("logging." + level))
 
-    #def start_progress_bar(self):
-        #self.progress_bar_thread = threading.Thread(
-            #target=self.progress_bar,
-            #name="progress_bar")
-        #self.progress_bar_thread.setDaemon(True)
-        #self.progress_bar_thread.start()
+    def start_progress_bar(self, interval):
+        ''' 启动显示线程, 每隔 interval 秒输出一次进度与吞吐量,
+        interval 为 0 时只汇总不输出 '''
+        self.metrics = TinifyCliMetrics()
+        self.progress_bar_interval = interval
+        self.progress_bar_thread = threading.Thread(
+            target=self.progress_bar,
+            name="progress_bar")
+        self.progress_bar_thread.setDaemon(True)
+        self.progress_bar_thread.start()
 
-    #def progress_bar(self):
-        #pass
+    def stop_progress_bar(self):
+        ''' 停止显示线程, 返回汇总好的 TinifyCliMetrics '''
+        self.mailbox.put(None)
+        self.progress_bar_thread.join()
+        self.metrics.end_time = time.time()
+        return self.metrics
+
+    def progress_bar(self):
+        next_tick = time.time() + (self.progress_bar_interval or 1)
+        while True:
+            try:
+                event = self.mailbox.get(
+                    timeout=max(next_tick - time.time(), 0.01))
+            except Queue.Empty:
+                event = ()
+            if event is None:
+                return
+            if event:
+                self.metrics.handle(event)
+            if time.time() >= next_tick:
+                if self.progress_bar_interval:
+                    self.logger.info(self.metrics.format_status())
+                next_tick = time.time() + (self.progress_bar_interval or 1)
+
+def report(event):
+    ''' 工作线程通过此函数把事件投递给显示线程, 没有显示线程时什么也不做 '''
+    display = shared_var.display
+    if display is not None and display.progress_bar_thread is not None:
+        display.mailbox.put(event)
@@ -0,0 +1,101 @@
+# coding=utf-8
+
+''' 并发引擎
+
+thread 引擎中每个并发请求占用一个线程; async 引擎使用 gevent 的协程,
+在一个线程里同时进行成千上万个传输. 调度器和流水线用 spawn 启动工作单元,
+验证 Key 用 create_pool 创建的池; 两种引擎对外提供同样的接口.
+'''
+
+import logging
+import sys
+import threading
+
+from . import shared_var
+
+LOGGER = logging.getLogger('tinify-cli')
+
+ENGINES = ['thread', 'async']
+
+# --thread-num auto 时 thread 引擎的并发数上限
+AUTO_MAX_THREADS = 64
+
+def setup_engine(engine):
+    ''' 在发出任何网络请求之前调用, 准备好所选的引擎 '''
+    shared_var.engine = engine
+    if engine == 'async':
+        try:
+            from gevent import monkey
+        except ImportError:
+            LOGGER.critical('async 引擎需要 gevent , 请先 pip install gevent')
+            sys.exit(1)
+        # 把 socket, ssl, threading 等替换为协程版本, 之后 requests
+        # 的阻塞调用都只会挂起当前协程
+        monkey.patch_all()
+
+def concurrency():
+    ''' 同时进行中的任务数上限 '''
+    if shared_var.engine == 'async':
+        return shared_var.max_inflight
+    if shared_var.is_auto_concurrency:
+        return AUTO_MAX_THREADS
+    return shared_var.thread_num
+
+def spawn(name, target, *args):
+    ''' 按当前引擎启动一个执行 target(*args) 的工作单元, 返回有 join
+    方法的对象. thread 引擎为守护线程, async 引擎为协程 '''
+    if shared_var.engine == 'async':
+        import gevent
+        worker = gevent.spawn(target, *args)
+        worker.name = name
+        return worker
+    worker = threading.Thread(target=target, args=args, name=name)
+    worker.setDaemon(True)
+    worker.start()
+    return worker
+
+def create_pool(size):
+    ''' 按当前引擎创建一个大小为 size 的池 '''
+    if shared_var.engine == 'async':
+        return GreenletPool(size)
+    from multiprocessing.dummy import Pool as ThreadPool
+    return ThreadPool(size)
+
+class AsyncResult(object):
+    ''' 包装 gevent 的 Greenlet , 提供与 multiprocessing 的 AsyncResult
+    相同的接口 '''
+    def __init__(self, greenlet):
+        self.greenlet = greenlet
+
+    def ready(self):
+        return self.greenlet.ready()
+
+    def wait(self, timeout=None):
+        self.greenlet.join(timeout=timeout)
+
+    def get(self):
+        return self.greenlet.get()
+
+class GreenletPool(object):
+    ''' 以 gevent.pool.Pool 实现的, 接口与 multiprocessing.dummy.Pool
+    相同的协程池, size 即同时进行中的任务数上限 '''
+    def __init__(self, size):
+        import gevent.pool
+        self.pool = gevent.pool.Pool(size)
+
+    def map(self, func, iterable):
+        return self.pool.map(func, iterable)
+
+    def map_async(self, func, iterable):
+        import gevent
+        # 负责 map 的协程不能占用池里的名额, 否则池大小为 1 时会死锁
+        return AsyncResult(gevent.spawn(self.pool.map, func, iterable))
+
+    def close(self):
+        pass
+
+    def join(self):
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.kill()
@@ -0,0 +1,154 @@
+# coding=utf-8
+
+''' 续传日志, 记录已经上传但还没有保存输出的图片 '''
+
+import json
+import logging
+import os
+import threading
+import time
+
+from .output import write_atomically
+
+LOGGER = logging.getLogger('tinify-cli')
+
+RESUME_JOURNAL_FILENAME = '.tinify-cli-resume.json'
+
+def to_str(obj):
+    ''' json 给出的是 unicode , 其余代码中的路径, URL 等都是 str '''
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, dict):
+        return dict((to_str(k), to_str(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [to_str(item) for item in obj]
+    return obj
+
+class TinifyCliResumeJournal(object):
+    ''' 保存在输出目录里的续传日志.
+
+    每上传完一张图片, 在内存中记下服务器给出的输出地址 (Location) , 返回的
+    JSON 和所用 Key 的指纹; 输出保存好之后删除这条记录. 有变化时每隔
+    SAVE_INTERVAL 秒, 以及程序结束时 (包括按 Ctrl+C 中止时), 把还没有完成
+    的记录写入文件, 进程意外退出时最多丢失最近几秒的记录. 下次运行时,
+    源文件的大小和修改时间都没有变化, 且记录不超过 max_age 秒的图片直接
+    从输出地址下载, 不再上传, 从而不再消耗压缩次数.
+    '''
+
+    # 服务器上的输出只保留一段时间, 更早的记录不再使用 (--resume-max-age)
+    MAX_AGE = 3600
+    SAVE_INTERVAL = 5
+
+    def __init__(self, path, max_age=MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # 保证后写入的是较新的记录
+        self.entries = {}  # 源文件路径 => 记录
+        self.dirty = False
+        self.saved_at = time.time()
+        self.resumed = 0
+        self.stale = 0  # 续传时输出地址已经失效, 只好重新上传的次数
+
+        try:
+            with open(path, 'r') as fp:
+                entries = to_str(json.load(fp))
+        except (IOError, ValueError):
+            entries = {}
+        now = time.time()
+        for src, entry in (entries.items() if isinstance(entries, dict)
+                           else []):
+            if now - entry.get('time', 0) < self.max_age:
+                # 旧版本记下的是 Key 本身, 不再保留
+                entry.get('info', {}).pop('key', None)
+                self.entries[src] = entry
+        if self.entries:
+            LOGGER.info('续传日志中有 ' + str(len(self.entries)) +
+                        ' 张已经上传的图片, 将直接下载它们的输出')
+
+    @staticmethod
+    def _stat(src):
+        st = os.stat(src)
+        return st.st_size, st.st_mtime
+
+    def lookup(self, src):
+        ''' 返回上次运行得到的 (输出地址, 服务器返回的 JSON) ,
+        没有记录或源文件已经变化时返回 None '''
+        with self.lock:
+            entry = self.entries.get(src)
+        if entry is None:
+            return None
+        try:
+            if self._stat(src) != (entry['size'], entry['mtime']):
+                return None
+        except OSError:
+            return None
+        return entry['url'], entry['info']
+
+    def mark_resumed(self):
+        with self.lock:
+            self.resumed += 1
+
+    def record(self, src, url, info):
+        ''' 上传完成, 记下输出地址 '''
+        try:
+            size, mtime = self._stat(src)
+        except OSError:
+            return
+        with self.lock:
+            self.entries[src] = {
+                'url': url,
+                'info': info,
+                'size': size,
+                'mtime': mtime,
+                'time': time.time(),
+            }
+            self.dirty = True
+        self._maybe_flush()
+
+    def discard(self, src, stale=False):
+        ''' 输出已经保存 (stale 为 False), 或者输出地址已经失效 '''
+        with self.lock:
+            if self.entries.pop(src, None) is not None:
+                self.dirty = True
+            if stale:
+                self.stale += 1
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if self.dirty and time.time() - self.saved_at >= self.SAVE_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        ''' 把未完成的记录写入文件, 全部完成时删除文件. 返回写入的条数. '''
+        with self.save_lock:
+            with self.lock:
+                data = json.dumps(self.entries, indent=2, sort_keys=True) \
+                        if self.entries else None
+                count = len(self.entries)
+                self.dirty = False
+                self.saved_at = time.time()
+            try:
+                if data is not None:
+                    write_atomically([data], self.path)
+                elif os.path.exists(self.path):
+                    os.remove(self.path)
+            except (IOError, OSError) as err:
+                LOGGER.warn('无法写入续传日志 ' + self.path +
+                            ' (' + str(err) + ')')
+        return count
+
+    def save(self):
+        ''' 程序结束时调用, 写入文件 '''
+        count = self.flush()
+        if count:
+            LOGGER.info('续传日志中记下了 ' + str(count) +
+                        ' 张已经上传但还没有保存的图片, 下次运行时不必重新上传')
+
+    def log_stats(self):
+        if self.resumed > self.stale:
+            LOGGER.info('按续传日志直接下载了 ' +
+                        str(self.resumed - self.stale) + ' 张图片, 省去了上传')
+        if self.stale:
+            LOGGER.info('续传日志中有 ' + str(self.stale) +
+                        ' 个输出地址已经失效, 重新上传了这些图片')
@@ -2,14 +2,18 @@
 
 ''' Key 管理 '''
 
+import hashlib
+import json
 import logging
-from multiprocessing.dummy import Pool as ThreadPool
 import os
-import random
 import sys
 import threading
+import time
 
 from . import api
+from .output import write_atomically
+from . import engine
+from . import profiler
 
 from . import shared_var
 
@@ -19,33 +23,138 @@ class EmptyKeyHolderException(Exception):
     pass
 
 class TinifyCliKeyHolder(object):
+    ''' 存放可用的 API Key , 并为每个任务挑选 Key .
+
+    根据每次响应中的 compression-count 记录各 Key 本月已用的次数, 优先挑选
+    剩余次数最多的 Key (执行中的请求也计入已用), 在 Key 用满之前就把它移出
+    key 箱, 而不必等到请求失败.
+
+    各 Key 的状态 (可用, 用量耗尽, 未授权), 已用次数和检查时间保存在 Key 文件
+    旁边的状态文件中. 在有效期 (STATUS_TTL 秒) 内的状态直接使用; 过期的可用
+    Key 先照常使用, 同时在后台重新验证; 没有记录的 Key 在后台验证, 通过后加入
+    key 箱. 未授权的 Key 不再重新验证, 用量耗尽的 Key 到下个月再验证.
+    '''
     KEY_HOLDER_PATH = None
+    # 每个 Key 每月可压缩的次数, 0 表示不限. 免费 Key 为 500 次, 付费 Key
+    # 不限, 所以默认不限, 由服务器的 AccountError 决定何时移除 Key
+    MONTHLY_QUOTA = 0
+    STATUS_TTL = 3600  # 状态文件中可用 Key 的有效秒数, 0 表示不使用状态文件
+    STATUS_SUFFIX = '.status'
+    STATUS_MODE = 0600  # 状态文件虽然只有 Key 的指纹, 也只让自己读写
 
     @staticmethod
     def set_key_holder_path(path):
         TinifyCliKeyHolder.KEY_HOLDER_PATH = os.path.expanduser(path)
 
+    @staticmethod
+    def account_status(err):
+        ''' 由 AccountError 判断 Key 是用量耗尽 ('exhausted') 还是未授权
+        ('invalid') '''
+        # alternatives of message:
+        #   * "Your monthly limit has been exceeded
+        #     (HTTP429/TooManyRequests)"
+        #   * "Credentials are invalid (HTTP 401/Unauthorized)"
+        if err.message and "exceeded" in err.message:
+            return 'exhausted'
+        return 'invalid'
+
+    @staticmethod
+    def fingerprint(key):
+        ''' 代替 Key 本身写进续传日志等文件, 可以用 find_key 找回 Key '''
+        return hashlib.sha1(key).hexdigest()[:12]
+
+    @staticmethod
+    def status_path():
+        return TinifyCliKeyHolder.KEY_HOLDER_PATH + \
+                TinifyCliKeyHolder.STATUS_SUFFIX
+
     def validate_key(self, key):
-        tinify = api.TinifyCliClient(key)
+        ''' 向服务器验证 key , 返回 'valid', 'exhausted', 'invalid' ,
+        暂时无法判断时返回 None '''
+        tinify = api.TinifyCliClient(key, shared_var.session_pool,
+                                     shared_var.rate_limiter)
         try:
             tinify.validate()
             LOGGER.info("Key " + key +
                         " 已使用 " + str(tinify.compression_count) + " 次")
-            ret = True
+            ret = 'valid'
         except api.AccountError, e:
-            # alternatives of message:
-            #   * "Your monthly limit has been exceeded
-            #     (HTTP429/TooManyRequests)"
-            #   * "Credentials are invalid (HTTP 401/Unauthorized)"
-            if "exceeded" in e.message:
+            ret = self.account_status(e)
+            if ret == 'exhausted':
                 LOGGER.warn("Key " + key + " 已超过用量限制")
-                ret = True
-            elif "invalid" in e.message:
+            else:
                 LOGGER.warn("Key " + key + " 是未经授权的")
-                ret = False
+        except (api.ServerError, api.ConnectionError), e:
+            LOGGER.warn(u"验证 Key " + key + u" 时出错, 暂且当作可用 (" +
+                        unicode(e) + u")")
+            return None
+        with self.keys_lock:
+            self.status[key] = {
+                'status': ret,
+                'compression_count': tinify.compression_count,
+                'checked_at': time.time(),
+            }
         return ret
 
-    def load_keys_from_file(self):
+    def _load_status(self, keys):
+        ''' 读取状态文件中 keys 的记录, 返回 Key => 记录的 dict . 文件中
+        以 Key 的指纹为键; 旧版本以 Key 本身为键的记录也能读取, 下次保存时
+        改为指纹. 文件不存在或损坏时返回空的 dict '''
+        try:
+            with open(self.status_path(), 'r') as fp:
+                saved = json.load(fp)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(saved, dict):
+            return {}
+        status = {}
+        for key in keys:
+            entry = saved.get(self.fingerprint(key), saved.get(key))
+            if isinstance(entry, dict):
+                status[key] = entry
+        return status
+
+    def save_status(self):
+        ''' 把各 Key 的状态和最近一次得知的已用次数写入状态文件. 只有本次
+        运行中有请求成功的 Key 才更新检查时间, 其余的 Key 到期后照常重新
+        验证. 不使用状态文件 (STATUS_TTL 为 0) 时什么也不做. '''
+        if shared_var.is_no_validate or self.STATUS_TTL <= 0:
+            return
+        with self.keys_lock:
+            for key, count in self.compression_counts.items():
+                entry = self.status.get(key)
+                if entry is None or entry['status'] != 'valid':
+                    continue
+                entry['compression_count'] = count
+                if key in self.confirmed_at:
+                    entry['checked_at'] = self.confirmed_at[key]
+            data = json.dumps(dict((self.fingerprint(key), entry)
+                                   for key, entry in self.status.items()),
+                              indent=2, sort_keys=True)
+        try:
+            write_atomically([data], self.status_path(),
+                             mode=self.STATUS_MODE)
+        except (IOError, OSError) as err:
+            LOGGER.warn('无法写入 Key 状态文件 ' + self.status_path() +
+                        ' (' + str(err) + ')')
+
+    @staticmethod
+    def _is_fresh(entry, now):
+        ''' 状态文件中的一条记录是否仍然可信 '''
+        status = entry.get('status')
+        checked_at = entry.get('checked_at', 0)
+        if status == 'invalid':
+            return True
+        if time.gmtime(checked_at)[:2] != time.gmtime(now)[:2]:
+            return False  # 每个月用量清零
+        if status == 'exhausted':
+            return True
+        return now - checked_at < TinifyCliKeyHolder.STATUS_TTL
+
+    def load_keys_from_file(self, refresh=False):
+        ''' 读取 Key 文件. 需要验证的 Key 在后台验证, 本函数不等待验证
+        结束 (见 wait_validation). refresh 为 True 时忽略状态文件,
+        重新验证全部 Key . '''
         # 检查文件存在
         if not os.path.exists(TinifyCliKeyHolder.KEY_HOLDER_PATH):
             LOGGER.critical("请创建文件 " +
@@ -55,46 +164,218 @@ class TinifyCliKeyHolder(object):
             sys.exit(1)
 
         with open(TinifyCliKeyHolder.KEY_HOLDER_PATH, 'r') as fp:
-            keys_from_file = [key.strip() for key in fp]
-
-            if not shared_var.is_no_validate:
-                if shared_var.thread_num == 1:
-                    # 方便调试
-                    validity = map(self.validate_key, keys_from_file)
-                else:
-                    p = ThreadPool(shared_var.thread_num)
-                    shared_var.key_loading_thread_pool = p  # 全局引用
-                    validity = p.map_async(self.validate_key, keys_from_file)
-                    while not validity.ready():
-                        validity.wait(timeout=1)
-                    p.close()
-                    p.join()
-                    shared_var.key_loading_thread_pool = None
-                    validity = validity.get()
-            else:
-                # 如果要求跳过验证阶段, 这里生成一个虚假的全为 True 的 Key
-                # 可用性 List , 以欺骗后段程序
-                validity = [True] * len(keys_from_file)
-
-            t0 = zip(validity, keys_from_file)  # 把可用性和 key 绑回来
-            t1 = filter(lambda x: x[0] is True, t0)  # 过滤掉不可用的 key
-            if len(t1) > 0:  # 如果过滤完后, 还有 key 的话
-                t2 = zip(*t1)  # 提取出可用的 key 的 list
-                _, self.keys = t2
-                self.keys = list(self.keys)
-            else:  # 如果没有 key 可用的话
+            keys_from_file = [key.strip() for key in fp if key.strip()]
+
+        if shared_var.is_no_validate:
+            self.keys = keys_from_file
+            if len(self.keys) <= 0:
                 raise EmptyKeyHolderException()
+            return
 
-    def __init__(self):
-        self.keys_lock = threading.Lock()
+        if not refresh and self.STATUS_TTL > 0:
+            self.status = self._load_status(keys_from_file)
+        now = time.time()
+        to_validate = []
+        for key in keys_from_file:
+            entry = self.status.get(key)
+            if entry is None:
+                to_validate.append(key)
+                continue
+            status = entry.get('status')
+            if status == 'invalid':
+                LOGGER.warn("Key " + key + " 是未经授权的 (据状态文件)")
+                continue
+            is_fresh = self._is_fresh(entry, now)
+            if status == 'exhausted' and is_fresh:
+                LOGGER.warn("Key " + key + " 已超过用量限制 (据状态文件)")
+                self.exhausted_keys.add(key)
+                continue
+            if status == 'valid':
+                # 过期的可用 Key 先照常使用, 同时在后台重新验证
+                count = entry.get('compression_count')
+                if time.gmtime(entry.get('checked_at', 0))[:2] == \
+                        time.gmtime(now)[:2] and count is not None:
+                    self.compression_counts[key] = count
+                self.keys.append(key)
+                LOGGER.info("Key " + key + " 已使用 " + str(count) +
+                            " 次 (据状态文件, 检查于 " +
+                            str(int((now - entry.get('checked_at', 0)) / 60)) +
+                            " 分钟前)")
+            if not is_fresh:
+                to_validate.append(key)
+        with self.keys_lock:
+            for key in list(self.keys):
+                self._retire_if_exhausted(key)
 
-    def acquire_key(self):
+        if to_validate:
+            LOGGER.info('在后台验证 ' + str(len(to_validate)) + ' 个 Key')
+            self.is_validating = True
+            self.validation_thread = threading.Thread(
+                target=self._validate_keys, args=(to_validate, ),
+                name='key_validation')
+            self.validation_thread.setDaemon(True)
+            self.validation_thread.start()
+        else:
+            self.save_status()
+            if len(self.keys) <= 0:
+                raise EmptyKeyHolderException()
+
+    def _validate_keys(self, keys):
+        ''' 在后台线程中验证 keys , 验证完一个就更新一个 '''
+        try:
+            # 每个 Key 只需要一个请求, 多出来的线程是浪费
+            concurrency = min(engine.concurrency(), len(keys))
+            if concurrency == 1:
+                # 方便调试
+                for key in keys:
+                    self._apply_validation(key, self.validate_key(key))
+            else:
+                p = engine.create_pool(concurrency)
+                shared_var.key_loading_thread_pool = p  # 全局引用
+                validity = p.map_async(self.validate_key, keys)
+                while not validity.ready():
+                    validity.wait(timeout=1)
+                p.close()
+                p.join()
+                shared_var.key_loading_thread_pool = None
+                for key, result in zip(keys, validity.get()):
+                    self._apply_validation(key, result)
+            self.save_status()
+        finally:
+            with self.keys_lock:
+                self.is_validating = False
+                self.keys_cond.notify_all()
+
+    def _apply_validation(self, key, result):
+        with self.keys_lock:
+            if result == 'valid' or result is None:
+                if key not in self.keys and key not in self.exhausted_keys:
+                    self.keys.append(key)
+                count = self.status.get(key, {}).get('compression_count')
+                if result == 'valid' and count is not None:
+                    self.compression_counts[key] = count
+                self._retire_if_exhausted(key)
+            else:
+                if key in self.keys:
+                    self.keys.remove(key)
+                if result == 'exhausted':
+                    self.exhausted_keys.add(key)
+            self.keys_cond.notify_all()
+
+    def wait_validation(self):
+        ''' 等待后台验证结束, 没有可用的 Key 时抛出
+        EmptyKeyHolderException '''
         with self.keys_lock:
+            while self.is_validating:
+                # 带超时的等待, 使主线程仍能响应 SIGINT
+                self.keys_cond.wait(1)
             if len(self.keys) <= 0:
                 raise EmptyKeyHolderException()
-            return random.choice(self.keys)
 
-    def remove_key(self, key):
+    def __init__(self):
+        # 启用性能剖析时记录这个锁的争用
+        self.keys_lock = profiler.profiled_lock(threading.Lock(), 'keys_lock')
+        self.keys_cond = threading.Condition(self.keys_lock)
+        self.keys = []
+        self.exhausted_keys = set()
+        self.compression_counts = {}  # key => 本月已压缩的次数
+        self.inflight_counts = {}  # key => 正在使用这个 key 的请求数
+        self.status = {}  # key => 状态文件中的一条记录
+        self.confirmed_at = {}  # key => 最近一次请求成功 (确认可用) 的时间
+        self.is_validating = False
+        self.validation_thread = None
+
+    def add_keys(self, keys):
+        ''' 直接加入 keys , 不验证, 也不读写 Key 文件和状态文件.
+        失效的 Key 在第一次请求失败时被移除. '''
+        with self.keys_lock:
+            for key in keys:
+                if key not in self.keys:
+                    self.keys.append(key)
+            self.keys_cond.notify_all()
+
+    def _has_quota(self, key):
+        ''' key 还有没被进行中的请求占用的剩余次数 '''
+        return self.MONTHLY_QUOTA <= 0 or self._remaining(key) > 0
+
+    def _remaining(self, key):
+        ''' key 的剩余次数, 正在进行的请求视为已经用掉 '''
+        used = self.compression_counts.get(key, 0) + \
+                self.inflight_counts.get(key, 0)
+        if self.MONTHLY_QUOTA <= 0:
+            return -used  # 不限次数时, 挑选用得最少的
+        return self.MONTHLY_QUOTA - used
+
+    def update_compression_count(self, key, count):
+        if count is None:
+            return
+        with self.keys_lock:
+            self.compression_counts[key] = count
+            self._retire_if_exhausted(key)
+
+    def _retire_if_exhausted(self, key):
+        if self.MONTHLY_QUOTA <= 0 or key not in self.keys:
+            return
+        if self.compression_counts.get(key, 0) >= self.MONTHLY_QUOTA:
+            LOGGER.warn("Key " + key + " 本月用量已达 " +
+                        str(self.MONTHLY_QUOTA) + " 次, 不再使用")
+            self.keys.remove(key)
+            self.exhausted_keys.add(key)
+
+    def find_key(self, fingerprint):
+        ''' 返回 key 箱中指纹为 fingerprint 的 Key , 没有时返回 None '''
+        if fingerprint is None:
+            return None
+        with self.keys_lock:
+            for key in self.keys:
+                if self.fingerprint(key) == fingerprint:
+                    return key
+        return None
+
+    def acquire_key(self, preferred=None):
+        ''' 挑选剩余次数最多的 key , 用完后须调用 release_key .
+        preferred 仍然可用时优先使用它. 还没有可用的 Key 但后台验证尚未
+        结束时等待. 设置了 MONTHLY_QUOTA 时, 所有 Key 的剩余次数都已被进行中
+        的请求占满的话, 等待这些请求结束, 而不是超出限额. '''
+        start_time = time.time()
+        with self.keys_lock:
+            while True:
+                while len(self.keys) <= 0 and self.is_validating:
+                    self.keys_cond.wait(1)
+                if len(self.keys) <= 0:
+                    raise EmptyKeyHolderException()
+                candidates = [key for key in self.keys if self._has_quota(key)]
+                if candidates:
+                    break
+                # 失败的请求不消耗次数, 结束后可能空出剩余次数; 全部成功时
+                # 这些 Key 用满后被移出 key 箱, 上面抛出异常
+                self.keys_cond.wait(1)
+            if preferred in candidates:
+                key = preferred
+            else:
+                key = max(candidates, key=self._remaining)
+            self.inflight_counts[key] = self.inflight_counts.get(key, 0) + 1
+        if profiler.PROFILER is not None:
+            profiler.PROFILER.record('key_wait', start_time, time.time())
+        return key
+
+    def release_key(self, key, compression_count=None):
+        ''' 归还 acquire_key 得到的 key , 并记下响应中的已用次数 '''
+        with self.keys_lock:
+            self.inflight_counts[key] = self.inflight_counts.get(key, 1) - 1
+            if compression_count is not None:
+                self.compression_counts[key] = max(
+                    compression_count, self.compression_counts.get(key, 0))
+                if key in self.keys:
+                    # 服务器返回了已用次数, 且没有因为 AccountError 被移除
+                    self.confirmed_at[key] = time.time()
+            self._retire_if_exhausted(key)
+            # 等待剩余次数的 acquire_key
+            self.keys_cond.notify_all()
+
+    def remove_key(self, key, err=None):
+        ''' 移出 key 箱. err 为请求得到的 AccountError 时, 在状态文件中记下
+        这个 Key 用量耗尽或未授权, 下次运行不再使用 '''
         with self.keys_lock:
             try:
                 self.keys.remove(key)
@@ -102,4 +383,16 @@ class TinifyCliKeyHolder(object):
                 # 如果同一时间, 多个 worker 拿到了同一把失效的 key , 此时可能
                 # key 不存在于 key 箱中
                 pass
+            self.keys_cond.notify_all()
+            if err is None:
+                return
+            status = self.account_status(err)
+            if status == 'exhausted':
+                self.exhausted_keys.add(key)
+            self.confirmed_at.pop(key, None)
+            self.status[key] = {
+                'status': status,
+                'compression_count': self.compression_counts.get(key),
+                'checked_at': time.time(),
+            }
 
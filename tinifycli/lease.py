@@ -0,0 +1,222 @@
+# coding=utf-8
+
+''' 多进程 / 多台机器之间的任务分片 '''
+
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+
+from .display import report
+from .results import write_result
+from . import shared_var
+
+LOGGER = logging.getLogger('tinify-cli')
+
+class TinifyCliLeaseStore(object):
+    ''' 放在共享文件系统上的 SQLite 租约表.
+
+    多个 tinify-cli 进程 (可以在不同的机器上) 各自搜索文件, 但每批文件要先在
+    租约表中领取, 领到的才处理. 租约由后台线程定期续期, 进程退出后租约过期,
+    其中未完成的文件会被其他进程领走. 处理完的文件记为完成, 不会再被领取.
+    '''
+
+    MAX_WAIT = 1.0  # 等待时, 最多这么多秒检查一次是否要求中止
+    RECHECK_INTERVAL = 5.0  # 重新领取其他进程持有的任务的间隔 (秒)
+    RETRY_MARGIN = 1.0  # 过了租约到期时间这么多秒仍被持有的任务才放弃
+
+    def __init__(self, path, root, lease_seconds=300, batch_size=16):
+        self.path = path
+        # 租约以相对于 root (源目录) 的路径为键, 各台机器的挂载点可以不同
+        self.root = root
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.owner = '%s:%d:%08x' % (socket.gethostname(), os.getpid(),
+                                     random.getrandbits(32))
+        self.lock = threading.Lock()
+        self.claimed = 0
+        self.completed = 0
+        self.conn = sqlite3.connect(path, timeout=60.0,
+                                    check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.text_factory = str
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS leases ('
+            'src TEXT PRIMARY KEY, owner TEXT, expires REAL, '
+            'done INTEGER NOT NULL DEFAULT 0, dest TEXT, finished_at REAL)')
+
+        self.closed = False
+        self.heartbeat_stopped = threading.Event()
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat,
+                                                 name='lease_heartbeat')
+        self.heartbeat_thread.setDaemon(True)
+        self.heartbeat_thread.start()
+
+    def claim_batch(self, srcs):
+        ''' 在一个事务中领取 srcs (相对路径) 中尚未完成,
+        且没有被其他进程持有有效租约的文件, 返回领到的 list '''
+        return self._claim(srcs)[0]
+
+    def _claim(self, srcs):
+        ''' 同 claim_batch , 返回 (领到的 list, {其他进程持有有效租约的
+        文件: 租约到期时间}) . 已经完成的文件两者都不在. '''
+        now = time.time()
+        claimed = []
+        held = {}
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                for src in srcs:
+                    row = self.conn.execute(
+                        'SELECT owner, expires, done FROM leases '
+                        'WHERE src = ?', (src, )).fetchone()
+                    if row is None:
+                        self.conn.execute(
+                            'INSERT INTO leases (src, owner, expires) '
+                            'VALUES (?, ?, ?)',
+                            (src, self.owner, now + self.lease_seconds))
+                    elif row[2]:
+                        continue  # 已经完成
+                    elif row[0] == self.owner or row[1] < now:
+                        self.conn.execute(
+                            'UPDATE leases SET owner = ?, expires = ? '
+                            'WHERE src = ?',
+                            (self.owner, now + self.lease_seconds, src))
+                    else:
+                        held[src] = row[1]  # 其他进程正在处理
+                        continue
+                    claimed.append(src)
+                self.conn.execute('COMMIT')
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.claimed += len(claimed)
+        return claimed, held
+
+    def filter_tasks(self, tasks):
+        ''' 把任务按 batch_size 分批领取, 只产生领到的任务.
+
+        其他进程持有有效租约的任务先放在一边, 每隔一段时间重新领取一次:
+        那个进程处理完了就跳过, 它退出后租约到期就能领到. 任务都搜索完
+        之后继续等待, 直到这些任务都有了结果; 过了当初看到的租约到期时间
+        仍被持有 (那个进程还活着, 一直在续期) 的才放弃.
+        '''
+        deferred = []  # [任务, 放弃的时间] 的 list
+        recheck_interval = min(self.RECHECK_INTERVAL,
+                               self.lease_seconds / 3.0)
+        next_check = time.time() + recheck_interval
+        batch = []
+        for task in tasks:
+            batch.append(task)
+            if len(batch) >= self.batch_size:
+                for claimed_task in self._claim_tasks(batch, deferred):
+                    yield claimed_task
+                batch = []
+            if deferred and time.time() >= next_check:
+                for claimed_task in self._recheck(deferred, False):
+                    yield claimed_task
+                next_check = time.time() + recheck_interval
+        for claimed_task in self._claim_tasks(batch, deferred):
+            yield claimed_task
+
+        while deferred and not shared_var.is_draining:
+            wait = next_check - time.time()
+            if wait > 0:
+                # 分段等待, 以便按 Ctrl+C 时及时结束
+                time.sleep(min(wait, self.MAX_WAIT))
+                continue
+            for claimed_task in self._recheck(deferred, True):
+                yield claimed_task
+            next_check = time.time() + recheck_interval
+        for task, _ in deferred:
+            self._skip(task, 'leased')  # 按 Ctrl+C 时还在等待的
+
+    def _claim_tasks(self, tasks, deferred):
+        ''' 领取 tasks , 返回领到的任务. 其他进程持有有效租约的任务放入
+        deferred . '''
+        if not tasks:
+            return []
+        claimed, held = self._claim([self._key(task[0]) for task in tasks])
+        claimed = set(claimed)
+        ret = []
+        for task in tasks:
+            key = self._key(task[0])
+            if key in claimed:
+                ret.append(task)
+            elif key in held:
+                # 租约到期后 (加上一点余量, 以免与续期同时发生) 仍被持有
+                # 的话, 最后放弃它
+                deferred.append([task, held[key] + self.RETRY_MARGIN])
+            else:
+                self._skip(task, 'done')  # 其他进程已经处理完
+        return ret
+
+    def _recheck(self, deferred, is_final):
+        ''' 重新领取 deferred 中的任务, 返回领到的任务. is_final 时放弃
+        已经过了放弃时间的任务. '''
+        tasks = [task for task, _ in deferred]
+        give_up_at = dict((id(task), deadline) for task, deadline in deferred)
+        del deferred[:]
+        ret = []
+        for index in range(0, len(tasks), self.batch_size):
+            still_held = []
+            ret.extend(self._claim_tasks(tasks[index:index + self.batch_size],
+                                         still_held))
+            now = time.time()
+            for task, _ in still_held:
+                deadline = give_up_at[id(task)]
+                if is_final and now >= deadline:
+                    self._skip(task, 'leased')
+                else:
+                    deferred.append([task, deadline])
+        return ret
+
+    @staticmethod
+    def _skip(task, reason):
+        report(('skipped', ))
+        write_result(task, 'skipped', error=reason)
+
+    def _key(self, src):
+        return os.path.relpath(src, self.root)
+
+    def complete(self, src, dest):
+        ''' 记录 src (绝对路径) 已经处理完毕 '''
+        if isinstance(dest, tuple):
+            dest = repr(dest)
+        with self.lock:
+            if self.closed:  # 异常退出时还没停下的工作线程
+                return
+            self.conn.execute(
+                'UPDATE leases SET done = 1, dest = ?, finished_at = ? '
+                'WHERE src = ? AND done = 0',
+                (dest, time.time(), self._key(src)))
+            self.completed += 1
+
+    def _heartbeat(self):
+        ''' 定期为本进程持有的未完成租约续期 '''
+        while not self.heartbeat_stopped.wait(self.lease_seconds / 3.0):
+            try:
+                with self.lock:
+                    self.conn.execute(
+                        'UPDATE leases SET expires = ? '
+                        'WHERE owner = ? AND done = 0',
+                        (time.time() + self.lease_seconds, self.owner))
+            except sqlite3.Error as err:
+                LOGGER.warn('租约续期失败 (' + str(err) + ')')
+
+    def close(self):
+        ''' 停止续期, 并放弃本进程尚未完成的租约, 让其他进程可以马上领取.
+        可以重复调用 '''
+        self.heartbeat_stopped.set()
+        self.heartbeat_thread.join()  # 等续期线程停下再关闭连接
+        with self.lock:
+            if self.closed:
+                return
+            self.conn.execute(
+                'UPDATE leases SET expires = 0 WHERE owner = ? AND done = 0',
+                (self.owner, ))
+            self.conn.close()
+            self.closed = True
@@ -0,0 +1,129 @@
+# coding=utf-8
+
+''' 按源文件内容哈希保存服务器上压缩结果的输出地址 '''
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from .cache import file_digest
+from .journal import to_str
+from .key_holder import TinifyCliKeyHolder
+
+LOGGER = logging.getLogger('tinify-cli')
+
+class TinifyCliLocationStore(object):
+    ''' 保存输出地址 (Location) 的 SQLite 数据库 (--reuse-uploads).
+
+    每上传一张图片, 以源文件内容的哈希为键记下输出地址, 服务器返回的
+    JSON , 所用 Key 的指纹和过期时间. 之后的运行中 (哪怕 --resize-method,
+    --width, --height 不同, 或者输出文件丢了) 遇到内容相同的源文件, 只要
+    记录还没有过期, 就直接向输出地址请求所需的尺寸, 不再上传源文件.
+    输出地址提前失效时删除记录, 重新上传.
+    '''
+
+    COMMIT_INTERVAL = 50  # 每记录这么多条提交一次
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.reused = 0
+        self.stale = 0
+        self.pending = 0
+
+        store_dir = os.path.dirname(path)
+        if store_dir and not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS locations ('
+            'hash TEXT PRIMARY KEY, url TEXT, info TEXT, key TEXT, '
+            'expires_at REAL)')
+        self.conn.execute('DELETE FROM locations WHERE expires_at <= ?',
+                          (time.time(), ))
+        # 旧版本在 key 列保存的是 Key 本身, 换成指纹
+        self.conn.create_function('key_fingerprint', 1,
+                                  TinifyCliKeyHolder.fingerprint)
+        self.conn.execute(
+            'UPDATE locations SET key = key_fingerprint(key) '
+            'WHERE length(key) != 12')
+        self.conn.commit()
+
+    def lookup(self, src, data=None):
+        ''' 返回 (输出地址, 服务器返回的 JSON) , 没有未过期的记录时返回
+        None . JSON 中的 key_id 为当时上传所用 Key 的指纹. '''
+        try:
+            digest = file_digest(src, data)
+        except (IOError, OSError):
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT url, info, key FROM locations '
+                'WHERE hash = ? AND expires_at > ?',
+                (digest, time.time())).fetchone()
+        if row is None:
+            return None
+        url, info, key_id = row
+        info = to_str(json.loads(info))
+        info['key_id'] = key_id
+        return url, info
+
+    def mark_reused(self):
+        with self.lock:
+            self.reused += 1
+
+    def record(self, src, url, info, data=None):
+        ''' 上传完成, 记下输出地址 '''
+        try:
+            digest = file_digest(src, data)
+        except (IOError, OSError):
+            return
+        info = dict(info)
+        key_id = info.pop('key_id', None)
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO locations VALUES (?, ?, ?, ?, ?)',
+                (digest, url, json.dumps(info), key_id,
+                 time.time() + self.ttl))
+            self._maybe_commit()
+
+    def discard(self, src):
+        ''' 输出地址已经失效 '''
+        try:
+            digest = file_digest(src)
+        except (IOError, OSError):
+            return
+        with self.lock:
+            self.conn.execute('DELETE FROM locations WHERE hash = ?',
+                              (digest, ))
+            self.stale += 1
+            self._maybe_commit()
+
+    def _maybe_commit(self):
+        self.pending += 1
+        if self.pending >= self.COMMIT_INTERVAL:
+            self.conn.commit()
+            self.pending = 0
+
+    def flush(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def log_stats(self):
+        if self.reused > self.stale:
+            LOGGER.info('按保存的输出地址直接取得了 ' +
+                        str(self.reused - self.stale) + ' 张图片, 省去了上传')
+        if self.stale:
+            LOGGER.info(str(self.stale) + ' 个保存的输出地址已经失效, '
+                        '重新上传了这些图片')
@@ -0,0 +1,146 @@
+# coding=utf-8
+
+''' 增量运行清单, 记录已经处理过的源文件 '''
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from .cache import file_digest
+
+LOGGER = logging.getLogger('tinify-cli')
+
+MANIFEST_FILENAME = '.tinify-cli-manifest.sqlite'
+
+def _dest_text(dest):
+    ''' 多尺寸输出时 dest 是一个 tuple , 转成字符串保存 '''
+    if isinstance(dest, tuple):
+        return repr(dest)
+    return dest
+
+class TinifyCliManifest(object):
+    ''' 保存在输出目录里的 SQLite 清单.
+
+    每处理完一张图片, 记下源文件的路径, 大小, 修改时间, 内容哈希,
+    尺寸调整参数, 以及各个输出文件的大小和修改时间. 下次运行时, 源文件
+    没有变化且输出文件都还在 (也没有被改动) 的图片只需几次 stat 就能跳过.
+    '''
+
+    COMMIT_INTERVAL = 50  # 每记录这么多条提交一次
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str  # 路径按字节串保存, 与 os.listdir 一致
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'src TEXT PRIMARY KEY, dest TEXT, size INTEGER, mtime REAL, '
+            'hash TEXT, resize TEXT, output_size INTEGER, updated_at REAL, '
+            'outputs TEXT)')
+        columns = [row[1] for row in
+                   self.conn.execute('PRAGMA table_info(files)')]
+        if 'outputs' not in columns:
+            # 旧版本的清单没有记录输出文件的状态
+            self.conn.execute('ALTER TABLE files ADD COLUMN outputs TEXT')
+        self.conn.commit()
+        self.pending = 0
+        self.skipped = 0
+        self.closed = False
+
+        # 一次读进内存, 之后的查询不再访问数据库
+        self.records = {}
+        for row in self.conn.execute(
+                'SELECT src, dest, size, mtime, hash, resize, outputs '
+                'FROM files'):
+            self.records[row[0]] = row[1:]
+
+    def is_known(self, src):
+        return src in self.records
+
+    @staticmethod
+    def _output_stats(dest):
+        ''' 各个输出文件的 [大小, 修改时间] , 有输出文件不存在时抛出 OSError '''
+        paths = dest if isinstance(dest, tuple) else (dest, )
+        stats = []
+        for path in paths:
+            stat = os.stat(path)
+            stats.append([stat.st_size, stat.st_mtime])
+        return stats
+
+    def is_unchanged(self, src, dest, resize):
+        ''' 源文件自上次处理以来没有变化, 输出参数相同, 且输出文件都还在,
+        和当时写入的一样时返回 True '''
+        record = self.records.get(src)
+        if record is None:
+            return False
+        old_dest, old_size, old_mtime, old_hash, old_resize, old_outputs = \
+                record
+        if old_dest != _dest_text(dest) or old_resize != repr(resize):
+            return False
+        try:
+            stat = os.stat(src)
+            outputs = self._output_stats(dest)
+        except OSError:
+            return False  # 源文件或某个输出文件不存在
+        if old_outputs is not None and json.loads(old_outputs) != outputs:
+            return False  # 输出文件被替换或改动过
+        if stat.st_size != old_size:
+            return False
+        if stat.st_mtime != old_mtime:
+            # 只是修改时间变了, 内容可能没变, 用哈希确认
+            if file_digest(src) != old_hash:
+                return False
+            self._update_mtime(src, stat.st_mtime)
+        self.skipped += 1
+        return True
+
+    def _update_mtime(self, src, mtime):
+        with self.lock:
+            if self.closed:
+                return
+            self.conn.execute('UPDATE files SET mtime = ? WHERE src = ?',
+                              (mtime, src))
+            self.records[src] = (self.records[src][:2] + (mtime, ) +
+                                 self.records[src][3:])
+            self._maybe_commit()
+
+    def record(self, src, dest, resize):
+        ''' 记录一张处理完毕的图片. 内容哈希与缓存等共用 (见
+        cache.file_digest), 已经算过的不再读文件 '''
+        stat = os.stat(src)
+        digest = file_digest(src)
+        outputs = self._output_stats(dest)
+        output_size = sum(size for size, _ in outputs)
+        outputs = json.dumps(outputs)
+        dest = _dest_text(dest)
+        with self.lock:
+            if self.closed:  # 异常退出时还没停下的工作线程
+                return
+            self.conn.execute(
+                'INSERT OR REPLACE INTO files (src, dest, size, mtime, hash, '
+                'resize, output_size, updated_at, outputs) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (src, dest, stat.st_size, stat.st_mtime, digest,
+                 repr(resize), output_size, time.time(), outputs))
+            self.records[src] = (dest, stat.st_size, stat.st_mtime, digest,
+                                 repr(resize), outputs)
+            self._maybe_commit()
+
+    def _maybe_commit(self):
+        self.pending += 1
+        if self.pending >= self.COMMIT_INTERVAL:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        ''' 提交尚未提交的记录. 可以重复调用 '''
+        with self.lock:
+            if self.closed:
+                return
+            self.conn.commit()
+            self.conn.close()
+            self.closed = True
@@ -0,0 +1,143 @@
+# coding=utf-8
+
+''' 吞吐量与延迟统计 '''
+
+import time
+
+from .profiler import TinifyCliHistogram
+
+# 显示和汇总的百分位数
+PERCENTILES = (50, 95, 99)
+
+def _format_bytes_rate(bytes_num, seconds):
+    if seconds <= 0:
+        return '0.0MiB/s'
+    return '%.1fMiB/s' % (bytes_num / seconds / 1024.0 / 1024.0)
+
+def _format_latencies(histogram):
+    if histogram.count == 0:
+        return '-'
+    return '/'.join('%.2f' % histogram.percentile(pct / 100.0)
+                    for pct in PERCENTILES)
+
+def _latency_summary(histogram):
+    return dict(('p' + str(pct), histogram.percentile(pct / 100.0))
+                for pct in PERCENTILES)
+
+class TinifyCliMetrics(object):
+    ''' 汇总工作线程报告的事件.
+
+    事件是一个 tuple , 第一个元素是事件的名字:
+      * ('discovered', )                        发现了一个待处理的任务
+      * ('skipped', )                           发现的任务无需处理而被跳过
+      * ('discovery_done', )                    所有任务都已发现
+      * ('start', key)                          开始用 key 处理一张图片
+      * ('success', key, 原大小, 压缩后大小, 压缩延迟, 下载延迟, 已用次数,
+         实际上传的字节数, 实际下载的字节数)
+      * ('cached', 压缩后大小)                  命中缓存, 没有请求 API
+      * ('failure', key, 失败原因)
+
+    延迟记在固定大小的直方图 (见 profiler.TinifyCliHistogram) 中, 内存和
+    每次刷新的开销不随图片数增长, 百分位数是所在桶的上界.
+
+    本类不是线程安全的, 只在显示线程中使用.
+    '''
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.end_time = None
+        self.discovered = 0
+        self.skipped = 0
+        self.is_discovery_done = False
+        self.done = 0
+        self.cached = 0
+        self.failures = {}  # 失败原因 => 次数
+        self.inflight = 0
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.shrink_latency = TinifyCliHistogram()
+        self.download_latency = TinifyCliHistogram()
+        self.key_usage = {}  # key => 本次运行中压缩的张数
+        self.key_compression_counts = {}  # key => 最近一次得知的本月已用次数
+
+    def handle(self, event):
+        name = event[0]
+        if name == 'discovered':
+            self.discovered += 1
+        elif name == 'skipped':
+            self.skipped += 1
+        elif name == 'discovery_done':
+            self.is_discovery_done = True
+        elif name == 'start':
+            self.inflight += 1
+        elif name == 'success':
+            _, key, src_size, dest_size, shrink_time, download_time, \
+                    compression_count, bytes_up, bytes_down = event
+            self.inflight -= 1
+            self.done += 1
+            self.bytes_up += bytes_up
+            self.bytes_down += bytes_down
+            self.shrink_latency.add(shrink_time)
+            self.download_latency.add(download_time)
+            self.key_usage[key] = self.key_usage.get(key, 0) + 1
+            if compression_count is not None:
+                self.key_compression_counts[key] = compression_count
+        elif name == 'cached':
+            self.done += 1
+            self.cached += 1
+        elif name == 'failure':
+            _, _, reason = event
+            self.inflight -= 1
+            self.failures[reason] = self.failures.get(reason, 0) + 1
+
+    def elapsed(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    def eta(self):
+        ''' 预计剩余的秒数, 还在发现文件或尚无完成的图片时返回 None '''
+        if not self.is_discovery_done or self.done == 0:
+            return None
+        rate = self.done / self.elapsed()
+        return max(self.discovered - self.skipped - self.done, 0) / rate
+
+    def format_status(self):
+        elapsed = self.elapsed()
+        progress = str(self.done) + '/' + \
+                str(self.discovered - self.skipped)
+        if not self.is_discovery_done:
+            progress += '+'
+        eta = self.eta()
+        return ('进度 ' + progress +
+                ', ' + '%.1f' % (self.done / elapsed) + ' 张/秒' +
+                ', 上传 ' + _format_bytes_rate(self.bytes_up, elapsed) +
+                ', 下载 ' + _format_bytes_rate(self.bytes_down, elapsed) +
+                ', 进行中 ' + str(self.inflight) +
+                ', 压缩延迟 p50/p95/p99 ' +
+                _format_latencies(self.shrink_latency) + ' 秒' +
+                ', 下载延迟 ' +
+                _format_latencies(self.download_latency) + ' 秒' +
+                ', 预计剩余 ' +
+                ('-' if eta is None else '%.0f 秒' % eta))
+
+    def summary(self):
+        ''' 可以直接转成 JSON 的统计结果 '''
+        elapsed = self.elapsed()
+        return {
+            'elapsed': elapsed,
+            'discovered': self.discovered,
+            'skipped': self.skipped,
+            'done': self.done,
+            'cached': self.cached,
+            'failures': self.failures,
+            'images_per_second': self.done / elapsed if elapsed else 0.0,
+            'bytes_up': self.bytes_up,
+            'bytes_down': self.bytes_down,
+            'upload_bytes_per_second':
+                self.bytes_up / elapsed if elapsed else 0.0,
+            'download_bytes_per_second':
+                self.bytes_down / elapsed if elapsed else 0.0,
+            'shrink_latency': _latency_summary(self.shrink_latency),
+            'download_latency': _latency_summary(self.download_latency),
+            'key_usage': self.key_usage,
+            'key_compression_counts': self.key_compression_counts,
+        }
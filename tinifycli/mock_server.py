@@ -0,0 +1,316 @@
+# coding=utf-8
+
+'''
+模拟 Tinify API 的本地服务器
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+实现了 /shrink 和输出地址两个接口, 用于在不消耗 Key 用量的情况下测试和
+测量 tinify-cli 的性能. 支持:
+
+* 按 Key 计数的 Compression-Count 响应头, 超过每月上限时返回 429
+* 不在允许列表里的 Key 返回 401
+* 可配置的服务器处理延迟, 每个连接的带宽上限和随机错误率
+* 可配置的每秒请求数上限, 超过时返回 429 (与用量耗尽的 429 消息不同)
+* 可配置的输出保留时间, 过期的输出地址返回 404 , 用于测试续传时输出地址
+  已经失效的情况
+
+用法::
+
+    $ python -m tinifycli.mock_server --port 8000 --latency 0.2
+    $ tinify-cli --api-endpoint http://127.0.0.1:8000 ...
+'''
+
+import argparse
+import base64
+import BaseHTTPServer
+import collections
+import itertools
+import json
+import random
+import SocketServer
+import threading
+import time
+
+class MockTinifyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' 处理一个连接上的请求, 配置和状态都保存在 self.server 上 '''
+    protocol_version = 'HTTP/1.1'  # 支持 keep-alive
+    # 响应头和响应体先写入缓冲区, 处理完一个请求后一起发出 (见
+    # handle_one_request 中的 wfile.flush). 再关闭 Nagle 算法, 否则
+    # keep-alive 连接上的每个请求都要多等一次延迟确认 (约 40 毫秒).
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+
+    def _key(self):
+        auth = self.headers.get('authorization', '')
+        if not auth.lower().startswith('basic '):
+            return None
+        try:
+            return base64.b64decode(auth[6:]).split(':', 1)[1]
+        except (TypeError, IndexError):
+            return None
+
+    def _throttle(self, bytes_num):
+        ''' 按带宽上限, 为传输 bytes_num 字节等待相应的时间 '''
+        if self.server.bandwidth > 0:
+            time.sleep(float(bytes_num) / self.server.bandwidth)
+
+    def _read_body(self):
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                self._throttle(size)
+            return ''.join(chunks)
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length)
+        self._throttle(length)
+        return body
+
+    def _send(self, status, body, headers=None, content_type=None):
+        self.send_response(status)
+        if content_type is None:
+            content_type = 'application/json'
+        self.send_header('content-type', content_type)
+        self.send_header('content-length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self._throttle(len(body))
+        self.wfile.write(body)
+
+    def _send_error(self, status, error, message, headers=None):
+        self._send(status, json.dumps({'error': error, 'message': message}),
+                   headers)
+
+    def _authorize(self):
+        ''' 校验 Key , 通过时返回 (key, 本月已用次数), 否则已经发出错误响应
+        并返回 (None, None) '''
+        key = self._key()
+        if key is None or (self.server.keys is not None and
+                           key not in self.server.keys):
+            self._send_error(401, 'Unauthorized', 'Credentials are invalid')
+            return None, None
+        return key, self.server.compression_count(key)
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.path == '/shrink':
+            self._shrink(body)
+        elif self.path.startswith('/output/'):
+            self._output(body)
+        else:
+            self._send_error(404, 'NotFound', 'Not found')
+
+    def do_GET(self):
+        body = self._read_body()
+        if self.path.startswith('/output/'):
+            self._output(body)
+        else:
+            self._send_error(404, 'NotFound', 'Not found')
+
+    def _shrink(self, body):
+        key, count = self._authorize()
+        if key is None:
+            return
+        if not self.server.allow_request():
+            self._send_error(429, 'TooManyRequests',
+                             'Too many requests, please slow down')
+            return
+        headers = {'compression-count': str(count)}
+        if not body:
+            self._send_error(400, 'InputMissing', 'Input file is empty',
+                             headers)
+            return
+        if self.server.monthly_limit and count >= self.server.monthly_limit:
+            self._send_error(429, 'TooManyRequests',
+                             'Your monthly limit has been exceeded', headers)
+            return
+        if random.random() < self.server.error_rate:
+            self._send_error(503, 'ServiceUnavailable',
+                             'Service is temporarily unavailable')
+            return
+
+        time.sleep(self.server.latency)
+        count = self.server.increase_compression_count(key)
+        output_id = self.server.store_output(body)
+        output_size = int(len(body) * self.server.ratio)
+        headers = {
+            'compression-count': str(count),
+            'location': 'http://%s:%d/output/%s' % (
+                self.server.server_address[0], self.server.server_address[1],
+                output_id),
+        }
+        result = {
+            'input': {'size': len(body), 'type': 'image/png'},
+            'output': {
+                'size': output_size, 'type': 'image/png',
+                'width': self.server.image_width,
+                'height': self.server.image_height,
+                'ratio': self.server.ratio,
+            },
+        }
+        self._send(201, json.dumps(result), headers)
+
+    def _output(self, body):
+        key, count = self._authorize()
+        if key is None:
+            return
+        output = self.server.load_output(self.path[len('/output/'):])
+        if output is None:
+            self._send_error(404, 'NotFound', 'Output has expired')
+            return
+        output = output[:int(len(output) * self.server.ratio)]
+        headers = {'compression-count': str(count)}
+        width, height = self.server.image_width, self.server.image_height
+        if body:
+            try:
+                resize = json.loads(body).get('resize', {})
+            except ValueError:
+                self._send_error(400, 'BadSignature', 'Malformed JSON')
+                return
+            # 带参数的请求 (例如调整尺寸) 也计入用量
+            count = self.server.increase_compression_count(key)
+            headers['compression-count'] = str(count)
+            width = resize.get('width', width)
+            height = resize.get('height', height)
+        headers['image-width'] = str(width)
+        headers['image-height'] = str(height)
+        self._send(200, output, headers, content_type='image/png')
+
+class MockTinifyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    ''' 模拟的 Tinify API 服务器, 每个连接一个线程 '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, keys=None, monthly_limit=500, latency=0.0,
+                 bandwidth=0, error_rate=0.0, ratio=0.5, max_rps=0,
+                 output_ttl=0, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MockTinifyHandler)
+        self.keys = keys  # 允许的 Key , None 表示任何 Key 都可用
+        self.monthly_limit = monthly_limit  # 0 表示不限
+        self.latency = latency  # 服务器处理每张图片所用的秒数
+        self.bandwidth = bandwidth  # 每个连接每秒可传输的字节数, 0 表示不限
+        self.error_rate = error_rate  # /shrink 返回 503 的概率
+        self.ratio = ratio  # 压缩后大小与原大小之比
+        self.max_rps = max_rps  # /shrink 每秒请求数上限, 0 表示不限
+        self.output_ttl = output_ttl  # 输出保留的秒数, 0 表示一直保留
+        self.verbose = verbose
+        self.image_width = 800
+        self.image_height = 600
+
+        self.lock = threading.Lock()
+        self.compression_counts = {}
+        self.outputs = {}  # 输出 ID => (保存的时间, 内容)
+        self.output_ids = itertools.count()
+        self.request_times = collections.deque()
+
+    def allow_request(self):
+        ''' 按最近一秒内的请求数判断是否超过 max_rps '''
+        if self.max_rps <= 0:
+            return True
+        with self.lock:
+            now = time.time()
+            while self.request_times and self.request_times[0] < now - 1.0:
+                self.request_times.popleft()
+            if len(self.request_times) >= self.max_rps:
+                return False
+            self.request_times.append(now)
+            return True
+
+    def compression_count(self, key):
+        with self.lock:
+            return self.compression_counts.get(key, 0)
+
+    def increase_compression_count(self, key):
+        with self.lock:
+            count = self.compression_counts.get(key, 0) + 1
+            self.compression_counts[key] = count
+            return count
+
+    def store_output(self, body):
+        with self.lock:
+            output_id = '%x%08x' % (next(self.output_ids),
+                                    random.getrandbits(32))
+            self.outputs[output_id] = (time.time(), body)
+            return output_id
+
+    def load_output(self, output_id):
+        ''' 返回输出的内容, 不存在或已经过期时返回 None '''
+        with self.lock:
+            stored = self.outputs.get(output_id)
+            if stored is None:
+                return None
+            stored_at, body = stored
+            if self.output_ttl > 0 and \
+                    time.time() - stored_at >= self.output_ttl:
+                del self.outputs[output_id]
+                return None
+            return body
+
+    @property
+    def endpoint(self):
+        return 'http://%s:%d' % self.server_address
+
+    def start(self):
+        ''' 在后台线程中运行, 返回 API 地址 '''
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='mock_server')
+        thread.setDaemon(True)
+        thread.start()
+        return self.endpoint
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=u'模拟 Tinify API 的本地服务器',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog='python -m tinifycli.mock_server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--keys', default=None,
+                        help=u'允许的 Key , 以逗号分隔, 不指定时任何 Key 都可用')
+    parser.add_argument('--monthly-limit', default=500, type=int,
+                        help=u'每个 Key 每月可压缩的次数, 0 表示不限')
+    parser.add_argument('--latency', default=0.0, type=float,
+                        help=u'服务器处理每张图片所用的秒数')
+    parser.add_argument('--bandwidth', default=0, type=int,
+                        help=u'每个连接每秒可传输的字节数, 0 表示不限')
+    parser.add_argument('--error-rate', default=0.0, type=float,
+                        help=u'/shrink 返回 503 的概率')
+    parser.add_argument('--ratio', default=0.5, type=float,
+                        help=u'压缩后大小与原大小之比')
+    parser.add_argument('--max-rps', default=0, type=int,
+                        help=u'/shrink 每秒请求数上限, 超过时返回 429')
+    parser.add_argument('--output-ttl', default=0, type=float,
+                        help=u'输出保留的秒数, 过期后输出地址返回 404 , '
+                        u'0 表示一直保留')
+    parser.add_argument('--verbose', action='store_true',
+                        help=u'输出每个请求的日志')
+    args = parser.parse_args()
+
+    keys = None if args.keys is None else set(args.keys.split(','))
+    server = MockTinifyServer((args.host, args.port), keys=keys,
+                              monthly_limit=args.monthly_limit,
+                              latency=args.latency,
+                              bandwidth=args.bandwidth,
+                              error_rate=args.error_rate,
+                              ratio=args.ratio,
+                              max_rps=args.max_rps,
+                              output_ttl=args.output_ttl,
+                              verbose=args.verbose)
+    print 'Mock Tinify API listening on ' + server.endpoint
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+# coding=utf-8
+
+''' 输出文件的写入.
+
+所有输出都先写到目标目录中的临时文件, 写完后再改名为目标文件, 所以中途被
+打断时不会留下半个文件. 需要把原图原样放到目标位置时 (例如压缩后没有变小),
+不经过用户态复制: 优先 reflink , 其次硬链接, 都不行时才复制.
+'''
+
+import binascii
+import errno
+import logging
+import os
+import platform
+import shutil
+import stat
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
+
+LOGGER = logging.getLogger('tinify-cli')
+
+# Linux 的 ioctl FICLONE , 让两个文件共享数据块 (btrfs, XFS, overlayfs 等),
+# 之后修改其中一个不影响另一个
+FICLONE = 0x40049409
+
+# 临时文件重名时最多换这么多次名字
+TEMP_ATTEMPTS = 100
+
+def _mkstemp(dest, mode=0666):
+    ''' 在 dest 所在目录新建临时文件, 返回 (fd, 路径) . 与 tempfile.mkstemp
+    (总是 0600) 不同, 以 mode 新建, 由内核去掉 umask , 与 open(dest, 'wb')
+    新建的文件相同. 这样不需要读取 umask : 读取 umask 只能先临时修改它,
+    会影响同一进程中其他线程新建的文件. '''
+    dest_dir = os.path.dirname(os.path.abspath(dest))
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    for _ in range(TEMP_ATTEMPTS):
+        temp_path = os.path.join(dest_dir, '.tinify-' +
+                                 binascii.hexlify(os.urandom(6)) + '.tmp')
+        try:
+            return os.open(temp_path, flags, mode), temp_path
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+    raise IOError(errno.EEXIST, '无法新建临时文件', dest_dir)
+
+def _dest_mode(dest, mode=None):
+    ''' 输出文件应有的权限: 给出 mode 时就是 mode , 否则替换已有的 dest
+    时沿用它的权限. 都没有时返回 None , 即 0666 去掉 umask '''
+    if mode is not None:
+        return mode
+    try:
+        return stat.S_IMODE(os.stat(dest).st_mode)
+    except OSError:
+        return None
+
+def _rename(temp_path, dest, syncer):
+    if platform.system() == 'Windows' and os.path.exists(dest):
+        # Windows 上 rename 不能覆盖已有文件
+        os.remove(dest)
+    os.rename(temp_path, dest)
+    if syncer is not None:
+        syncer.renamed(dest)
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def write_temp(chunks, dest, syncer=None, mode=None):
+    ''' 把 chunks 依次写入 dest 所在目录的临时文件, 返回 (临时文件的路径,
+    写入的字节数) . 之后用 commit_temp 改名为 dest , 或用 discard_temp
+    删除. 中途出错时不留下临时文件. 给出 syncer 时 fsync 文件内容.
+    mode 见 _dest_mode , 保存 Key 等敏感内容时用 0600 . '''
+    mode = _dest_mode(dest, mode)
+    fd, temp_path = _mkstemp(dest, 0666 if mode is None else mode)
+    size = 0
+    try:
+        if mode is not None:
+            os.chmod(temp_path, mode)  # umask 可能去掉了其中的一些位
+        with os.fdopen(fd, 'wb') as fp:
+            for chunk in chunks:
+                fp.write(chunk)
+                size += len(chunk)
+            if syncer is not None:
+                fp.flush()
+                os.fsync(fp.fileno())
+    except:
+        _remove_quietly(temp_path)
+        raise
+    return temp_path, size
+
+def commit_temp(temp_path, dest, syncer=None):
+    ''' 把 write_temp 写好的临时文件改名为 dest . 给出 syncer 时由它批量
+    fsync 目录. '''
+    try:
+        _rename(temp_path, dest, syncer)
+    except:
+        _remove_quietly(temp_path)
+        raise
+
+def discard_temp(temp_path):
+    _remove_quietly(temp_path)
+
+def write_atomically(chunks, dest, syncer=None, mode=None):
+    ''' 把 chunks 依次写入 dest 所在目录的临时文件, 写完后改名为 dest ,
+    返回写入的字节数. 中途出错时 dest 保持原样. mode 同 write_temp . '''
+    temp_path, size = write_temp(chunks, dest, syncer, mode)
+    commit_temp(temp_path, dest, syncer)
+    return size
+
+def _reflink(src, fd):
+    ''' 让 fd 与 src 共享数据块, 文件系统不支持时返回 False '''
+    if fcntl is None or platform.system() != 'Linux':
+        return False
+    try:
+        with open(src, 'rb') as fp:
+            fcntl.ioctl(fd, FICLONE, fp.fileno())
+    except (IOError, OSError):
+        return False  # EOPNOTSUPP, EXDEV (跨文件系统), EINVAL 等
+    return True
+
+def place_file(src, dest, syncer=None):
+    ''' 把 src 的内容放到 dest , 返回所用的方式: reflink , link (硬链接)
+    或 copy . 与 write_atomically 一样先放到临时文件再改名, 权限也相同.
+    硬链接使 dest 与 src 是同一个文件 (权限也是 src 的), 只用于之后不会
+    被原地修改的文件. '''
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        return 'same'
+    mode = _dest_mode(dest)
+    fd, temp_path = _mkstemp(dest, 0666 if mode is None else mode)
+    try:
+        try:
+            if _reflink(src, fd):
+                if mode is not None:
+                    os.chmod(temp_path, mode)
+                method = 'reflink'
+                if syncer is not None:
+                    os.fsync(fd)
+            else:
+                method = None
+        finally:
+            os.close(fd)
+        if method is None:
+            os.remove(temp_path)
+            try:
+                os.link(src, temp_path)
+                method = 'link'
+            except (OSError, AttributeError):
+                # 跨文件系统等情况; AttributeError: Windows 上的 Python 2
+                # 没有 os.link
+                shutil.copyfile(src, temp_path)
+                if mode is not None:
+                    os.chmod(temp_path, mode)
+                method = 'copy'
+                if syncer is not None:
+                    with open(temp_path, 'rb+') as fp:
+                        os.fsync(fp.fileno())
+        _rename(temp_path, dest, syncer)
+    except:
+        _remove_quietly(temp_path)
+        raise
+    return method
+
+def fsync_dir(path):
+    ''' fsync 目录 path , 使其中的改名落盘. 不支持时 (Windows) 什么也不做 '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class TinifyCliDirSyncer(object):
+    ''' 批量 fsync 输出目录 (--fsync).
+
+    改名之后还要 fsync 所在目录, 新的文件名才算落盘. 每个文件都这样做代价
+    很高, 所以只记下有改名的目录, 每 BATCH_SIZE 个文件或每 INTERVAL 秒对
+    其中每个目录 fsync 一次. 程序结束前须调用 flush .
+    '''
+
+    BATCH_SIZE = 64
+    INTERVAL = 1.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirs = set()
+        self.pending = 0
+        self.last_sync = time.time()
+        self.files = 0
+        self.dir_syncs = 0
+
+    def renamed(self, dest):
+        now = time.time()
+        with self.lock:
+            self.dirs.add(os.path.dirname(os.path.abspath(dest)))
+            self.pending += 1
+            self.files += 1
+            is_due = self.pending >= self.BATCH_SIZE or \
+                    now - self.last_sync >= self.INTERVAL
+        if is_due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            dirs = self.dirs
+            self.dirs = set()
+            self.pending = 0
+            self.last_sync = time.time()
+            self.dir_syncs += len(dirs)
+        for path in dirs:
+            fsync_dir(path)
+
+    def log_stats(self):
+        LOGGER.info('改名了 ' + str(self.files) + ' 个输出文件, 目录 fsync ' +
+                    str(self.dir_syncs) + ' 次')
@@ -0,0 +1,124 @@
+# coding=utf-8
+
+''' 分阶段的任务流水线 '''
+
+import logging
+import Queue
+import threading
+import time
+
+from .dispatcher import TinifyCliDispatcher
+from .key_holder import EmptyKeyHolderException
+from .results import write_result
+
+LOGGER = logging.getLogger('tinify-cli')
+
+class TinifyCliPipeline(TinifyCliDispatcher):
+    ''' 把每个任务拆成若干阶段 (读取, 上传, 下载, 写入), 每个阶段有自己的
+    工作线程, 阶段之间以有界队列连接. 这样一个慢的下载不会占住上传的线程,
+    上传带宽, 下载带宽和磁盘 I/O 可以同时被利用.
+
+    stages 是 (名字, 函数, 线程数) 的 list . 每个阶段的函数接收上一阶段的
+    返回值 (第一个阶段接收任务参数), 返回 tuple 表示任务在此结束
+    (("success", ) 或 (失败原因, 任务参数)), 返回其他值则交给下一阶段, 这个
+    值须有 drop_data 方法, 任务被放弃时调用它释放占用的内存.
+    入队, 重试和熔断与 TinifyCliDispatcher 相同. drain 之后, 前 drain_stages
+    个阶段中还没有开始的任务被放弃, 之后的阶段继续把已经开始的任务做完.
+    '''
+
+    QUEUE_FACTOR = 2  # 阶段之间的队列长度为下一阶段线程数的这么多倍
+
+    def __init__(self, stages, queue_size, drain_stages=1):
+        TinifyCliDispatcher.__init__(
+            self, sum(worker_num for _, _, worker_num in stages), queue_size)
+        self.stages = stages
+        self.drain_stages = drain_stages
+        # 第一个阶段直接从分发队列中取任务
+        self.stage_queues = [self.queue] + [
+            Queue.Queue(worker_num * self.QUEUE_FACTOR)
+            for _, _, worker_num in stages[1:]]
+        self.busy_times = [0.0] * len(stages)
+        self.busy_lock = threading.Lock()
+        self.start_time = None
+        self.end_time = None
+
+    def run(self, tasks, func=None):
+        ''' 各阶段的函数已在 stages 中给出, func 被忽略 '''
+        self.start_time = time.time()
+        try:
+            return TinifyCliDispatcher.run(self, tasks, func)
+        finally:
+            self.end_time = time.time()
+
+    def _start_workers(self, func):
+        for index, (name, _, worker_num) in enumerate(self.stages):
+            for i in range(worker_num):
+                self._start_thread(name + '-' + str(i), self._stage_worker,
+                                   index)
+
+    def _stop_workers(self):
+        for (_, _, worker_num), queue in zip(self.stages, self.stage_queues):
+            for _ in range(worker_num):
+                try:
+                    queue.put_nowait(None)
+                except Queue.Full:
+                    # 被中止时队列里可能还有任务, 线程是 daemon , 不必等它们
+                    pass
+
+    def _stage_worker(self, index):
+        name, func, _ = self.stages[index]
+        in_queue = self.stage_queues[index]
+        out_queue = None
+        if index + 1 < len(self.stages):
+            out_queue = self.stage_queues[index + 1]
+        while True:
+            item = in_queue.get()
+            if item is None:
+                return
+            task, attempt = item[:2]
+            job = item[2] if len(item) > 2 else task
+            if self.draining and index < self.drain_stages:
+                if job is not task:
+                    # 与失败时一样, 归还预读的内容占用的内存额度
+                    job.drop_data()
+                self._drop(task)
+                continue
+            self.circuit_breaker.wait()
+            start_time = time.time()
+            try:
+                ret = func(job)
+            except EmptyKeyHolderException as err:
+                self.error = err
+                self.terminate()
+                return
+            except Exception as err:
+                LOGGER.exception('在 ' + name + ' 阶段处理任务 ' +
+                                 repr(task) + ' 时发生了错误')
+                write_result(task, 'failed', error=repr(err))
+                self._task_done(False)
+                continue
+            finally:
+                with self.busy_lock:
+                    self.busy_times[index] += time.time() - start_time
+
+            if isinstance(ret, tuple):
+                self._handle_result(task, attempt, ret)
+            else:
+                out_queue.put((task, attempt, ret))
+
+    def stage_stats(self):
+        ''' 返回每个阶段的 (名字, 线程数, 利用率) , 利用率是线程忙碌的时间
+        占全部线程时间的比例 '''
+        elapsed = (self.end_time or time.time()) - self.start_time
+        stats = []
+        for (name, _, worker_num), busy_time in zip(self.stages,
+                                                    self.busy_times):
+            stats.append((name, worker_num,
+                          busy_time / max(elapsed * worker_num, 1e-6)))
+        return stats
+
+    def log_stats(self):
+        for name, worker_num, utilization in self.stage_stats():
+            LOGGER.info('流水线阶段 ' + name + ': ' + str(worker_num) +
+                        ' 个线程, 利用率 ' + '%.0f' % (utilization * 100) +
+                        '%')
@@ -0,0 +1,255 @@
+# coding=utf-8
+
+''' 上传前的本地预筛选
+
+只读取 PNG / JPEG 的文件头和元数据, 估计 Tinify 能够节省的比例, 跳过预计
+收益太小的图片 (例如已经被压缩过的, 或者非常小的图片), 以节省用量和带宽.
+估计是启发式的, 宁可多上传, 不要错杀.
+'''
+
+import collections
+import logging
+import multiprocessing
+import os
+import signal
+import struct
+
+from .display import report
+from .results import write_result
+
+LOGGER = logging.getLogger('tinify-cli')
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+PNG_PALETTE_COLOR_TYPE = 3
+
+# 经 Tinify 压缩的图片, 每个像素大约占用的字节数. 源图片的每像素字节数接近
+# 或低于这个值时, 说明它已经被压缩过了.
+PNG_TARGET_BYTES_PER_PIXEL = 0.6
+JPEG_TARGET_BYTES_PER_PIXEL = 0.15
+# JPEG 的质量高于这个值时, Tinify 才有明显的压缩空间
+JPEG_TARGET_QUALITY = 80
+
+# 标准 JPEG 亮度量化表 (质量 50), 用于估计源图片的质量
+JPEG_STD_LUMINANCE_SUM = sum([
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99])
+
+# 其他优化工具在文本块, 注释或 APPn 段中留下的标记 (小写). 带有这些标记的
+# 图片已经被优化过, 再压缩基本上只能省掉元数据.
+OPTIMIZER_MARKERS = ('tinypng', 'tinyjpg', 'tinify', 'jpegmini', 'pngquant',
+                     'imageoptim', 'kraken.io', 'optimizilla', 'compressor.io',
+                     'shortpixel')
+# 只在文本块或段的前这么多字节中寻找标记
+MARKER_SCAN_SIZE = 1024
+
+def _clamp(value):
+    return max(0.0, min(1.0, value))
+
+def _has_optimizer_marker(data):
+    data = data.lower()
+    return any(marker in data for marker in OPTIMIZER_MARKERS)
+
+def _screen_png(fp, size):
+    ''' 返回预计节省的比例 '''
+    fp.seek(len(PNG_SIGNATURE))
+    width = height = color_type = None
+    is_palette = False
+    is_optimized = False
+    metadata_size = 0
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type == 'IHDR':
+            width, height, _, color_type = \
+                    struct.unpack('>IIBB', fp.read(10))
+            fp.seek(length - 10 + 4, os.SEEK_CUR)
+        else:
+            if chunk_type == 'PLTE':
+                is_palette = True
+            elif chunk_type in ('tEXt', 'iTXt'):
+                metadata_size += length + 12  # Tinify 会去掉这些元数据
+                scan_size = min(length, MARKER_SCAN_SIZE)
+                if _has_optimizer_marker(fp.read(scan_size)):
+                    is_optimized = True
+                fp.seek(length - scan_size + 4, os.SEEK_CUR)
+                continue
+            elif chunk_type in ('zTXt', 'iCCP', 'eXIf'):
+                metadata_size += length + 12
+            elif chunk_type == 'IEND':
+                break
+            fp.seek(length + 4, os.SEEK_CUR)  # 跳过数据和 CRC
+
+    if not width or not height:
+        return 1.0  # 看不懂的文件交给服务器判断
+    metadata_savings = float(metadata_size) / size
+    if color_type == PNG_PALETTE_COLOR_TYPE or is_palette or is_optimized:
+        # 已经是调色板图片或已经被优化过, 基本上只能省掉元数据
+        return _clamp(metadata_savings)
+    bytes_per_pixel = float(size - metadata_size) / (width * height)
+    pixel_savings = 1.0 - PNG_TARGET_BYTES_PER_PIXEL / bytes_per_pixel
+    return _clamp(pixel_savings * (1.0 - metadata_savings) + metadata_savings)
+
+def _screen_jpeg(fp, size):
+    ''' 返回预计节省的比例 '''
+    fp.seek(2)
+    width = height = None
+    quality = None
+    metadata_size = 0
+    is_optimized = False
+    while True:
+        marker = fp.read(2)
+        if len(marker) < 2 or marker[0] != '\xff':
+            break
+        marker = ord(marker[1])
+        if marker == 0xd9 or marker == 0xda:  # EOI, SOS 之后是图像数据
+            break
+        if 0xd0 <= marker <= 0xd7 or marker == 0x01:
+            continue  # 没有长度字段的标记
+        length = struct.unpack('>H', fp.read(2))[0]
+        payload = fp.read(length - 2)
+        if marker in (0xc0, 0xc1, 0xc2) and len(payload) >= 5:
+            height, width = struct.unpack('>HH', payload[1:5])
+        elif marker == 0xdb and quality is None and len(payload) >= 65:
+            # 第一个量化表一般是亮度表, 只处理 8 位精度的表
+            if ord(payload[0]) >> 4 == 0:
+                table_sum = sum(ord(c) for c in payload[1:65])
+                scale = 100.0 * table_sum / JPEG_STD_LUMINANCE_SUM
+                # 标准的 IJG 质量与缩放比例的关系
+                if scale <= 100:
+                    quality = (200 - scale) / 2.0
+                else:
+                    quality = 5000.0 / scale
+        elif 0xe1 <= marker <= 0xef or marker == 0xfe:
+            # APP1-APP15 (EXIF, XMP, ICC 等) 和注释
+            metadata_size += length + 2
+            if _has_optimizer_marker(payload[:MARKER_SCAN_SIZE]):
+                is_optimized = True
+
+    if not width or not height:
+        return 1.0
+    metadata_savings = float(metadata_size) / size
+    bytes_per_pixel = float(size - metadata_size) / (width * height)
+    pixel_savings = 1.0 - JPEG_TARGET_BYTES_PER_PIXEL / bytes_per_pixel
+    if is_optimized:
+        return _clamp(metadata_savings)
+    if quality is not None and quality <= JPEG_TARGET_QUALITY:
+        pixel_savings = min(pixel_savings, 0.05)
+    return _clamp(pixel_savings * (1.0 - metadata_savings) + metadata_savings)
+
+def screen_image(path):
+    ''' 估计压缩 path 能节省的比例, 返回 (path, 比例, 文件大小) ,
+    读不了的文件大小为 None . 可以在子进程中运行. '''
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as fp:
+            head = fp.read(8)
+            if head == PNG_SIGNATURE:
+                savings = _screen_png(fp, size)
+            elif head[:2] == '\xff\xd8':
+                savings = _screen_jpeg(fp, size)
+            else:
+                savings = 1.0
+    except (IOError, OSError, struct.error, ZeroDivisionError):
+        return path, 1.0, None
+    return path, savings, size
+
+def _init_worker():
+    # 子进程不处理 Ctrl+C , 由主进程统一处理
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class _ScreenedResult(object):
+    ''' 在当前进程中筛选的结果, 接口与进程池的 AsyncResult 相同 '''
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+class TinifyCliPrescreener(object):
+    ''' 在进程池中预筛选任务, 跳过预计节省比例低于 min_savings ,
+    或小于 min_size 字节的图片.
+
+    进程池在构造时就创建好, 所以要在启动任何线程之前构造: 带着其他线程
+    持有的锁 fork 出来的子进程可能会死锁. in_process 为 True 时在当前进程
+    中筛选 (例如 gevent 替换了 threading 时不宜使用进程池). '''
+
+    # 每个进程同时在筛选的任务数
+    WINDOW_PER_PROCESS = 4
+
+    def __init__(self, min_savings, min_size, process_num=None, window=None,
+                 in_process=False):
+        self.min_savings = min_savings
+        self.min_size = min_size
+        self.process_num = process_num or multiprocessing.cpu_count()
+        # 同时在筛选的任务数上限
+        self.window = window or self.process_num * self.WINDOW_PER_PROCESS
+        self.pool = None
+        if not in_process:
+            self.pool = multiprocessing.Pool(self.process_num, _init_worker)
+        self.screened = 0
+        self.skipped = 0
+        self.skipped_bytes = 0
+
+    def _submit(self, task):
+        if task[2] is not None:
+            # 要调整尺寸的图片 (例如任务清单中单独给出了 resize) 总能变小
+            return None
+        path = task[0]
+        if self.pool is not None:
+            return self.pool.apply_async(screen_image, (path, ))
+        return _ScreenedResult(screen_image(path))
+
+    def filter_tasks(self, tasks):
+        ''' 逐个提交筛选, 按原来的顺序产生保留下来的任务. 最前面的任务
+        筛选完就马上产生, 不需要等后面的任务. 要调整尺寸的任务不筛选. '''
+        pending = collections.deque()
+        try:
+            for task in tasks:
+                pending.append((task, self._submit(task)))
+                while pending and (len(pending) >= self.window or
+                                   pending[0][1] is None or
+                                   pending[0][1].ready()):
+                    task, result = pending.popleft()
+                    if result is None or self._keep(task, result.get()):
+                        yield task
+            while pending:
+                task, result = pending.popleft()
+                if result is None or self._keep(task, result.get()):
+                    yield task
+        finally:
+            self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def _keep(self, task, result):
+        path, savings, size = result
+        self.screened += 1
+        if size is not None and size < self.min_size:
+            LOGGER.info('文件 ' + os.path.basename(path) + ' 只有 ' +
+                        str(size) + ' 字节, 跳过')
+        elif savings < self.min_savings:
+            LOGGER.info('文件 ' + os.path.basename(path) +
+                        ' 预计只能节省 ' + '%.0f' % (savings * 100) +
+                        '%, 跳过')
+        else:
+            return True
+        self.skipped += 1
+        self.skipped_bytes += size or 0
+        report(('skipped', ))
+        write_result(task, 'skipped', error='prescreen')
+        return False
+
+    def log_stats(self):
+        LOGGER.info('预筛选了 ' + str(self.screened) + ' 张图片, 省去了 ' +
+                    str(self.skipped) + ' 次上传 (共 ' +
+                    str(self.skipped_bytes) + ' 字节)')
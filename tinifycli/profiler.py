@@ -0,0 +1,267 @@
+# coding=utf-8
+
+''' 按阶段统计用时的性能剖析 (--profile).
+
+记录每张图片各个阶段的用时: 读取源文件 (read), 上传 (upload), 等待服务器
+压缩 (server), 下载 (download), 写入输出 (write), 等待 Key (key_wait) 和
+等待 TinifyCliKeyHolder.keys_lock (keys_lock, 只记录发生争用的那些), 以及
+用 tracecall 标记的方法. 结束时在日志中输出各阶段的用时分布, 并把全部
+事件写成 Chrome trace 格式的 JSON , 可以用 chrome://tracing 或 Perfetto
+打开.
+
+没有启用时 PROFILER 为 None , tracecall 标记的方法保持原样, keys_lock 也是
+普通的锁, 各处只多一次 ``PROFILER is not None`` 的判断.
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+
+LOGGER = logging.getLogger('tinify-cli')
+
+# 启用时为 TinifyCliProfiler
+PROFILER = None
+
+# 日志中各阶段的先后顺序, 其余阶段按名字排在后面
+PHASE_ORDER = ['read', 'upload', 'server', 'download', 'write', 'key_wait',
+               'keys_lock']
+
+class TinifyCliHistogram(object):
+    ''' 用时的直方图, 桶的上界为 2 的整数次幂微秒 '''
+
+    def __init__(self):
+        self.buckets = {}  # 桶的上界 (微秒) => 次数
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        micros = max(int(seconds * 1000000), 1)
+        bound = 1 << (micros - 1).bit_length()
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, ratio):
+        ''' 第 ratio (0 到 1) 分位数所在的桶的上界 (秒) '''
+        if self.count == 0:
+            return None
+        rank = ratio * self.count
+        seen = 0
+        for bound in sorted(self.buckets):
+            seen += self.buckets[bound]
+            if seen >= rank:
+                return min(bound / 1000000.0, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+            # JSON 的键只能是字符串
+            'buckets_us': dict((str(bound), count)
+                               for bound, count in self.buckets.items()),
+        }
+
+class TinifyCliProfiler(object):
+    ''' 收集各阶段的用时 '''
+
+    # 最多保留这么多个事件用于导出, 直方图不受此限制
+    MAX_EVENTS = 1000000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.pid = os.getpid()
+        self.histograms = {}  # 阶段名 => TinifyCliHistogram
+        self.events = []
+        self.thread_names = {}  # 线程 ident => 线程名
+        self.dropped_events = 0
+        self.lock_acquisitions = {}  # 锁名 => 获取的次数
+
+    def record(self, phase, start, end, args=None):
+        ''' 记录一次从 start 到 end 的 phase 阶段 (time.time() 的秒数) '''
+        thread = threading.current_thread()
+        with self.lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = TinifyCliHistogram()
+            histogram.add(end - start)
+            if len(self.events) >= self.MAX_EVENTS:
+                self.dropped_events += 1
+                return
+            self.thread_names[thread.ident] = thread.name
+            self.events.append((phase, start, end, thread.ident, args))
+
+    def count_acquisition(self, name):
+        with self.lock:
+            self.lock_acquisitions[name] = \
+                    self.lock_acquisitions.get(name, 0) + 1
+
+    def summary(self):
+        ''' 各阶段的直方图, 供 --summary-json 使用 '''
+        with self.lock:
+            return dict((phase, histogram.to_dict())
+                        for phase, histogram in self.histograms.items())
+
+    def _phases(self):
+        return sorted(self.histograms, key=lambda phase: (
+            PHASE_ORDER.index(phase) if phase in PHASE_ORDER
+            else len(PHASE_ORDER), phase))
+
+    def log_stats(self):
+        def ms(seconds):
+            return '%.1f' % (seconds * 1000)
+        with self.lock:
+            for phase in self._phases():
+                histogram = self.histograms[phase]
+                line = '阶段 %-9s %6d 次, 共 %s 秒, 平均/p50/p95/p99/最大 ' \
+                        '%s/%s/%s/%s/%s 毫秒' % (
+                            phase, histogram.count, '%.2f' % histogram.total,
+                            ms(histogram.total / histogram.count),
+                            ms(histogram.percentile(0.5)),
+                            ms(histogram.percentile(0.95)),
+                            ms(histogram.percentile(0.99)),
+                            ms(histogram.max))
+                if phase in self.lock_acquisitions:
+                    line += ' (共获取 ' + str(self.lock_acquisitions[phase]) + \
+                            ' 次, 只计发生争用的)'
+                LOGGER.info(line)
+            for name, count in sorted(self.lock_acquisitions.items()):
+                if name not in self.histograms:
+                    LOGGER.info('锁 ' + name + ' 共获取 ' + str(count) +
+                                ' 次, 没有发生争用')
+            if self.dropped_events:
+                LOGGER.warning('事件过多, 有 ' + str(self.dropped_events) +
+                               ' 个没有写入 trace 文件')
+
+    def write_trace(self, path):
+        ''' 写入 Chrome trace 格式 (JSON Object Format) 的文件 '''
+        with self.lock:
+            trace_events = []
+            for ident, name in self.thread_names.items():
+                trace_events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                    'tid': ident, 'args': {'name': name},
+                })
+            for phase, start, end, ident, args in self.events:
+                event = {
+                    'name': phase, 'cat': 'tinify-cli', 'ph': 'X',
+                    'pid': self.pid, 'tid': ident,
+                    'ts': int((start - self.start_time) * 1000000),
+                    'dur': int((end - start) * 1000000),
+                }
+                if args:
+                    event['args'] = args
+                trace_events.append(event)
+        with open(path, 'w') as fp:
+            json.dump({'traceEvents': trace_events,
+                       'displayTimeUnit': 'ms',
+                       'otherData': {'phases': self.summary()}}, fp)
+        LOGGER.info('性能剖析结果已写入 ' + path)
+
+class TinifyCliProfiledLock(object):
+    ''' 记录争用时等待用时的锁. 可以交给 threading.Condition 使用. '''
+
+    def __init__(self, lock, name, profiler):
+        self.lock = lock
+        self.name = name
+        self.profiler = profiler
+
+    def acquire(self, blocking=True):
+        self.profiler.count_acquisition(self.name)
+        if self.lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        start_time = time.time()
+        ret = self.lock.acquire()
+        self.profiler.record(self.name, start_time, time.time())
+        return ret
+
+    def release(self):
+        self.lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+class TinifyCliTimedBody(object):
+    ''' 包装要上传的内容 (str 或文件对象), 记下 requests 读完最后一块的
+    时间, 用来区分上传和等待服务器压缩 '''
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, body, size):
+        self.body = body
+        self.size = size
+        self.offset = 0
+        self.finished_at = None
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        if isinstance(self.body, str):
+            if size < 0:
+                size = len(self.body) - self.offset
+            chunk = self.body[self.offset:self.offset + size]
+            self.offset += len(chunk)
+        else:
+            chunk = self.body.read(size)
+        if not chunk and self.finished_at is None:
+            self.finished_at = time.time()
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+def profiled_lock(lock, name):
+    ''' 启用时返回记录争用的 lock , 否则原样返回 lock '''
+    if PROFILER is None:
+        return lock
+    return TinifyCliProfiledLock(lock, name, PROFILER)
+
+def tracecall(func):
+    ''' 标记需要记录每次调用用时的方法. 只做标记, 原样返回 func ;
+    enable 时才把所在类中的这些方法换成记录用时的版本. '''
+    func.is_traced = True
+    return func
+
+def _traced(func):
+    def new_func(*args, **kwargs):
+        ''' 待返回的函数 '''
+        start_time = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            PROFILER.record(func.__name__, start_time, time.time())
+    new_func.__name__ = func.__name__
+    new_func.__doc__ = func.__doc__
+    return new_func
+
+def enable():
+    ''' 启用性能剖析, 须在创建 Key 箱之前调用 '''
+    global PROFILER
+    if PROFILER is not None:
+        return PROFILER
+    PROFILER = TinifyCliProfiler()
+    from .api import TinifyCliClient
+    for cls in [TinifyCliClient]:
+        for name, attr in cls.__dict__.items():
+            if getattr(attr, 'is_traced', False):
+                setattr(cls, name, _traced(attr))
+    return PROFILER
@@ -0,0 +1,146 @@
+# coding=utf-8
+
+''' 请求频率与带宽限制 '''
+
+import collections
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger('tinify-cli')
+
+class TokenBucket(object):
+    ''' 令牌桶, 每秒补充 rate 个令牌, 最多攒 capacity 个. rate 为 0 时不限制.
+
+    一次取用的数量大于桶中已有的令牌时先欠下, 调用者等待欠下的令牌补齐的时间,
+    这样大文件也能通过, 总体速率仍然符合限制.
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.last_time = time.time()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill()
+            self.rate = float(rate)
+
+    def _refill(self):
+        now = time.time()
+        if self.rate > 0:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+
+    def consume(self, amount=1):
+        ''' 取用 amount 个令牌, 必要时等待 '''
+        with self.lock:
+            if self.rate <= 0:
+                return
+            self._refill()
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+class TinifyCliRateLimiter(object):
+    ''' 所有工作线程共享的限速器.
+
+    对整个运行和每个 Key 分别限制请求数/秒, 上传字节数/秒和下载字节数/秒.
+    此外还会自适应: 收到 429 (并非用量耗尽) 或 5xx 时把请求速率减半,
+    之后每个成功的请求让速率线性回升, 直到回到上限或不再需要限制.
+    '''
+
+    MIN_RATE = 0.5  # 自适应时请求速率的下限 (次/秒)
+    INCREASE_STEP = 0.1  # 每个成功的请求让速率回升这么多 (次/秒)
+    WINDOW = 10.0  # 统计实际请求速率的时间窗口 (秒)
+    # 同时进行中的请求往往一起失败, 这段时间内只减半一次
+    DECREASE_INTERVAL = 1.0
+
+    def __init__(self, max_rps=0, max_upload=0, max_download=0,
+                 key_max_rps=0, key_max_upload=0, key_max_download=0):
+        self.max_rps = max_rps
+        self.key_limits = (key_max_rps, key_max_upload, key_max_download)
+        self.request_bucket = TokenBucket(max_rps, max(max_rps, 1))
+        self.upload_bucket = TokenBucket(max_upload)
+        self.download_bucket = TokenBucket(max_download)
+        self.key_buckets = {}  # key => (请求, 上传, 下载) 三个令牌桶
+        self.lock = threading.Lock()
+
+        self.adaptive_rps = None  # 自适应得到的请求速率, None 表示未启用
+        self.ceiling_rps = None  # 第一次被限制前的实际请求速率
+        self.last_decrease = 0
+        self.adaptive_bucket = TokenBucket(0)
+        self.request_times = collections.deque()
+
+    def _buckets_of(self, key):
+        with self.lock:
+            buckets = self.key_buckets.get(key)
+            if buckets is None:
+                rps, upload, download = self.key_limits
+                buckets = (TokenBucket(rps, max(rps, 1)),
+                           TokenBucket(upload), TokenBucket(download))
+                self.key_buckets[key] = buckets
+            return buckets
+
+    def acquire(self, key, upload_size=0):
+        ''' 发出请求之前调用, upload_size 为请求体的字节数 '''
+        key_request, key_upload, _ = self._buckets_of(key)
+        self.adaptive_bucket.consume()
+        self.request_bucket.consume()
+        key_request.consume()
+        if upload_size:
+            self.upload_bucket.consume(upload_size)
+            key_upload.consume(upload_size)
+        with self.lock:
+            now = time.time()
+            self.request_times.append(now)
+            while self.request_times[0] < now - self.WINDOW:
+                self.request_times.popleft()
+
+    def consume_download(self, key, size):
+        ''' 每下载 size 字节调用一次 '''
+        _, _, key_download = self._buckets_of(key)
+        self.download_bucket.consume(size)
+        key_download.consume(size)
+
+    def _observed_rps(self):
+        if len(self.request_times) < 2:
+            return self.MIN_RATE
+        span = max(self.request_times[-1] - self.request_times[0], 1.0)
+        return len(self.request_times) / span
+
+    def on_throttled(self):
+        ''' 服务器表示请求过多或出错时调用, 请求速率减半 '''
+        with self.lock:
+            now = time.time()
+            if now - self.last_decrease < self.DECREASE_INTERVAL:
+                return
+            self.last_decrease = now
+            if self.adaptive_rps is None:
+                rate = self._observed_rps()
+                if self.max_rps > 0:
+                    rate = min(rate, self.max_rps)
+                self.ceiling_rps = rate
+            else:
+                rate = self.adaptive_rps
+            self.adaptive_rps = max(rate / 2.0, self.MIN_RATE)
+            LOGGER.warn('服务器繁忙, 请求速率降为 ' +
+                        '%.1f' % self.adaptive_rps + ' 次/秒')
+            self.adaptive_bucket.set_rate(self.adaptive_rps)
+
+    def on_success(self):
+        ''' 请求成功时调用, 请求速率线性回升 '''
+        with self.lock:
+            if self.adaptive_rps is None:
+                return
+            self.adaptive_rps += self.INCREASE_STEP
+            if self.adaptive_rps >= self.ceiling_rps:
+                LOGGER.info('请求速率恢复正常')
+                self.adaptive_rps = None
+                self.adaptive_bucket.set_rate(0)
+            else:
+                self.adaptive_bucket.set_rate(self.adaptive_rps)
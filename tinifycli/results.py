@@ -0,0 +1,52 @@
+# coding=utf-8
+
+''' 逐行输出每个任务的结果 (JSONL), 见 --from-manifest '''
+
+import json
+import threading
+
+from . import shared_var
+
+class TinifyCliResultWriter(object):
+    ''' 把每个任务的结果写成一行 JSON , 每写一行就 flush ,
+    使下游程序可以边读边处理. 线程安全. '''
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.lock = threading.Lock()
+        self.counts = {}  # 状态 => 行数
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self.lock:
+            self.fp.write(line)
+            self.fp.flush()
+            status = record.get('status')
+            self.counts[status] = self.counts.get(status, 0) + 1
+
+def write_result(task, status, info=None, error=None):
+    ''' 输出任务 (源文件, 目标文件, 尺寸参数) 的结果, status 为 success,
+    cached, skipped 或 failed . info 是 worker 返回的统计信息.
+    没有启用结果输出时什么也不做. '''
+    writer = shared_var.result_writer
+    if writer is None:
+        return
+    src, dest, resize = task
+    record = {
+        'src': src,
+        'dest': list(dest) if isinstance(dest, tuple) else dest,
+        'status': status,
+    }
+    if info:
+        src_size = info.get('src_size')
+        dest_size = info.get('dest_size')
+        record['src_size'] = src_size
+        record['dest_size'] = dest_size
+        if src_size and dest_size is not None:
+            record['ratio'] = float(dest_size) / src_size
+        record['shrink_latency'] = info.get('shrink_time')
+        record['download_latency'] = info.get('download_time')
+        record['key'] = info.get('key')
+    if error is not None:
+        record['error'] = error
+    writer.write(record)
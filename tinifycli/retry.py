@@ -0,0 +1,101 @@
+# coding=utf-8
+
+''' 失败任务的重试策略 '''
+
+import logging
+import random
+import threading
+import time
+
+LOGGER = logging.getLogger('tinify-cli')
+
+class TinifyCliRetryPolicy(object):
+    ''' 按失败原因决定是否重试, 以及重试前等待多久.
+
+    等待时间为带随机抖动的指数退避: 第 n 次重试前等待 [0, base * 2^n)
+    秒中的随机值, 最长不超过 MAX_DELAY 秒.
+    '''
+
+    # 失败原因 => (最多重试次数, 退避的基数 (秒))
+    LIMITS = {
+        # 坏掉的 Key 已经被移除, 换一把 Key 马上重试即可
+        'accountError': (20, 0.0),
+        'netError': (8, 1.0),
+        'serverError': (8, 2.0),
+        # 请求太频繁, 限速器已经降低了速率, 不计入熔断器
+        'rateLimited': (16, 1.0),
+        'clientError': (2, 1.0),
+        # 续传日志中的输出地址失效了, 马上重新上传
+        'staleResume': (4, 0.0),
+    }
+    MAX_DELAY = 60.0
+
+    def should_retry(self, reason, attempt):
+        ''' attempt 为已经失败的次数 '''
+        max_retries, _ = self.LIMITS.get(reason, (0, 0.0))
+        return attempt <= max_retries
+
+    def delay(self, reason, attempt):
+        _, base = self.LIMITS.get(reason, (0, 0.0))
+        return random.uniform(0, min(self.MAX_DELAY, base * 2 ** attempt))
+
+class TinifyCliCircuitBreaker(object):
+    ''' 服务器错误的熔断器.
+
+    WINDOW 秒内出现 THRESHOLD 次服务器错误时断开, 所有工作线程暂停发出新请求
+    COOLDOWN 秒; 之后放行, 若紧接着又出错则再次断开, 且暂停时间加倍.
+    '''
+
+    THRESHOLD = 5
+    WINDOW = 10.0
+    COOLDOWN = 5.0
+    MAX_COOLDOWN = 120.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failure_times = []
+        self.open_until = 0.0
+        self.cooldown = self.COOLDOWN
+        self.half_open = False
+
+    def record_success(self):
+        with self.lock:
+            if self.half_open:
+                if time.time() < self.open_until:
+                    return  # 暂停前发出的请求, 不计入
+                LOGGER.info('服务器恢复正常')
+                self.half_open = False
+                self.cooldown = self.COOLDOWN
+            self.failure_times = []
+
+    def record_failure(self):
+        now = time.time()
+        with self.lock:
+            if self.half_open:
+                if now < self.open_until:
+                    return  # 暂停前发出的请求, 不计入
+                # 暂停之后仍然出错, 加倍暂停时间
+                self.cooldown = min(self.cooldown * 2, self.MAX_COOLDOWN)
+                self._open(now)
+                return
+            self.failure_times = [t for t in self.failure_times
+                                  if now - t < self.WINDOW]
+            self.failure_times.append(now)
+            if len(self.failure_times) >= self.THRESHOLD:
+                self._open(now)
+
+    def _open(self, now):
+        LOGGER.warn('服务器错误过多, 暂停 ' + '%.0f' % self.cooldown +
+                    ' 秒后再发出请求')
+        self.open_until = now + self.cooldown
+        self.failure_times = []
+        self.half_open = True
+
+    def wait(self):
+        ''' 熔断器断开时, 等到它可以放行为止 '''
+        while True:
+            with self.lock:
+                remaining = self.open_until - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 1.0))
@@ -0,0 +1,94 @@
+# coding=utf-8
+
+''' HTTP 连接池, 按 API Key 复用 requests.Session '''
+
+import logging
+import os
+import threading
+
+LOGGER = logging.getLogger('tinify-cli')
+
+CACERT_PATH = \
+        os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cacert.pem')
+
+def connections_per_key(concurrency, max_variants=1):
+    ''' 每个 Key 同时可能用到的连接数, 作为连接池的大小.
+
+    每个任务上传一次, 再同时下载 max_variants 个尺寸; 流水线模式下上传和
+    下载同时进行. 连接池只是保留连接数的上限, 用不到的连接不会被建立.
+    '''
+    return max(int(concurrency), 1) * (max(int(max_variants), 1) + 1)
+
+class TinifyCliSessionPool(object):
+    ''' 每个 API Key 对应一个 requests.Session , 在所有工作线程之间共享.
+
+    同一个 Key 的上传与下载, 以及之后的图片, 都会复用已经建立好的 keep-alive
+    连接, 从而省掉每张图片一次的 TLS 握手.
+    '''
+
+    def __init__(self, pool_size=1, user_agent=None):
+        # 连接池里最多保留的连接数, 见 connections_per_key
+        self.pool_size = max(int(pool_size), 1)
+        self.user_agent = user_agent
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.request_count = 0
+        self.request_count_lock = threading.Lock()
+
+    def get_session(self, key):
+        ''' 取得 key 对应的 Session , 不存在则新建一个 '''
+        with self.sessions_lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = self._create_session(key)
+                self.sessions[key] = session
+            return session
+
+    def _create_session(self, key):
+        # 在第一次需要连接时才导入 requests , 它是启动时最慢的部分
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.sessions.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.pool_size,
+                              pool_block=False)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.auth = ('api', key)
+        if self.user_agent is not None:
+            session.headers = {'user-agent': self.user_agent}
+        session.verify = CACERT_PATH
+        return session
+
+    def count_request(self):
+        ''' 每发出一个请求调用一次, 用于统计连接复用率 '''
+        with self.request_count_lock:
+            self.request_count += 1
+
+    def stats(self):
+        ''' 返回 (请求数, 新建连接数, 复用连接数) '''
+        new_connections = 0
+        with self.sessions_lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for pool_key in pools.keys():
+                    pool = pools.get(pool_key)
+                    if pool is not None:
+                        new_connections += pool.num_connections
+        requests_num = self.request_count
+        reused = max(requests_num - new_connections, 0)
+        return requests_num, new_connections, reused
+
+    def log_stats(self):
+        requests_num, new_connections, reused = self.stats()
+        LOGGER.info('共发出 ' + str(requests_num) + ' 个请求, 新建连接 ' +
+                    str(new_connections) + ' 个, 复用连接 ' +
+                    str(reused) + ' 次')
+
+    def close(self):
+        with self.sessions_lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
@@ -4,16 +4,46 @@ worker_thread_pool = None
 key_loading_thread_pool = None
 
 key_holder = None
+display = None
+session_pool = None
+result_cache = None
+manifest = None
+lease_store = None
+resume_journal = None
+location_store = None
+watcher = None
+rate_limiter = None
+output_syncer = None
+result_writer = None
 
 is_debug = False
 is_debug_requests = False
 is_no_validate = False
 is_only_validate_key = False
 is_override = False
+is_fsync = False
 is_preview_filename = False
 is_resize = False
+variants = None
+is_recursive = False
+is_watch = False
+is_watch_poll = False
+is_draining = False
+drain_timeout = 30
+from_manifest = None
 
 thread_num = 1
+is_auto_concurrency = False
+engine = 'thread'
+max_inflight = 100
+is_pipeline = False
+
+max_rps = 0
+max_upload = 0
+max_download = 0
+key_max_rps = 0
+key_max_upload = 0
+key_max_download = 0
 
 src_dir = None
 dest_dir = None
@@ -23,3 +53,25 @@ resize_method = None
 width = None
 height = None
 
+is_cache = False
+cache_dir = None
+cache_size = None
+is_reuse_uploads = False
+location_store_path = None
+location_ttl = 3600
+resume_max_age = 3600
+
+is_manifest = False
+
+is_prescreen = False
+min_savings = 0.1
+min_size = 512
+
+shard_db = None
+shard_lease = 300
+shard_batch = 16
+
+progress_interval = 5
+summary_json = None
+profile_path = None
+
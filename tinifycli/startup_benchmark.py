@@ -0,0 +1,133 @@
+# coding=utf-8
+
+'''
+启动时间基准测试
+~~~~~~~~~~~~~~~~
+
+tinify-cli 常被 git hook 和构建脚本逐个文件地调用, 这时启动时间比吞吐量更
+重要. 本测试多次运行 ``tinify-cli --version`` 和 ``tinify-cli -p`` (预览
+文件名), 取用时的中位数, 超过给定的预算 (毫秒) 时以退出码 1 结束, 可以放进
+CI 防止启动时间退化. 同时检查这两个命令没有导入 requests .
+
+用法::
+
+    $ python -m tinifycli.startup_benchmark --runs 10 \\
+          --version-budget 150 --preview-budget 250
+'''
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# 运行 tinify-cli 之后报告是否导入了这些模块
+HEAVY_MODULES = ['requests']
+
+CLI_SCRIPT = '''
+import sys
+import tinifycli
+try:
+    tinifycli.main()
+finally:
+    loaded = [name for name in %r if name in sys.modules]
+    sys.stderr.write('\\nLOADED_MODULES ' + ','.join(loaded) + '\\n')
+''' % (HEAVY_MODULES, )
+
+def run_once(args):
+    ''' 运行一次 tinify-cli , 返回 (退出码, 用时, 导入了的重量级模块) '''
+    with open(os.devnull, 'wb') as devnull:
+        start_time = time.time()
+        process = subprocess.Popen([sys.executable, '-c', CLI_SCRIPT] + args,
+                                   stdout=devnull, stderr=subprocess.PIPE)
+        _, stderr = process.communicate()
+        elapsed = time.time() - start_time
+    loaded = []
+    for line in stderr.splitlines():
+        if line.startswith('LOADED_MODULES '):
+            loaded = [name for name in line.split(' ', 1)[1].split(',')
+                      if name]
+    return process.returncode, elapsed, loaded
+
+def measure(name, args, runs, budget):
+    ''' 运行 runs 次, 返回结果. 第一次运行用来预热 .pyc 和磁盘缓存, 不计入 '''
+    run_once(args)
+    timings = []
+    statuses = set()
+    loaded = set()
+    for _ in range(runs):
+        status, elapsed, modules = run_once(args)
+        timings.append(elapsed)
+        statuses.add(status)
+        loaded.update(modules)
+    timings.sort()
+    median = timings[len(timings) // 2]
+    return {
+        'command': name,
+        'median_ms': median * 1000,
+        'min_ms': timings[0] * 1000,
+        'max_ms': timings[-1] * 1000,
+        'budget_ms': budget,
+        'status': sorted(statuses),
+        'loaded_modules': sorted(loaded),
+        'ok': median * 1000 <= budget and statuses == set([0]) and
+              not loaded,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=u'tinify-cli 启动时间基准测试',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog='python -m tinifycli.startup_benchmark')
+    parser.add_argument('--runs', default=10, type=int,
+                        help=u'每个命令运行的次数')
+    parser.add_argument('--images', default=50, type=int,
+                        help=u'预览时源目录中的图片数量')
+    parser.add_argument('--version-budget', default=150, type=float,
+                        help=u'tinify-cli --version 用时中位数的上限 (毫秒)')
+    parser.add_argument('--preview-budget', default=250, type=float,
+                        help=u'tinify-cli -p 用时中位数的上限 (毫秒)')
+    parser.add_argument('--output', default=None,
+                        help=u'把结果以 JSON 格式写入此文件')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='tinify-cli-startup-')
+    try:
+        src_dir = os.path.join(workdir, 'src')
+        os.makedirs(src_dir)
+        for i in range(args.images):
+            open(os.path.join(src_dir, 'img%05d.png' % i), 'wb').close()
+        results = [
+            measure('--version', ['--version'], args.runs,
+                    args.version_budget),
+            # 预览不需要 Key , 给一个不存在的 Key 文件以确认这一点
+            measure('-p', [src_dir, '-p', '-K',
+                           os.path.join(workdir, 'no-such-keys')],
+                    args.runs, args.preview_budget),
+        ]
+    finally:
+        shutil.rmtree(workdir)
+
+    for result in results:
+        line = 'tinify-cli %-10s 中位数 %7.1f ms (%.1f - %.1f), 预算 %.0f ms' % (
+            result['command'], result['median_ms'], result['min_ms'],
+            result['max_ms'], result['budget_ms'])
+        if result['status'] != [0]:
+            line += ', 退出码 ' + ','.join(map(str, result['status']))
+        if result['loaded_modules']:
+            line += ', 导入了 ' + ','.join(result['loaded_modules'])
+        line += '  ' + ('OK' if result['ok'] else 'FAIL')
+        sys.stdout.write(line + '\n')
+
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    if not all(result['ok'] for result in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
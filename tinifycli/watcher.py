@@ -0,0 +1,277 @@
+# coding=utf-8
+
+''' 监视源目录, 逐个产生新出现的图片 (--watch)
+
+Linux 上通过 ctypes 使用 inotify , 其他系统 (或 inotify 不可用时) 定期扫描
+目录. 两种方式都会等文件写完再产生它: 文件在 SETTLE_TIME 秒内大小和修改时间
+都没有变化, 并且 (inotify 下) 写入者已经关闭了文件.
+
+定期扫描每次都要遍历整个目录树并 stat 每个文件, 所以没有变化时逐渐拉长
+扫描的间隔 (POLL_INTERVAL 到 MAX_POLL_INTERVAL 秒), 一有变化就恢复.
+'''
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+LOGGER = logging.getLogger('tinify-cli')
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+def _load_libc():
+    ''' 返回支持 inotify 的 libc , 不支持时返回 None '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+class _PendingFile(object):
+    ''' 一个可能还没有写完的文件 '''
+    __slots__ = ('deadline', 'stat', 'is_closed')
+
+    def __init__(self, deadline, is_closed):
+        self.deadline = deadline
+        self.stat = None  # 上一次检查时的 (大小, 修改时间)
+        self.is_closed = is_closed
+
+class TinifyCliWatcher(object):
+    ''' 监视 root 下 (recursive 时包括子目录, 但不包括 exclude_dir) 的文件,
+    files() 是一个直到 stop() 才结束的生成器, 逐个产生写完的文件相对于 root
+    的路径 '''
+
+    SETTLE_TIME = 0.5  # 文件在这么多秒内没有变化才认为写完了
+    # inotify 下没有收到关闭事件的文件 (例如写入者一直打开着它),
+    # 这么多秒没有变化也认为写完了
+    OPEN_FILE_TIMEOUT = 30.0
+    POLL_INTERVAL = 1.0  # 不能使用 inotify 时扫描目录的最短间隔 (秒)
+    MAX_POLL_INTERVAL = 8.0  # 一直没有变化时, 扫描间隔最多拉长到这么多秒
+    MAX_WAIT = 1.0  # 最多等待这么多秒就检查一次, 使主线程能响应 SIGINT
+
+    def __init__(self, root, recursive=False, exclude_dir=None,
+                 use_inotify=True):
+        self.root = root
+        self.recursive = recursive
+        self.exclude_dir = exclude_dir
+        self.pending = {}  # 相对路径 => _PendingFile
+        self.snapshot = {}  # 扫描模式下, 相对路径 => (大小, 修改时间)
+        self.watch_dirs = {}  # inotify 的 watch descriptor => 相对路径
+        self.poll_interval = self.POLL_INTERVAL
+        self.inotify_fd = None
+        self.stopped = False
+        self.libc = _load_libc() if use_inotify else None
+        if self.libc is not None:
+            fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.inotify_fd = fd
+            else:
+                LOGGER.warn('无法使用 inotify (' +
+                            os.strerror(ctypes.get_errno()) + '), 改为定期扫描')
+
+    @property
+    def backend(self):
+        return 'inotify' if self.inotify_fd is not None else 'poll'
+
+    def _walk(self, rel_dir=''):
+        ''' 产生 rel_dir 下 (及其子目录中) 的 (相对路径, 是否为目录) '''
+        dir_stack = [rel_dir]
+        while dir_stack:
+            rel_dir = dir_stack.pop()
+            abs_dir = os.path.join(self.root, rel_dir)
+            try:
+                names = os.listdir(abs_dir)
+            except OSError:
+                continue  # 目录在扫描时被删除了
+            for name in names:
+                rel_path = os.path.join(rel_dir, name)
+                abs_path = os.path.join(abs_dir, name)
+                if os.path.isdir(abs_path):
+                    if self.recursive and abs_path != self.exclude_dir:
+                        yield rel_path, True
+                        dir_stack.append(rel_path)
+                else:
+                    yield rel_path, False
+
+    def _add_watch(self, rel_dir):
+        abs_dir = os.path.join(self.root, rel_dir)
+        wd = self.libc.inotify_add_watch(self.inotify_fd, abs_dir,
+                                         WATCH_MASK)
+        if wd < 0:
+            LOGGER.warn('无法监视目录 ' + abs_dir + ' (' +
+                        os.strerror(ctypes.get_errno()) + ')')
+            return
+        self.watch_dirs[wd] = rel_dir
+
+    def _stat(self, rel_path):
+        try:
+            st = os.stat(os.path.join(self.root, rel_path))
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def _touch(self, rel_path, is_closed, now, stat=None):
+        ''' 文件有了变化, 重新开始等待它写完. 已经知道文件的 (大小,
+        修改时间) 时由 stat 给出, 省去一轮检查. '''
+        entry = self.pending.get(rel_path)
+        if entry is None:
+            entry = _PendingFile(now + self.SETTLE_TIME, is_closed)
+            self.pending[rel_path] = entry
+        else:
+            entry.deadline = now + self.SETTLE_TIME
+            entry.is_closed = is_closed
+        entry.stat = stat
+
+    def files(self):
+        ''' 先产生已有的文件, 然后不停地产生新出现的文件 '''
+        if self.inotify_fd is not None:
+            # 先开始监视再扫描, 以免漏掉扫描期间出现的文件
+            self._add_watch('')
+            for rel_path, is_dir in self._walk():
+                if is_dir:
+                    self._add_watch(rel_path)
+                else:
+                    yield rel_path
+        else:
+            for rel_path, is_dir in self._walk():
+                if not is_dir:
+                    self.snapshot[rel_path] = self._stat(rel_path)
+                    yield rel_path
+        LOGGER.info('开始监视 ' + self.root + ' (' + self.backend + ')')
+
+        next_poll = time.time() + self.POLL_INTERVAL
+        while not self.stopped:
+            now = time.time()
+            timeout = self.MAX_WAIT
+            if self.pending:
+                timeout = min(timeout, max(0, min(
+                    entry.deadline for entry in self.pending.values()) - now))
+            if self.inotify_fd is not None:
+                self._read_events(timeout)
+            else:
+                if now >= next_poll:
+                    if self._poll(now):
+                        self.poll_interval = self.POLL_INTERVAL
+                    else:
+                        self.poll_interval = min(self.poll_interval * 2,
+                                                 self.MAX_POLL_INTERVAL)
+                    next_poll = now + self.poll_interval
+                time.sleep(max(0, min(timeout, next_poll - now)))
+            for rel_path in self._settled(time.time()):
+                yield rel_path
+
+    def _read_events(self, timeout):
+        try:
+            readable, _, _ = select.select([self.inotify_fd], [], [],
+                                           timeout)
+        except select.error as err:
+            if err.args[0] == errno.EINTR:
+                return
+            raise
+        if not readable:
+            return
+        try:
+            data = os.read(self.inotify_fd, 64 * 1024)
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        now = time.time()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                LOGGER.warn('inotify 事件队列溢出, 重新扫描源目录')
+                for rel_path, is_dir in self._walk():
+                    if is_dir:
+                        self._add_watch(rel_path)
+                    else:
+                        self._touch(rel_path, True, now)
+                continue
+            if mask & IN_IGNORED:
+                self.watch_dirs.pop(wd, None)  # 目录被删除了
+                continue
+            rel_dir = self.watch_dirs.get(wd)
+            if rel_dir is None or not name:
+                continue
+            rel_path = os.path.join(rel_dir, name)
+            if mask & IN_ISDIR:
+                abs_path = os.path.join(self.root, rel_path)
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO) and \
+                        abs_path != self.exclude_dir:
+                    # 新目录: 监视它, 并处理在开始监视之前已经放进去的文件
+                    self._add_watch(rel_path)
+                    for sub_path, is_dir in self._walk(rel_path):
+                        if is_dir:
+                            self._add_watch(sub_path)
+                        else:
+                            self._touch(sub_path, True, now)
+                continue
+            self._touch(rel_path, bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO)),
+                        now)
+
+    def _poll(self, now):
+        ''' 扫描目录, 把新出现或有变化的文件放入 pending , 返回是否有这样
+        的文件 '''
+        snapshot = {}
+        changed = False
+        for rel_path, is_dir in self._walk():
+            if is_dir:
+                continue
+            stat = self._stat(rel_path)
+            snapshot[rel_path] = stat
+            if stat is not None and self.snapshot.get(rel_path) != stat:
+                self._touch(rel_path, True, now, stat)
+                changed = True
+        self.snapshot = snapshot
+        return changed
+
+    def _settled(self, now):
+        ''' 取出已经写完的文件 '''
+        ready = []
+        for rel_path, entry in self.pending.items():
+            if now < entry.deadline:
+                continue
+            stat = self._stat(rel_path)
+            if stat is None:
+                del self.pending[rel_path]  # 文件被删除或改名了
+            elif stat != entry.stat:
+                # 第一次检查, 或者仍在变化
+                entry.stat = stat
+                entry.deadline = now + self.SETTLE_TIME
+            elif entry.is_closed or now - stat[1] >= self.OPEN_FILE_TIMEOUT:
+                del self.pending[rel_path]
+                ready.append(rel_path)
+            else:
+                entry.deadline = now + self.SETTLE_TIME
+        return ready
+
+    def stop(self):
+        ''' 使 files() 在 MAX_WAIT 秒内结束, 可以在信号处理函数中调用 '''
+        self.stopped = True
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
@@ -3,37 +3,373 @@
 ''' 压缩 '''
 
 import logging
+import os
+import threading
+import time
 import traceback
 
 from . import api as tf
+from .cache import file_digest
+from .output import commit_temp, discard_temp
+from . import profiler
 
 from . import shared_var
+from .display import report
 
 LOGGER = logging.getLogger('tinify-cli')
 
+# 流水线模式下, 不超过这个大小的图片在 read 阶段整个读入内存
+READ_AHEAD_LIMIT = 8 * 1024 * 1024
+# 所有排队中的任务读入内存的总字节数上限, 超出时直接从文件上传
+READ_AHEAD_TOTAL = 64 * 1024 * 1024
+
+class TinifyCliByteBudget(object):
+    ''' 限制同时占用的字节数. 不阻塞: 超出时 try_acquire 返回 False . '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self, size):
+        with self.lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self.lock:
+            self.used -= size
+
+READ_AHEAD_BUDGET = TinifyCliByteBudget(READ_AHEAD_TOTAL)
+
+def _lookup_cache(src, dest, resize):
+    ''' 返回仍需处理的 (输出列表, 对应的缓存键列表) , 全部命中缓存时
+    记录完成并返回 (None, 统计信息) . 没有启用缓存时缓存键列表为 None . '''
+    if isinstance(dest, tuple):
+        # 一次上传, 输出多个尺寸, dest 和 resize 一一对应
+        outputs = zip(dest, resize)
+    else:
+        outputs = [(dest, resize)]
+
+    cache = shared_var.result_cache
+    if cache is None:
+        return outputs, None
+    if isinstance(dest, tuple):
+        cache_keys = cache.make_keys(src, resize)
+    else:
+        cache_keys = [cache.make_key(src, resize)]
+    missed = [(output, cache_key)
+              for output, cache_key in zip(outputs, cache_keys)
+              if not cache.lookup(cache_key, output[0],
+                                  shared_var.output_syncer)]
+    if not missed:
+        LOGGER.info('文件 ' + os.path.basename(src) + ' 命中缓存, 跳过上传')
+        _record_done(src, dest, resize)
+        dest_size = sum(os.path.getsize(output[0]) for output in outputs)
+        report(('cached', dest_size))
+        return None, {'cached': True, 'src_size': os.path.getsize(src),
+                      'dest_size': dest_size}
+    return ([output for output, _ in missed],
+            [cache_key for _, cache_key in missed])
+
+def _lookup_shrunk(src, data=None):
+    ''' 在续传日志和输出地址库中查找 src 之前上传得到的输出地址, 返回
+    (来源, (输出地址, 服务器返回的 JSON)) , 没有时返回 (None, None) '''
+    journal = shared_var.resume_journal
+    if journal is not None:
+        shrunk = journal.lookup(src)
+        if shrunk is not None:
+            return 'journal', shrunk
+    store = shared_var.location_store
+    if store is not None:
+        shrunk = store.lookup(src, data)
+        if shrunk is not None:
+            return 'store', shrunk
+    return None, None
+
+def _resumed_key(src, data=None):
+    ''' 之前上传过 src , 且当时上传所用的 Key 仍然可用时, 返回这个 Key '''
+    _, shrunk = _lookup_shrunk(src, data)
+    if shrunk is None:
+        return None
+    return shared_var.key_holder.find_key(shrunk[1].get('key_id'))
+
+def _shrink(tinify, src, data=None):
+    ''' 上传 src , 把输出地址记入续传日志和输出地址库, 返回 (输出地址,
+    服务器返回的 JSON) . 之前上传过 src 时不再上传, 直接返回当时的
+    输出地址. '''
+    journal = shared_var.resume_journal
+    store = shared_var.location_store
+    source, shrunk = _lookup_shrunk(src, data)
+    if source == 'journal':
+        LOGGER.info('文件 ' + os.path.basename(src) +
+                    ' 已在上次运行时上传, 直接下载输出')
+        journal.mark_resumed()
+    elif source == 'store':
+        LOGGER.info('文件 ' + os.path.basename(src) +
+                    ' 的压缩结果仍在服务器上, 直接取得输出')
+        store.mark_reused()
+    if shrunk is not None:
+        tinify.resumed = source
+        tinify.src_size = os.path.getsize(src)
+        tinify.shrink_time = 0.0
+        return shrunk
+    download_url, info = tinify.shrink(src, data)
+    # 之后用同一个 Key 下载. 记下的是 Key 的指纹, Key 本身不写进文件
+    info['key_id'] = shared_var.key_holder.fingerprint(tinify.key)
+    if journal is not None:
+        journal.record(src, download_url, info)
+    if store is not None:
+        store.record(src, download_url, info, data)
+    return download_url, info
+
+def _resume_failure(err, tinify, args):
+    ''' 用之前得到的输出地址下载失败. 输出地址可能已经失效, 删除记录,
+    重新上传 '''
+    LOGGER.warn(u'文件 ' + os.path.basename(args[0]) + u' 之前得到的输出' +
+                u'地址无法下载, 重新上传 ' + err.message)
+    if tinify.resumed == 'journal':
+        shared_var.resume_journal.discard(args[0], stale=True)
+    else:
+        shared_var.location_store.discard(args[0])
+    report(('failure', tinify.key, 'staleResume'))
+    return ('staleResume', args, unicode(err))
+
+def _record_done(src, dest, resize, outputs=None, cache_keys=None):
+    ''' 把处理结果记入缓存, 清单, 租约表和续传日志 '''
+    if cache_keys is not None:
+        for (output_dest, _), cache_key in zip(outputs, cache_keys):
+            shared_var.result_cache.store(cache_key, output_dest)
+    if shared_var.manifest is not None:
+        shared_var.manifest.record(src, dest, resize)
+    if shared_var.lease_store is not None:
+        shared_var.lease_store.complete(src, dest)
+    if shared_var.resume_journal is not None:
+        shared_var.resume_journal.discard(src)
+
+def _success_info(tinify):
+    ''' 成功时随 "success" 一起返回的统计信息 '''
+    return {
+        'key': tinify.key,
+        'src_size': tinify.src_size,
+        'dest_size': tinify.dest_size,
+        'shrink_time': tinify.shrink_time,
+        'download_time': tinify.download_time,
+        'resumed': tinify.resumed,
+    }
+
+def _report_success(tinify):
+    report(('success', tinify.key, tinify.src_size, tinify.dest_size,
+            tinify.shrink_time, tinify.download_time,
+            tinify.compression_count, tinify.bytes_up, tinify.bytes_down))
+
+def _report_exception(key):
+    ''' 报告 'start' 之后发生了 API 异常以外的异常 (由调度器记为失败),
+    使进行中的图片数保持正确 '''
+    report(('failure', key, 'internalError'))
+
+def _failure(err, key, args):
+    ''' 把 API 的异常转换为失败原因, 返回 (失败原因, 任务参数, 错误信息) '''
+    if isinstance(err, tf.AccountError):
+        LOGGER.warn("Key " + key + " 不正确或用量耗尽, 移除本 Key 并重试")
+        shared_var.key_holder.remove_key(key, err)
+        reason = 'accountError'
+    elif isinstance(err, tf.ConnectionError):
+        LOGGER.error(u"网络连接出错, 重试 " + err.message)
+        reason = 'netError'
+    elif isinstance(err, tf.ClientError):
+        LOGGER.error(u"谜之错误, 请报告开发者 " + err.message)
+        traceback.print_exc()
+        reason = 'clientError'
+    elif isinstance(err, tf.RateLimitError):
+        LOGGER.warn(u"请求太频繁, 稍后重试 " + err.message)
+        reason = 'rateLimited'
+    else:
+        LOGGER.error(u"服务器错误, 请稍后重试 " + err.message)
+        reason = 'serverError'
+    report(('failure', key, reason))
+    return (reason, args, unicode(err))
+
 def compress((src, dest, resize)):
+    outputs, cache_keys = _lookup_cache(src, dest, resize)
+    if outputs is None:  # 全部命中缓存, 此时 cache_keys 为统计信息
+        return "success", cache_keys
+
+    key = shared_var.key_holder.acquire_key(_resumed_key(src))
+    tinify = tf.TinifyCliClient(key, shared_var.session_pool,
+                                shared_var.rate_limiter,
+                                syncer=shared_var.output_syncer)
+    report(('start', key))
     try:
-        key = shared_var.key_holder.acquire_key()
+        shrunk = _shrink(tinify, src)
+        if isinstance(dest, tuple):
+            tinify.compress_variants(src, outputs, shrunk)
+        else:
+            tinify.compress(src, dest, resize, shrunk)
+        _record_done(src, dest, resize, outputs, cache_keys)
+        _report_success(tinify)
+        return "success", _success_info(tinify)
+    except tf.Error, e:
+        if tinify.resumed and isinstance(e, (tf.AccountError,
+                                             tf.ClientError)):
+            return _resume_failure(e, tinify, [src, dest, resize])
+        return _failure(e, key, [src, dest, resize])
+    except:
+        _report_exception(key)
+        raise
+    finally:
+        shared_var.key_holder.release_key(key, tinify.compression_count)
+
+class CompressJob(object):
+    ''' 流水线中在各阶段之间传递的一个任务 '''
+
+    def __init__(self, src, dest, resize, outputs, cache_keys):
+        self.src = src
+        self.dest = dest
+        self.resize = resize
+        self.outputs = outputs  # (dest, resize) 的 list
+        self.cache_keys = cache_keys
+        self.data = None  # 读入内存的源文件内容
+        self.data_size = 0  # 在 READ_AHEAD_BUDGET 中占用的字节数
+        self.key = None
+        self.tinify = None
+        self.download_url = None
+        self.info = None  # 上传后服务器返回的 JSON
+        # 与 outputs 对应的 (临时文件的路径, 图片大小, 响应) 的 list ,
+        # 直接使用原图的为 None
+        self.results = None
+
+    @property
+    def args(self):
+        return [self.src, self.dest, self.resize]
+
+    def drop_data(self):
+        self.data = None
+        if self.data_size:
+            READ_AHEAD_BUDGET.release(self.data_size)
+            self.data_size = 0
+
+def read_stage((src, dest, resize)):
+    ''' 流水线的第一个阶段: 查询缓存, 读取源文件. 排队等待上传的图片
+    在内存中的总大小不超过 READ_AHEAD_TOTAL , 超出时上传阶段直接从文件
+    上传. '''
+    outputs, cache_keys = _lookup_cache(src, dest, resize)
+    if outputs is None:  # 全部命中缓存, 此时 cache_keys 为统计信息
+        return "success", cache_keys
+    job = CompressJob(src, dest, resize, outputs, cache_keys)
+    size = os.path.getsize(src)
+    if size <= READ_AHEAD_LIMIT and READ_AHEAD_BUDGET.try_acquire(size):
+        job.data_size = size
+        start_time = time.time()
         try:
-            tinify = tf.TinifyCliClient(key)
-            tinify.compress(src, dest, resize)
-        except tf.AccountError, e:
-            LOGGER.warn("Key " + key + " 不正确或用量耗尽, 移除本 Key 并重试")
-            shared_var.key_holder.remove_key(key)
-            return ("accountError", [src, dest, resize])
-        except tf.ConnectionError, e:
-            LOGGER.error("网络连接出错, 重试" + e.message)
-            return ("netError", [src, dest, resize])
-        except tf.ClientError, e:
-            LOGGER.error("谜之错误, 请报告开发者" + e.message)
-            traceback.print_exc()
-            return ("clientError", [key, src, dest, resize])
-        except tf.ServerError, e:
-            LOGGER.error("服务器错误, 请稍后重试" + e.message)
-            return ("serverError", [key, src, dest, resize])
-    except AttributeError as err:
-        # 在使用信号 SIGINT 终止程序时, 偶尔会抛出这个异常, 但原因未知
-        LOGGER.info('发生了错误 ' + str(err))
-
-    return "success",
+            with open(src, 'rb') as fp:
+                job.data = fp.read()
+        except:
+            job.drop_data()
+            raise
+        if profiler.PROFILER is not None:
+            profiler.PROFILER.record('read', start_time, time.time())
+        if shared_var.manifest is not None:
+            # 顺便算出内容哈希, 清单记录时不再读文件
+            file_digest(src, job.data)
+    return job
+
+def upload_stage(job):
+    ''' 上传并等待服务器压缩 '''
+    job.key = shared_var.key_holder.acquire_key(
+        _resumed_key(job.src, job.data))
+    job.tinify = tf.TinifyCliClient(job.key, shared_var.session_pool,
+                                    shared_var.rate_limiter,
+                                    syncer=shared_var.output_syncer)
+    report(('start', job.key))
+    try:
+        job.download_url, job.info = _shrink(job.tinify, job.src, job.data)
+    except tf.Error, e:
+        shared_var.key_holder.release_key(job.key,
+                                          job.tinify.compression_count)
+        return _failure(e, job.key, job.args)
+    except:
+        shared_var.key_holder.release_key(job.key,
+                                          job.tinify.compression_count)
+        _report_exception(job.key)
+        raise
+    finally:
+        job.drop_data()
+    return job
+
+def download_stage(job):
+    ''' 把所有输出下载到目标目录中的临时文件, 不经过内存. 压缩后没有变小的
+    不下载, 结果记为 None , 在 write 阶段直接使用原图. '''
+    start_time = time.time()
+    job.results = []
+    try:
+        for dest, resize in job.outputs:
+            job.results.append(
+                None if job.tinify.is_not_smaller(job.info, resize)
+                else job.tinify.fetch_temp(job.download_url, dest, resize))
+    except tf.Error, e:
+        _discard_results(job)
+        if job.tinify.resumed and isinstance(e, (tf.AccountError,
+                                                 tf.ClientError)):
+            return _resume_failure(e, job.tinify, job.args)
+        return _failure(e, job.key, job.args)
+    except:
+        _discard_results(job)
+        _report_exception(job.key)
+        raise
+    finally:
+        shared_var.key_holder.release_key(job.key,
+                                          job.tinify.compression_count)
+    job.tinify.download_time = time.time() - start_time
+    return job
+
+def _discard_results(job):
+    ''' 删除已经下载但不会再用的临时文件 '''
+    for result in job.results or []:
+        if result is not None:
+            discard_temp(result[0])
+    job.results = None
+
+def write_stage(job):
+    ''' 流水线的最后一个阶段: 把下载好的临时文件改名为输出文件并记录结果 '''
+    tinify = job.tinify
+    tinify.dest_size = 0
+    is_variants = isinstance(job.dest, tuple)
+    try:
+        for (dest, _), result in zip(job.outputs, job.results):
+            if result is None:
+                dest_size = tinify.place_original(job.src, dest)
+                headers = {}
+            else:
+                temp_path, dest_size, response = result
+                commit_temp(temp_path, dest, tinify.syncer)
+                headers = response.headers
+            tinify.dest_size += dest_size
+            output_info = {} if is_variants else job.info['output']
+            tinify._log_result(dest if is_variants else job.src,
+                               headers.get('image-width',
+                                           output_info.get('width', '?')),
+                               headers.get('image-height',
+                                           output_info.get('height', '?')),
+                               dest_size)
+        _record_done(job.src, job.dest, job.resize, job.outputs,
+                     job.cache_keys)
+    except:
+        _discard_results(job)  # 已经改名的不受影响
+        _report_exception(job.key)
+        raise
+    _report_success(tinify)
+    return "success", _success_info(tinify)
 
+# 流水线的阶段: (名字, 函数)
+PIPELINE_STAGES = [
+    ('read', read_stage),
+    ('upload', upload_stage),
+    ('download', download_stage),
+    ('write', write_stage),
+]
+# 按 Ctrl+C 后, read 和 upload 阶段中还没有开始的任务被放弃,
+# 已经上传的任务继续下载和写入
+PIPELINE_DRAIN_STAGES = 2